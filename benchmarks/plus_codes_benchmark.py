@@ -0,0 +1,44 @@
+"""
+Compares openlocationcode.encode called once per point with the vectorized encoder in
+open_buildings.plus_codes, on random coordinates, and checks both give the same codes.
+Prints codes per second for each.
+
+    python benchmarks/plus_codes_benchmark.py --rows 1000000
+"""
+
+import argparse
+import time
+
+import numpy as np
+from openlocationcode import openlocationcode as olc
+
+from open_buildings.plus_codes import encode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--code-length', type=int, default=12)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    lat = rng.uniform(-90, 90, args.rows)
+    lon = rng.uniform(-180, 180, args.rows)
+
+    start = time.perf_counter()
+    before = [olc.encode(y, x, codeLength=args.code_length) for y, x in zip(lat.tolist(), lon.tolist())]
+    before_rate = args.rows / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    after = encode(lat, lon, args.code_length)
+    after_rate = args.rows / (time.perf_counter() - start)
+
+    assert after.to_pylist() == before
+
+    print(f"Rows: {args.rows}")
+    print(f"openlocationcode.encode: {before_rate:,.0f} codes/sec")
+    print(f"Vectorized encode: {after_rate:,.0f} codes/sec ({after_rate / before_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
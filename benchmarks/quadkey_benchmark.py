@@ -0,0 +1,60 @@
+"""
+Compares the old per-row Python quadkey UDF (mercantile called once per row) with the
+vectorized arrow UDF in open_buildings.quadkey, running the same UPDATE the add_columns
+scripts run. Prints rows per second for each.
+
+    python benchmarks/quadkey_benchmark.py --rows 1000000
+"""
+
+import argparse
+import time
+
+import duckdb
+import mercantile
+from duckdb.typing import DOUBLE, INTEGER, VARCHAR
+
+from open_buildings.quadkey import register_quadkey_function
+
+
+def scalar_lat_lon_to_quadkey(lat, lon, level):
+    return mercantile.quadkey(mercantile.tile(lon, lat, level))
+
+
+def run(con, rows):
+    con.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS quadkey VARCHAR")
+    start = time.perf_counter()
+    con.execute("UPDATE buildings SET quadkey = lat_lon_to_quadkey(lat, lon, 12)")
+    return rows / (time.perf_counter() - start)
+
+
+def make_table(con, rows):
+    con.execute(f"""
+    CREATE TABLE buildings AS
+    SELECT random() * 360 - 180 AS lon, random() * 170 - 85 AS lat FROM range({rows})
+    """)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    con = duckdb.connect()
+    con.execute("SELECT setseed(0.42)")
+    make_table(con, args.rows)
+    con.create_function('lat_lon_to_quadkey', scalar_lat_lon_to_quadkey, [DOUBLE, DOUBLE, INTEGER], VARCHAR)
+    before = run(con, args.rows)
+
+    con = duckdb.connect()
+    con.execute("SELECT setseed(0.42)")
+    make_table(con, args.rows)
+    register_quadkey_function(con)
+    after = run(con, args.rows)
+
+    print(f"Rows: {args.rows}")
+    print(f"Per-row Python UDF: {before:,.0f} rows/sec")
+    print(f"Vectorized arrow UDF: {after:,.0f} rows/sec ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares the old row by row multipolygon splitting in process_with_pandas (one to_crs and
+one pd.concat per part) with split_multipolygons_gdf, which explodes all the multipolygons
+at once and reprojects the parts in a single call. Runs on a Google Open Buildings CSV if
+one is given, otherwise on generated buildings, and checks that both give the same output.
+
+    python benchmarks/split_multipolygons_benchmark.py --csv 0e9_buildings.csv
+    python benchmarks/split_multipolygons_benchmark.py --rows 20000
+"""
+
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from openlocationcode import openlocationcode as olc
+from shapely import wkt
+from shapely.geometry import MultiPolygon, box
+
+from open_buildings.google.process import split_multipolygons_gdf
+
+
+def split_rowwise(gdf):
+    output_gdf = gpd.GeoDataFrame(columns=list(gdf.columns), crs=gdf.crs)
+    multipolygons = gdf[gdf.geometry.type == 'MultiPolygon']
+    for i, row in multipolygons.iterrows():
+        for polygon in row.geometry.geoms:
+            new_area = gpd.GeoSeries([polygon], crs=gdf.crs).to_crs('EPSG:6933').area.values[0]
+            centroid = polygon.centroid
+            properties = row.drop('geometry').to_dict()
+            properties['area_in_meters'] = new_area
+            properties['full_plus_code'] = olc.encode(centroid.y, centroid.x, codeLength=12)
+            output_gdf = pd.concat(
+                [output_gdf, gpd.GeoDataFrame([properties], geometry=[polygon], crs=gdf.crs)],
+                ignore_index=True,
+            )
+    polygons = gdf[gdf.geometry.type == 'Polygon']
+    return pd.concat([output_gdf, polygons], ignore_index=True)
+
+
+def read_csv(path):
+    df = pd.read_csv(path)
+    df['geometry'] = df['geometry'].apply(wkt.loads)
+    df = df.drop(['latitude', 'longitude'], axis=1)
+    return gpd.GeoDataFrame(df, geometry='geometry', crs='EPSG:4326')
+
+
+def generate(rows, multi_fraction):
+    rng = np.random.default_rng(42)
+    x = rng.uniform(-10, 40, rows)
+    y = rng.uniform(-30, 30, rows)
+    size = 0.0002
+    geometries = []
+    for i in range(rows):
+        b = box(x[i], y[i], x[i] + size, y[i] + size)
+        if rng.random() < multi_fraction:
+            b = MultiPolygon([b, box(x[i] + 2 * size, y[i], x[i] + 3 * size, y[i] + size)])
+        geometries.append(b)
+    return gpd.GeoDataFrame(
+        {'area_in_meters': np.zeros(rows), 'confidence': rng.random(rows), 'full_plus_code': [''] * rows},
+        geometry=geometries,
+        crs='EPSG:4326',
+    )
+
+
+def timed(function, gdf):
+    start = time.perf_counter()
+    output = function(gdf)
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', help="A Google Open Buildings CSV file")
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--multi-fraction', type=float, default=0.05)
+    args = parser.parse_args()
+
+    gdf = read_csv(args.csv) if args.csv else generate(args.rows, args.multi_fraction)
+    multipolygons = (gdf.geometry.type == 'MultiPolygon').sum()
+
+    before, before_seconds = timed(split_rowwise, gdf)
+    after, after_seconds = timed(split_multipolygons_gdf, gdf)
+
+    assert list(before.geometry) == list(after.geometry)
+    assert list(before['full_plus_code']) == list(after['full_plus_code'])
+    assert np.allclose(before['area_in_meters'].astype(float), after['area_in_meters'].astype(float))
+
+    print(f"Rows: {len(gdf)}, multipolygons: {multipolygons}")
+    print(f"Row by row: {before_seconds:.2f} seconds")
+    print(f"Vectorized: {after_seconds:.2f} seconds ({before_seconds / after_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
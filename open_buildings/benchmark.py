@@ -0,0 +1,285 @@
+"""
+Benchmark harness used by `ob google benchmark`. Each benchmark cell is run a few times to
+warm up and then repeated, every run in a fresh process so that its peak memory is its own
+and one run can't leave caches or allocations behind for the next. Runs are timed with
+perf_counter, and the code being measured can mark its read / transform / write phases
+with `phase`, which is a no-op outside of a benchmark run. The repetitions are summarized
+as median, p95 and standard deviation rather than a single number.
+
+Results can be saved as a named baseline, along with the machine and library versions
+they were measured with, and later runs compared against it to catch regressions.
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+from open_buildings import profiling
+
+PHASES = ['read', 'transform', 'write']
+
+# The phases being timed in this process: a stack of [name, start] plus the totals. None
+# when no benchmark run is active.
+_timer = None
+
+
+@contextmanager
+def phase(name):
+    """Times a block as one phase of the current benchmark run. Time inside a nested phase
+    only counts towards the inner one."""
+    if _timer is None:
+        yield
+        return
+    stack, totals = _timer
+    now = time.perf_counter()
+    if stack:
+        outer = stack[-1]
+        totals[outer[0]] = totals.get(outer[0], 0.0) + now - outer[1]
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _, start = stack.pop()
+        totals[name] = totals.get(name, 0.0) + now - start
+        if stack:
+            stack[-1][1] = now
+
+
+def peak_rss():
+    """Peak resident memory in bytes of this process or any child it waited on (like ogr2ogr),
+    or None where the resource module isn't available, as on Windows."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else.
+    return max(own, children) * (1 if sys.platform == 'darwin' else 1024)
+
+
+def measure(function, *args):
+    """Runs function(*args), returning its wall time, the time of each phase it marked and
+    the peak memory of the process."""
+    global _timer
+    _timer = ([], {})
+    try:
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+        phases = _timer[1]
+    finally:
+        _timer = None
+    return {'seconds': seconds, 'phases': phases, 'peak_rss': peak_rss()}
+
+
+def run_isolated(function, *args):
+    """Runs function(*args) in a freshly spawned process and returns its result."""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return profiling.merge(executor.submit(profiling.call, profiling.settings(), function, *args).result())
+
+
+def percentile(values, q):
+    """Linearly interpolated percentile, q between 0 and 100."""
+    values = sorted(values)
+    if not values:
+        return math.nan
+    position = (len(values) - 1) * q / 100
+    low = math.floor(position)
+    high = math.ceil(position)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(values):
+    """Median, p95, standard deviation, min and mean of a list of timings."""
+    if not values:
+        return {'median': math.nan, 'p95': math.nan, 'stddev': math.nan, 'min': math.nan, 'mean': math.nan}
+    return {
+        'median': statistics.median(values),
+        'p95': percentile(values, 95),
+        'stddev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'mean': statistics.fmean(values),
+    }
+
+
+def run_cell(function, args, warmup=1, repetitions=5, isolate=True):
+    """Runs one benchmark cell: warmup runs that are thrown away, then repetitions measured
+    runs. function(*args) has to return the dict from `measure`, plus any other values
+    (like output_bytes), which are taken from the last run.
+
+    Returns a flat dict of the timing summary, the median of each phase, the highest peak
+    memory and the extra values."""
+    run = (lambda: run_isolated(function, *args)) if isolate else (lambda: function(*args))
+    for _ in range(warmup):
+        run()
+    runs = [run() for _ in range(repetitions)]
+
+    result = summarize([r['seconds'] for r in runs])
+    for name in PHASES:
+        times = [r['phases'][name] for r in runs if name in r['phases']]
+        result[f'{name}_seconds'] = statistics.median(times) if times else math.nan
+    peaks = [r['peak_rss'] for r in runs if r['peak_rss'] is not None]
+    result['peak_rss'] = max(peaks) if peaks else math.nan
+    result['repetitions'] = repetitions
+    result.update({k: v for k, v in runs[-1].items() if k not in ('seconds', 'phases', 'peak_rss')})
+    return result
+
+
+def skipped_cell():
+    """The result of run_cell for a cell that wasn't run, with every value missing."""
+    result = summarize([])
+    for name in PHASES:
+        result[f'{name}_seconds'] = math.nan
+    result.update({'peak_rss': math.nan, 'repetitions': 0, 'output_bytes': math.nan})
+    return result
+
+
+# Where named baselines are kept, one JSON file each.
+BASELINE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.open_buildings', 'benchmarks')
+
+
+def machine_fingerprint():
+    """The details of this machine that timings depend on."""
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = None
+    return {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'memory_bytes': memory,
+        'python': platform.python_version(),
+    }
+
+
+def library_versions():
+    """Versions of open_buildings and the libraries doing the conversions."""
+    import duckdb
+    import geopandas
+    import pandas
+    import pyarrow
+    import pyogrio
+
+    import open_buildings
+
+    return {
+        'open_buildings': open_buildings.__version__,
+        'duckdb': duckdb.__version__,
+        'pandas': pandas.__version__,
+        'geopandas': geopandas.__version__,
+        'pyarrow': pyarrow.__version__,
+        'gdal': pyogrio.__gdal_version_string__,
+    }
+
+
+def baseline_path(name, directory=None):
+    if not name or os.sep in name or name.startswith('.'):
+        raise ValueError(f"Invalid baseline name: {name}")
+    return os.path.join(directory or BASELINE_DIRECTORY, f'{name}.json')
+
+
+def _json_value(value):
+    # JSON has no NaN, so missing measurements are stored as null.
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def save_baseline(name, results, settings, directory=None):
+    """Saves benchmark results as the baseline called name, replacing any earlier one.
+    Returns the path it was written to."""
+    path = baseline_path(name, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    baseline = {
+        'version': 1,
+        'name': name,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_fingerprint(),
+        'versions': library_versions(),
+        'settings': settings,
+        'results': [{k: _json_value(v) for k, v in result.items()} for result in results],
+    }
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=4)
+    return path
+
+
+def load_baseline(name, directory=None):
+    path = baseline_path(name, directory)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No baseline called {name} in {os.path.dirname(path)}")
+    with open(path) as f:
+        baseline = json.load(f)
+    for result in baseline['results']:
+        for key, value in result.items():
+            if value is None:
+                result[key] = math.nan
+    return baseline
+
+
+def baseline_differences(baseline, settings):
+    """Describes how the machine, library versions and settings differ from the baseline's, since
+    any of them can explain a change in timings as well as the code can."""
+    differences = []
+    current = {'machine': machine_fingerprint(), 'versions': library_versions(), 'settings': settings}
+    for section, values in current.items():
+        stored = baseline.get(section, {})
+        for key in sorted(set(values) | set(stored)):
+            if values.get(key) != stored.get(key):
+                differences.append(f"{section} {key}: {stored.get(key)} -> {values.get(key)}")
+    return differences
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """Compares the median time of each process and format to the baseline. A cell is a
+    regression when it's more than threshold (as a fraction) slower, and a speedup when it's
+    more than threshold faster. Cells missing from either side are reported as 'new',
+    'missing' or 'skipped'."""
+    stored = {(r['process'], r['format']): r for r in baseline['results']}
+    comparison = []
+    for result in results:
+        key = (result['process'], result['format'])
+        current = result['median']
+        previous = stored[key]['median'] if key in stored else math.nan
+        if key not in stored:
+            status = 'new'
+        elif math.isnan(current) or math.isnan(previous):
+            status = 'skipped'
+        elif current > previous * (1 + threshold):
+            status = 'regression'
+        elif current < previous * (1 - threshold):
+            status = 'speedup'
+        else:
+            status = 'unchanged'
+        comparison.append({
+            'process': key[0],
+            'format': key[1],
+            'baseline': previous,
+            'current': current,
+            'speedup': previous / current if current > 0 else math.nan,
+            'status': status,
+        })
+    current_keys = {(r['process'], r['format']) for r in results}
+    for key, result in stored.items():
+        if key not in current_keys:
+            comparison.append({
+                'process': key[0],
+                'format': key[1],
+                'baseline': result['median'],
+                'current': math.nan,
+                'speedup': math.nan,
+                'status': 'missing',
+            })
+    return comparison
@@ -0,0 +1,316 @@
+"""
+An on-disk cache for reading remote partition files, so repeated queries over the same area
+read from local disk instead of the network.
+
+Files are cached in blocks of BLOCK_SIZE bytes rather than whole. A query only touches the
+footer and the row groups it reads, so only those byte ranges get downloaded and kept. Each
+block is keyed by the object's URL, its version and its offset. The version is the object's
+size and last modified time, as pyarrow doesn't give the ETag, and both change whenever the
+object is replaced. So a rewritten file is fetched again instead of being served stale.
+
+The cache is capped at max_bytes. Reading a block touches its file, and past the cap the
+least recently used blocks are removed. Hits, misses and bytes are counted in `stats`.
+
+`TileCache.open` gives a file-like object that pyarrow can read Parquet from, and
+`cached_parquet_reader` streams a list of files through the cache as one Arrow stream,
+which DuckDB can query like a table. Given the bounds of the area being queried it only
+reads the row groups that can hold rows there, and given the columns the query uses only
+those, so the rest are never fetched.
+
+The cache is opt in (get_buildings --cache-dir). A cold read costs more than letting DuckDB
+read the files itself: the blocks are fetched by pyarrow one request at a time from Python,
+where DuckDB's httpfs makes its requests in parallel, and every block is also written to
+disk. It pays off when the same area, or areas near each other, are queried again.
+"""
+
+import hashlib
+import io
+import os
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from open_buildings.connection import DEFAULT_S3_REGION
+from open_buildings.partitions import add_summaries, footer_row_groups, row_group_summary, select_row_groups_for_areas
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.open_buildings', 'cache')
+
+DEFAULT_CACHE_SIZE = 5 * 2**30
+
+# Small enough that a footer or a row group doesn't drag in much around it, big enough that
+# a row group is a handful of requests. Runs of missing blocks are fetched in one request.
+BLOCK_SIZE = 2**20
+
+# Once over the cap, blocks are evicted down to this share of it, so every new block
+# doesn't set off another eviction.
+EVICT_TO = 0.9
+
+
+def filesystem_for(url):
+    """The pyarrow filesystem and path for a URL. S3 buckets are read anonymously, since the
+    buildings are in public buckets."""
+    if url.startswith('s3://'):
+        return pafs.S3FileSystem(anonymous=True, region=DEFAULT_S3_REGION), url[len('s3://'):]
+    return pafs.FileSystem.from_uri(url if '://' in url else os.path.abspath(url))
+
+
+class TileCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_CACHE_SIZE, block_size=BLOCK_SIZE, filesystem=None):
+        """With a filesystem, URLs are paths on it instead of being resolved with filesystem_for.
+        That's how a local directory or a local S3 stand-in can take the place of a bucket."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.filesystem = filesystem
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_cached': 0, 'bytes_fetched': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Size and last use of every block, by path. Blocks left by earlier runs count too.
+        self._blocks = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if name.endswith('.block'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    self._blocks[path] = (stat.st_size, stat.st_mtime)
+        self.total_bytes = sum(size for size, _ in self._blocks.values())
+
+    def _resolve(self, url):
+        if self.filesystem is not None:
+            return self.filesystem, url
+        return filesystem_for(url)
+
+    def open(self, url):
+        """A read-only, seekable file for url that reads through the cache."""
+        filesystem, path = self._resolve(url)
+        info = filesystem.get_file_info(path)
+        if info.type != pafs.FileType.File:
+            raise FileNotFoundError(url)
+        version = f"{info.size}-{info.mtime_ns}"
+        key = hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+        return CachedFile(self, filesystem, path, key, info.size)
+
+    def _block_path(self, key, index):
+        return os.path.join(self.directory, key[:2], key, f'{index}.block')
+
+    def read_blocks(self, cached_file, first, last):
+        """The bytes of blocks first to last (inclusive) of a file, from disk where cached and
+        fetched in runs where not."""
+        blocks = []
+        missing = []
+        for index in range(first, last + 1):
+            path = self._block_path(cached_file.key, index)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                blocks.append(None)
+                missing.append(index)
+                continue
+            blocks.append(data)
+            self._touch(path, len(data))
+        with self._lock:
+            self.stats['hits'] += last - first + 1 - len(missing)
+            self.stats['misses'] += len(missing)
+            self.stats['bytes_cached'] += sum(len(b) for b in blocks if b is not None)
+
+        # Fetch each run of consecutive missing blocks in one request.
+        run_start = 0
+        while run_start < len(missing):
+            run_end = run_start
+            while run_end + 1 < len(missing) and missing[run_end + 1] == missing[run_end] + 1:
+                run_end += 1
+            start = missing[run_start] * self.block_size
+            end = min((missing[run_end] + 1) * self.block_size, cached_file.size)
+            data = cached_file.fetch(start, end - start)
+            with self._lock:
+                self.stats['bytes_fetched'] += len(data)
+            for index in missing[run_start:run_end + 1]:
+                offset = index * self.block_size - start
+                block = data[offset:offset + self.block_size]
+                blocks[index - first] = block
+                self._store(self._block_path(cached_file.key, index), block)
+            run_start = run_end + 1
+        return b''.join(blocks)
+
+    def _touch(self, path, size):
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._blocks[path] = (size, now)
+
+    def _store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name, so another process never reads half a block.
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            previous = self._blocks.get(path)
+            self.total_bytes += len(data) - (previous[0] if previous else 0)
+            self._blocks[path] = (len(data), time.time())
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        target = self.max_bytes * EVICT_TO
+        for path, (size, _) in sorted(self._blocks.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self._blocks[path]
+            self.total_bytes -= size
+            self.stats['evicted'] += 1
+
+    def clear(self):
+        for path in list(self._blocks):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._blocks.clear()
+        self.total_bytes = 0
+
+    def summary(self):
+        s = self.stats
+        return (f"Cache: {s['hits']} hits, {s['misses']} misses, {s['bytes_cached'] / 1e6:.1f} MB from disk, "
+                f"{s['bytes_fetched'] / 1e6:.1f} MB fetched, {s['evicted']} evicted, "
+                f"{self.total_bytes / 1e6:.1f} of {self.max_bytes / 1e6:.1f} MB used")
+
+
+class CachedFile(io.RawIOBase):
+    """A remote file read through a TileCache. Only the blocks that are read get fetched."""
+
+    def __init__(self, cache, filesystem, path, key, size):
+        self.cache = cache
+        self.filesystem = filesystem
+        self.path = path
+        self.key = key
+        self.size = size
+        self.position = 0
+        self._remote = None
+
+    def fetch(self, offset, length):
+        if self._remote is None:
+            self._remote = self.filesystem.open_input_file(self.path)
+        return self._remote.read_at(length, offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+        block_size = self.cache.block_size
+        first, last = self.position // block_size, (end - 1) // block_size
+        data = self.cache.read_blocks(self, first, last)
+        offset = self.position - first * block_size
+        result = data[offset:offset + end - self.position]
+        self.position = end
+        return result
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self._remote is not None:
+            self._remote.close()
+            self._remote = None
+        super().close()
+
+
+def hive_values(path):
+    """The key=value folders in a path, as hive partitioning reads them."""
+    return dict(part.split('=', 1) for part in path.split('/')[:-1] if '=' in part)
+
+
+def _conform(batch, schema):
+    """The batch with the columns of schema, in its order, with nulls for any it lacks."""
+    columns = []
+    for field in schema:
+        index = batch.schema.get_field_index(field.name)
+        if index < 0:
+            columns.append(pa.nulls(batch.num_rows, type=field.type))
+        else:
+            columns.append(batch.column(index).cast(field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def cached_parquet_reader(cache, files, hive_partitioning=False, bounds=None, quadkeys=None, entries=None, areas=None, columns=None):
+    """A RecordBatchReader over the rows of all the files, read through the cache. With
+    hive_partitioning the key=value folders in each path become string columns, as
+    read_parquet does, unless the file has them already.
+
+    With bounds only the row groups that can hold rows in bounds and the quadkey tiles are
+    read. They're picked with the files' manifest entries, if entries (by path) has them,
+    and from the statistics in the footers otherwise. Returns the reader and a
+    row_group_summary of the row groups and bytes skipped.
+
+    areas, a list of (bounds, quadkeys) pairs, reads the row groups that can hold rows in
+    any of them instead, for querying many areas in one pass. With columns only those are
+    read (the ones a file lacks are left out), so the rest are never fetched either."""
+    if areas is None and bounds is not None:
+        areas = [(bounds, quadkeys)]
+    parquet_files = [(f, pq.ParquetFile(cache.open(f))) for f in files]
+    selections = []
+    summary = {}
+    for f, pf in parquet_files:
+        row_groups = (entries or {}).get(f, {}).get('row_groups')
+        # A manifest that doesn't match the file is out of date, so go by the footer.
+        if row_groups is None or len(row_groups) != pf.metadata.num_row_groups:
+            row_groups = footer_row_groups(pf.metadata)
+        selected = select_row_groups_for_areas(row_groups, areas) if areas is not None else list(range(len(row_groups)))
+        selections.append(selected)
+        summary = add_summaries(summary, row_group_summary(row_groups, selected))
+    def file_columns(pf):
+        return None if columns is None else [c for c in columns if c in pf.schema_arrow.names]
+
+    schemas = [pf.schema_arrow if columns is None else pa.schema([pf.schema_arrow.field(c) for c in file_columns(pf)]) for _, pf in parquet_files]
+    if hive_partitioning:
+        for f, pf in parquet_files:
+            extra = [pa.field(k, pa.string()) for k in hive_values(f) if k not in pf.schema_arrow.names and (columns is None or k in columns)]
+            schemas.append(pa.schema(extra))
+    # Drop the GeoParquet metadata, which only describes one of the files.
+    schema = pa.unify_schemas(schemas).remove_metadata()
+
+    def batches():
+        for (f, pf), selected in zip(parquet_files, selections):
+            hive = hive_values(f) if hive_partitioning else {}
+            for batch in pf.iter_batches(row_groups=selected, columns=file_columns(pf)) if selected else []:
+                for name, value in hive.items():
+                    if name in schema.names and name not in pf.schema_arrow.names:
+                        batch = batch.append_column(name, pa.array([value] * batch.num_rows, type=pa.string()))
+                yield _conform(batch, schema)
+            pf.close()
+
+    return pa.RecordBatchReader.from_batches(schema, batches()), summary
@@ -1,12 +1,19 @@
 import sys
 import os
+import functools
 import click
 import pandas as pd
 import matplotlib.pyplot as plt
+from open_buildings import profiling
+from open_buildings.benchmark import baseline_differences, compare_results, load_baseline, save_baseline
 from open_buildings.google.process import process_benchmark, process_geometries
-from open_buildings.download_buildings import download as download_buildings
+from open_buildings.cache import DEFAULT_CACHE_SIZE, TileCache
+from open_buildings.download_buildings import download as download_buildings, download_batch
+from open_buildings.quadkey import DEFAULT_MAX_TILES
 from open_buildings.overture.add_columns import process_parquet_files
 from open_buildings.overture.partition import process_db
+from open_buildings.countries import build_country_coverage
+from open_buildings.synthetic import DEFAULT_BOUNDS, DISTRIBUTIONS, write_google_csv, write_overture_parquet
 from datetime import datetime, timedelta
 from tabulate import tabulate
 import boto3  # Required for S3 operations
@@ -29,9 +36,32 @@ def overture():
 main.add_command(google)
 main.add_command(overture)
 
+def profile_option(command):
+    """Adds --profile and --profile-sql to a command, recording its profiling spans while it runs."""
+    @click.option('--profile', 'profile_path', type=click.Path(dir_okay=False), default=None, help="Write a Chrome trace of the time spent in each step to this file (open it in chrome://tracing or ui.perfetto.dev), and print a summary.")
+    @click.option('--profile-sql', is_flag=True, help="With --profile, also record DuckDB's own profile of each SQL statement.")
+    @functools.wraps(command)
+    def wrapper(*args, profile_path, profile_sql, **kwargs):
+        if profile_path is None:
+            return command(*args, **kwargs)
+        with profiling.profile(profile_path, profile_sql):
+            return command(*args, **kwargs)
+    return wrapper
+
 def handle_comma_separated(ctx, param, value):
     return value.split(',')
 
+def handle_bbox(ctx, param, value):
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in value.split(','))
+    except ValueError:
+        raise click.BadParameter('expected minx,miny,maxx,maxy')
+    if minx >= maxx or miny >= maxy:
+        raise click.BadParameter('the minimums have to be less than the maximums')
+    return (minx, miny, maxx, maxy)
+
+DEFAULT_BBOX = ','.join(str(v) for v in DEFAULT_BOUNDS)
+
 @main.command(name="get_buildings")
 @click.argument('geojson_input', type=click.File('r'), required=False)
 @click.argument('dst', type=str, default="buildings.json")
@@ -40,7 +70,14 @@ def handle_comma_separated(ctx, param, value):
 @click.option('-s', '--silent', is_flag=True, default=False, help='Suppress all print outputs.')
 @click.option('--overwrite', default=False, is_flag=True, help='Overwrite the destination file if it already exists.')
 @click.option('--verbose', default=False, is_flag=True, help='Print detailed logs with timestamps.')
-def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, verbose):
+@click.option('--coverage', 'coverage_path', type=click.Path(exists=True), default=None, help='A country coverage table (from `ob overture coverage`), used to work out which countries to query when no country_iso is given.')
+@click.option('--cache-dir', default=None, type=click.Path(file_okay=False), help='Cache the parts of the remote files that queries read in this folder (like ~/.open_buildings/cache), so repeated queries in an area come from local disk. The first query in an area is slower than without the cache, as the cache fetches in one thread where DuckDB reads in parallel.')
+@click.option('--cache-size', default=DEFAULT_CACHE_SIZE / 2**30, type=click.FloatRange(min=0), show_default=True, help='With --cache-dir, the maximum size of the cache in GB. The least recently used data is removed past it.')
+@click.option('--max-tiles', default=DEFAULT_MAX_TILES, type=click.IntRange(min=1), show_default=True, help='Most quadkey tiles to cover the GeoJSON with. More tiles fit it closer, so fewer buildings are read and tested.')
+@click.option('--batch', is_flag=True, default=False, help='Download the buildings for every feature of a FeatureCollection or newline-delimited GeoJSON in one run. Put {id} in DST to write a file per feature, otherwise they all go in DST with an aoi_id column.')
+@click.option('--id-property', type=str, default=None, help="With --batch, the feature property to use as each AOI's id, instead of the feature id.")
+@profile_option
+def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, verbose, coverage_path, cache_dir, cache_size, max_tiles, batch, id_property):
     """Tool to extract buildings in common geospatial formats from large archives of GeoParquet data online. GeoJSON
     input can be provided as a file or piped in from stdin. If no GeoJSON input is provided, the tool will read from stdin.
 
@@ -56,7 +93,12 @@ def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, ve
 
     You can look up the country_iso for a country here: https://github.com/lukes/ISO-3166-Countries-with-Regional-Codes/blob/master/all/all.csv
     If you get the country wrong you will get zero results. Currently you can only query one country, so if your query crosses country boundaries you should
-    not use country_iso. In future versions of this tool we hope to eliminate the need to hint with the country_iso.
+    not use country_iso. Without country_iso the tool still only reads the partition files whose quadkey could overlap the
+    GeoJSON, and given a --coverage table it works out the countries to query by itself.
+
+    With --batch the input can hold many AOIs, as a FeatureCollection or as one GeoJSON feature per line. They're all
+    queried in one run, reading each partition file once for all the AOIs in it, which is much faster than a run per AOI.
+    A DST like out/{id}.fgb writes a file for each AOI, and reruns skip the ones already written.
     """
     # map source of google and overture to values for data_path and hive
     data_path = None
@@ -73,7 +115,20 @@ def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, ve
     
     format = None # will be set by the extension of the dst file
     generate_sql = False
-    download_buildings(geojson_input, format, generate_sql, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso)
+    cache = None if cache_dir is None else TileCache(cache_dir, int(cache_size * 2**30))
+    if batch:
+        try:
+            download_batch(geojson_input, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso, coverage_path, cache, max_tiles, id_property)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        return
+    download_buildings(geojson_input, format, generate_sql, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso, coverage_path, cache, max_tiles)
+
+def format_duration(seconds):
+    """Formats seconds as MM:SS.mmm, or '-' when there's no measurement."""
+    if pd.isna(seconds):
+        return '-'
+    return (datetime.min + timedelta(seconds=seconds)).strftime('%M:%S.%f')[:-3]
 
 @google.command('benchmark')
 @click.argument('input_path', type=click.Path(exists=True))
@@ -96,6 +151,9 @@ def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, ve
     help="Whether to keep multipolygons as they are without splitting into their component polygons.",
 )
 @click.option('--no-gpq', is_flag=True, help="Disable GPQ conversion. Timing will be faster, but not valid GeoParquet (until DuckDB adds support)")
+@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'native', 'none'], case_sensitive=False), help="How DuckDB parquet output gets its GeoParquet metadata: gpq rewrites the file, native writes it directly in a single pass")
+@click.option('--warmup', default=1, type=click.IntRange(min=0), help="Runs of each process and format to throw away before measuring. Default is 1.")
+@click.option('--repetitions', default=5, type=click.IntRange(min=1), help="Measured runs of each process and format. Default is 5.")
 @click.option(
     '--verbose', is_flag=True, help="Whether to print detailed processing information."
 )
@@ -105,6 +163,11 @@ def get_buildings(geojson_input, dst, source, country_iso, silent, overwrite, ve
     default='ascii',
     help="The format of the output. Options: ascii, csv, json, chart.",
 )
+@click.option('--save-baseline', 'baseline_name', default=None, help="Save the results as a baseline with this name, replacing any earlier baseline with the name.")
+@click.option('--compare-to', default=None, help="Compare the results to the baseline with this name, exiting with an error if any combination regressed.")
+@click.option('--threshold', default=0.1, type=click.FloatRange(min=0), help="How much slower (as a fraction of the baseline median) a combination has to be to count as a regression. Default is 0.1.")
+@click.option('--baseline-dir', default=None, type=click.Path(file_okay=False), help="Directory the baselines are kept in. Default is ~/.open_buildings/benchmarks.")
+@profile_option
 def benchmark(
     input_path,
     output_directory,
@@ -112,43 +175,118 @@ def benchmark(
     formats,
     skip_split_multis,
     no_gpq,
+    geo_conversion,
+    warmup,
+    repetitions,
     verbose,
     output_format,
+    baseline_name,
+    compare_to,
+    threshold,
+    baseline_dir,
 ):
-    """Runs the convert function on each of the supplied processes and formats, printing the timing of each as a table"""
+    """Runs the convert function on each of the supplied processes and formats, printing the timing of each as a table.
+
+    Each combination is run --warmup times, then --repetitions times, each run in a fresh process. The table
+    shows the median time, followed by the p95, standard deviation, read / transform / write phases, peak memory
+    and output size of each. The csv and json outputs have all of the measurements.
+
+    With --save-baseline the results are stored, along with the machine and library versions, and a later run with
+    --compare-to reports the speedup or regression of each combination against them. Any regression beyond
+    --threshold makes the command exit with status 1, so it can gate a release."""
+    # Load the baseline first, so a typo in its name fails before the benchmark runs.
+    try:
+        baseline = load_baseline(compare_to, baseline_dir) if compare_to else None
+    except (FileNotFoundError, ValueError) as e:
+        raise click.BadParameter(str(e), param_hint='--compare-to')
+
     results = process_benchmark(
-        input_path, output_directory, processes, formats, not skip_split_multis, verbose
+        input_path,
+        output_directory,
+        processes,
+        formats,
+        not skip_split_multis,
+        verbose,
+        'none' if no_gpq else geo_conversion,
+        warmup,
+        repetitions,
     )
 
-    df = pd.DataFrame(results)
-    df = df.pivot(index='process', columns='format', values='execution_time')
+    results_df = pd.DataFrame(results)
+    df = results_df.pivot(index='process', columns='format', values='execution_time')
 
     base_name = os.path.basename(input_path)
     file_name, file_ext = os.path.splitext(base_name)
 
     for format in output_format:
         if format == 'csv':
-            df.to_csv(f"{output_directory}/{file_name}_benchmark.csv", index=False)
+            results_df.to_csv(f"{output_directory}/{file_name}_benchmark.csv", index=False)
         elif format == 'json':
-            df.to_json(f"{output_directory}/{file_name}_benchmark.json", orient='split', indent=4)
+            results_df.to_json(f"{output_directory}/{file_name}_benchmark.json", orient='records', indent=4)
         elif format == 'chart':
             df.plot(kind='bar', rot=0)
             plt.title(f'Benchmark for file: {base_name}')
             plt.xlabel('Process')
-            plt.ylabel('Execution Time (in seconds)')
+            plt.ylabel('Median Execution Time (in seconds)')
             plt.tight_layout()
             plt.savefig(f"{output_directory}/{file_name}_benchmark.png")
             plt.clf()
         elif format == 'ascii':
             df_formatted = df.copy()
             for column in df_formatted.columns:
-                df_formatted[column] = df_formatted[column].apply(lambda x: (datetime.min + timedelta(seconds=x)).strftime('%M:%S.%f')[:-3])
+                df_formatted[column] = df_formatted[column].apply(format_duration)
 
-            print(f"\nTable for file: {base_name}")
+            print(f"\nMedian of {repetitions} runs for file: {base_name}")
             print(tabulate(df_formatted, headers="keys", tablefmt="fancy_grid"))
+
+            details = pd.DataFrame({
+                'process': results_df['process'],
+                'format': results_df['format'],
+                'median': results_df['median'].apply(format_duration),
+                'p95': results_df['p95'].apply(format_duration),
+                'stddev': results_df['stddev'].apply(format_duration),
+                'read': results_df['read_seconds'].apply(format_duration),
+                'transform': results_df['transform_seconds'].apply(format_duration),
+                'write': results_df['write_seconds'].apply(format_duration),
+                'peak MB': (results_df['peak_rss'] / 1e6).round(1),
+                'output MB': (results_df['output_bytes'] / 1e6).round(1),
+            })
+            print(tabulate(details, headers="keys", tablefmt="fancy_grid", showindex=False, missingval='-'))
         else:
             raise ValueError('Invalid output format')
 
+    settings = {
+        'input': os.path.abspath(input_path),
+        'processes': processes,
+        'formats': formats,
+        'split_multipolygons': not skip_split_multis,
+        'geo_conversion': 'none' if no_gpq else geo_conversion,
+        'warmup': warmup,
+        'repetitions': repetitions,
+    }
+
+    regressions = 0
+    if baseline is not None:
+        comparison = compare_results(results, baseline, threshold)
+        regressions = sum(1 for row in comparison if row['status'] == 'regression')
+
+        print(f"\nCompared to baseline {compare_to} from {baseline['created']} (threshold {threshold:.0%}):")
+        for difference in baseline_differences(baseline, settings):
+            print(f"  Warning: {difference}")
+        comparison_df = pd.DataFrame(comparison)
+        comparison_df['baseline'] = comparison_df['baseline'].apply(format_duration)
+        comparison_df['current'] = comparison_df['current'].apply(format_duration)
+        comparison_df['speedup'] = comparison_df['speedup'].apply(lambda x: '-' if pd.isna(x) else f"{x:.2f}x")
+        print(tabulate(comparison_df, headers="keys", tablefmt="fancy_grid", showindex=False))
+
+    if baseline_name:
+        path = save_baseline(baseline_name, results, settings, baseline_dir)
+        print(f"Saved baseline {baseline_name} to {path}")
+
+    if regressions:
+        print(f"{regressions} combination(s) regressed by more than {threshold:.0%} against baseline {compare_to}.")
+        sys.exit(1)
+
 @google.command('convert')
 @click.argument('input_path', type=click.Path(exists=True))
 @click.argument('output_directory', type=click.Path(exists=True))
@@ -172,11 +310,16 @@ def benchmark(
     is_flag=True,
     help="Whether to keep multipolygons as they are without splitting into their component polygons.",
 )
+@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'native', 'none'], case_sensitive=False), help="How DuckDB parquet output gets its GeoParquet metadata: gpq rewrites the file, native writes it directly in a single pass")
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help="Number of CSV files to convert at once, largest first. Default is 1.")
+@click.option('--memory-budget', default=None, type=float, help="With --jobs, only start another file if the estimated memory of the running conversions stays under this many GB.")
+@click.option('--chunk-size', default=None, type=int, help="With the pandas process, read and write each CSV this many rows at a time to keep memory flat. Default is the whole file at once.")
 @click.option(
     '--verbose', is_flag=True, help="Whether to print detailed processing information."
 )
+@profile_option
 def convert(
-    input_path, output_directory, format, overwrite, process, skip_split_multis, verbose
+    input_path, output_directory, format, overwrite, process, skip_split_multis, geo_conversion, jobs, memory_budget, chunk_size, verbose
 ):
     """Converts a CSV or a directory of CSV's to an alternate format. Input CSV's are assumed to be from Google's Open Buildings"""
     process_geometries(
@@ -187,8 +330,26 @@ def convert(
         process,
         not skip_split_multis,
         verbose,
+        geo_conversion,
+        jobs,
+        memory_budget * 1e9 if memory_budget else None,
+        chunk_size,
     )
 
+@google.command('generate')
+@click.argument('output_path', type=click.Path())
+@click.option('--rows', default=100000, type=click.IntRange(min=1), help="Number of buildings to generate. Default is 100000.")
+@click.option('--multipolygon-ratio', default=0.05, type=click.FloatRange(0, 1), help="Share of the buildings that are multipolygons. Default is 0.05.")
+@click.option('--distribution', default='clustered', type=click.Choice(DISTRIBUTIONS), help="clustered gathers buildings around towns of very different sizes, uniform spreads them evenly. Default is clustered.")
+@click.option('--bbox', default=DEFAULT_BBOX, callback=handle_bbox, help=f"Bounds to put the buildings in, as minx,miny,maxx,maxy. Default is {DEFAULT_BBOX}.")
+@click.option('--seed', default=0, type=int, help="Random seed. The same seed and options always give the same file.")
+@profile_option
+def google_generate(output_path, rows, multipolygon_ratio, distribution, bbox, seed):
+    """Writes a synthetic CSV in the Google Open Buildings schema, to benchmark convert without real data"""
+    start_time = datetime.now()
+    write_google_csv(output_path, rows, multipolygon_ratio, distribution, bbox, seed)
+    print(f"Wrote {rows} buildings to {output_path} in {datetime.now() - start_time}")
+
 @overture.command('add_columns')
 @click.argument('input_folder', type=click.Path(exists=True))
 @click.argument('output_folder', type=click.Path())
@@ -197,16 +358,41 @@ def convert(
 @click.option('--no-quadkey', is_flag=True, help="Whether to add a quadkey column to the output.")
 @click.option('--no-country-iso', is_flag=True, help="Whether to add a country_iso column to the output.")
 @click.option('--verbose', is_flag=True, help="Whether to print detailed processing information.")
+@click.option('--coverage', 'coverage_path', type=click.Path(exists=True), default=None, help="A country coverage table (from `ob overture coverage`) to assign buildings in interior tiles without a geometry test.")
+@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'native', 'none'], case_sensitive=False), help="How the output gets its GeoParquet metadata: gpq rewrites the file, native writes it directly in a single pass")
+@click.option('--keep-duckdb', is_flag=True, help="Load each file into a DuckDB database in the output folder and keep it, instead of streaming the file straight to the output.")
+@click.option('--memory-limit', default=None, help="DuckDB memory limit, like 4GB. Past it the sort by quadkey spills to the temp directory.")
+@click.option('--temp-directory', default=None, type=click.Path(file_okay=False), help="Where DuckDB spills data that doesn't fit in memory. Defaults to DuckDB's own choice.")
+@click.option('--threads', default=None, type=click.IntRange(min=1), help="Number of DuckDB threads for each file. Default is the cores split between the jobs.")
+@click.option('--jobs', default=None, type=click.IntRange(min=1), help="Number of files to process at once. Default is one per core, as many as fit in memory.")
+@click.option('--retries', default=2, type=click.IntRange(min=0), help="How many times to retry a file that fails. Default is 2.")
+@click.option('--verify', is_flag=True, help="Check the checksum of each output already in the ledger before skipping it, instead of just its size.")
+@profile_option
 def add_columns(
-    input_folder, output_folder, country_parquet_path, overwrite, no_quadkey, no_country_iso, verbose
+    input_folder, output_folder, country_parquet_path, overwrite, no_quadkey, no_country_iso, verbose, coverage_path, geo_conversion, keep_duckdb, memory_limit, temp_directory, threads,
+    jobs, retries, verify
 ):
     """Adds columns to the input Overture parquet files, using Overture country for admin boundaries, outputting GeoParquet ordered by quadkey the output folder"""
     add_quadkey = not no_quadkey
     add_country_iso = not no_country_iso
     """Adds columns to the input parquet files, outputting to the output folder"""
-    process_parquet_files(
-        input_folder, output_folder, country_parquet_path, overwrite, add_quadkey, add_country_iso, verbose
+    failed = process_parquet_files(
+        input_folder, output_folder, country_parquet_path, overwrite, add_quadkey, add_country_iso, verbose, coverage_path, geo_conversion,
+        keep_duckdb, memory_limit, temp_directory, threads, jobs, retries, verify
     )
+    if failed:
+        sys.exit(1)
+
+@overture.command('coverage')
+@click.argument('country_parquet_path', type=click.Path(exists=True))
+@click.argument('coverage_path', type=click.Path())
+@click.option('--zoom', default=12, type=int, help="The deepest quadkey zoom level to split border tiles to. Default is 12, matching the quadkey column.")
+@click.option('--verbose', is_flag=True, help="Whether to print detailed processing information.")
+@profile_option
+def coverage(country_parquet_path, coverage_path, zoom, verbose):
+    """Builds a table of quadkeys that are inside a country, outside all countries or on a border, from a countries parquet file"""
+    country_coverage = build_country_coverage(country_parquet_path, coverage_path, zoom, verbose)
+    print(f"Wrote {len(country_coverage.leaves)} tiles to {coverage_path}")
 
 @overture.command('download')
 @click.argument('destination_folder', type=click.Path())
@@ -216,6 +402,7 @@ def add_columns(
     default='buildings',
     help="Theme option for the files to download from S3. Default is buildings.",
 )
+@profile_option
 def overture_download(destination_folder, theme):
     """Download building files from S3 (can change theme for other overture data)."""
 
@@ -238,18 +425,35 @@ def overture_download(destination_folder, theme):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] Downloaded {file_name}")
 
+@overture.command('generate')
+@click.argument('output_path', type=click.Path())
+@click.option('--rows', default=100000, type=click.IntRange(min=1), help="Number of buildings to generate. Default is 100000.")
+@click.option('--multipolygon-ratio', default=0.0, type=click.FloatRange(0, 1), help="Share of the buildings that are multipolygons. Default is 0.")
+@click.option('--distribution', default='clustered', type=click.Choice(DISTRIBUTIONS), help="clustered gathers buildings around towns of very different sizes, uniform spreads them evenly. Default is clustered.")
+@click.option('--bbox', default=DEFAULT_BBOX, callback=handle_bbox, help=f"Bounds to put the buildings in, as minx,miny,maxx,maxy. Default is {DEFAULT_BBOX}.")
+@click.option('--seed', default=0, type=int, help="Random seed. The same seed and options always give the same file.")
+@click.option('--row-group-size', default=None, type=int, help="Row group size of the output. Default is one row group per 100000 rows generated.")
+@profile_option
+def overture_generate(output_path, rows, multipolygon_ratio, distribution, bbox, seed, row_group_size):
+    """Writes a synthetic GeoParquet file in the Overture buildings schema, with a bbox struct, to benchmark add_columns without real data"""
+    start_time = datetime.now()
+    write_overture_parquet(output_path, rows, multipolygon_ratio, distribution, bbox, seed, row_group_size)
+    print(f"Wrote {rows} buildings to {output_path} in {datetime.now() - start_time}")
+
 @overture.command('partition')
 @click.argument('duckdb-path', type=click.Path(exists=True))
 @click.option('--output-folder', default=os.getcwd(), type=click.Path(), help='Folder to store the output files')
-@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'none', 'pandas', 'ogr'], case_sensitive=False))
+@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'native', 'none', 'pandas', 'ogr'], case_sensitive=False), help='How to write GeoParquet: native writes it directly in a single pass, the others convert the Parquet written by DuckDB')
 @click.option('--verbose', is_flag=True, default=False, help='Print verbose output')
 @click.option('--max-per-file', default=10000000, type=int, help='Maximum number of rows per file')
 @click.option('--row-group-size', default=10000, type=int, help='Row group size for Parquet files')
 @click.option('--hive', is_flag=True, default=False, help='Output files in Hive format (folder structure)')
 @click.option('--table-name', default='buildings', type=str, help='Name of the table to process')
-def partition(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name):
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='Number of processes writing and converting files in parallel')
+@profile_option
+def partition(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name, workers):
     """Partition a DuckDB database of all overture data by country_iso"""
-    process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name)
+    process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name, workers)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,20 @@
 """The common module contains common functions and classes used by the other modules.
 """
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
 def hello_world():
     """Prints "Hello World!" to the console.
     """
-    print("Hello World!")
\ No newline at end of file
+    print("Hello World!")
+
+
+def arrow_to_numpy(arr):
+    """An Arrow array (or chunked array) of numbers as a float64 NumPy array, with nulls as NaN,
+    for the vectorized functions DuckDB calls with Arrow vectors."""
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    return pc.fill_null(arr.cast(pa.float64()), np.nan).to_numpy(zero_copy_only=False)
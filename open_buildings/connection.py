@@ -0,0 +1,98 @@
+"""
+DuckDB connections with the extensions and settings the commands need, set up once.
+
+`connect` opens a connection (to a database file, or in memory) with its settings and
+extensions loaded. Whether an extension is installed is only checked, and INSTALL only run,
+the first time it's needed in a process, instead of for every file.
+
+`shared_connection` goes further for in-memory work, like downloads: it keeps a warmed
+connection for each set of settings and hands out a cursor on it, so every later call in
+the process, from the CLI or from Python, starts with spatial (and httpfs) already loaded.
+Cursors share the database, so anything a caller creates in it should be dropped (or
+created with CREATE OR REPLACE) when it's done.
+"""
+
+import threading
+
+import duckdb
+
+# The region of the source.coop bucket the buildings are in. Setting it saves DuckDB a
+# redirect on the first request.
+DEFAULT_S3_REGION = 'us-west-2'
+
+# Extensions known to be installed, so each one is only checked once per process.
+_installed_extensions = set()
+
+# Warmed in-memory connections, by their settings.
+_shared_connections = {}
+_lock = threading.Lock()
+
+
+def duckdb_config(memory_limit=None, temp_directory=None, threads=None):
+    """DuckDB settings for a connection. Past memory_limit, sorts and joins spill to temp_directory."""
+    config = {}
+    if memory_limit is not None:
+        config['memory_limit'] = memory_limit
+    if temp_directory is not None:
+        config['temp_directory'] = temp_directory
+    if threads is not None:
+        config['threads'] = threads
+    return config
+
+
+def is_remote(path):
+    return path.startswith(('s3://', 'http://', 'https://', 'gs://', 'gcs://', 'r2://', 'az://'))
+
+
+def load_extension(conn, name):
+    """Loads an extension, installing it first if this process hasn't yet seen it installed."""
+    if name not in _installed_extensions:
+        installed = conn.execute(
+            "SELECT installed FROM duckdb_extensions() WHERE extension_name = ?", [name]
+        ).fetchone()
+        if installed is None or not installed[0]:
+            print(f"Installing DuckDB {name} extension...")
+            conn.execute(f"INSTALL {name};")
+        _installed_extensions.add(name)
+    conn.execute(f"LOAD {name};")
+
+
+def extension_available(name):
+    """Whether the extension can be loaded here, installing it if it has to be. For skipping
+    the work (or the tests) that needs it where it can't be, like without a network."""
+    with duckdb.connect() as conn:
+        try:
+            load_extension(conn, name)
+        except duckdb.Error:
+            return False
+    return True
+
+
+def connect(database=':memory:', read_only=False, extensions=('spatial',), memory_limit=None, temp_directory=None, threads=None, s3_region=None):
+    """A new connection to database with the extensions loaded and the settings applied."""
+    conn = duckdb.connect(database, read_only=read_only, config=duckdb_config(memory_limit, temp_directory, threads))
+    for name in extensions:
+        load_extension(conn, name)
+    if s3_region is not None:
+        conn.execute(f"SET GLOBAL s3_region = '{s3_region}';")
+    return conn
+
+
+def shared_connection(extensions=('spatial',), memory_limit=None, temp_directory=None, threads=None, s3_region=None):
+    """A cursor on the warmed in-memory connection for these settings, which is made the first
+    time they're asked for and kept for the rest of the process."""
+    key = (tuple(extensions), memory_limit, temp_directory, threads, s3_region)
+    with _lock:
+        conn = _shared_connections.get(key)
+        if conn is None:
+            conn = connect(':memory:', False, extensions, memory_limit, temp_directory, threads, s3_region)
+            _shared_connections[key] = conn
+    return conn.cursor()
+
+
+def close_shared_connections():
+    """Closes the shared connections, for a process that's done with them or before a fork."""
+    with _lock:
+        for conn in _shared_connections.values():
+            conn.close()
+        _shared_connections.clear()
@@ -0,0 +1,249 @@
+"""
+Country assignment backed by a spatial index. The add_columns scripts used to run
+UPDATE ... FROM countries WHERE ST_Intersects(...), which DuckDB executes as a nested loop
+of every building against every country, parsing both WKB geometries for each pair. Here
+the country polygons are split into their parts, prepared once, and put into a shapely
+STRtree. Each batch of buildings is matched against the tree by bounding box, and the
+exact intersects test only runs on the few candidate pairs that survive.
+
+A CountryCoverage table goes one step further: the world is cut into a quadtree of tiles
+down to a maximum zoom, and each leaf tile is recorded as fully inside one country, outside
+all countries, or on a border with a list of candidate countries. Buildings that fall
+inside an interior tile get their country from a dictionary lookup, and only the ones on
+border tiles need a geometry test at all.
+"""
+
+import os
+
+import mercantile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from duckdb.typing import BLOB, VARCHAR
+
+from open_buildings.profiling import span
+from open_buildings.quadkey import lon_lat_to_quadkeys
+
+COUNTRY_ISO_COLUMN = 'isocountrycodealpha2'
+
+INSIDE = 'inside'
+OUTSIDE = 'outside'
+BORDER = 'border'
+
+# Latitude limit of web mercator tiles.
+MAX_LATITUDE = 85.0511287798066
+
+
+class CountryIndex:
+    """An STRtree of country polygons that answers 'which country does this geometry intersect'."""
+
+    def __init__(self, iso_codes, geometries, coverage=None):
+        iso_codes = np.asarray(iso_codes, dtype=object)
+        # Multipolygons like France or the US have bounding boxes that span half the world, so
+        # index each part separately to keep the bbox prefilter tight.
+        parts, part_country = shapely.get_parts(np.asarray(geometries), return_index=True)
+        shapely.prepare(parts)
+        self.iso_codes = iso_codes
+        self.parts = parts
+        self.part_country = part_country
+        self.tree = shapely.STRtree(parts)
+        self.coverage = coverage
+
+    @classmethod
+    def from_parquet(cls, country_parquet_path, iso_column=COUNTRY_ISO_COLUMN, geometry_column='geometry', coverage_path=None):
+        table = pq.read_table(country_parquet_path, columns=[iso_column, geometry_column])
+        iso_codes = table.column(iso_column).to_pylist()
+        geometries = shapely.from_wkb(table.column(geometry_column).to_numpy(zero_copy_only=False))
+        coverage = CountryCoverage.from_parquet(coverage_path) if coverage_path else None
+        return cls(iso_codes, geometries, coverage)
+
+    def lookup(self, geometries):
+        """Returns an object array with the ISO code of the first country each geometry intersects, or None."""
+        geometries = np.asarray(geometries)
+        result = np.full(len(geometries), None, dtype=object)
+        if len(geometries) == 0:
+            return result
+
+        if self.coverage is not None:
+            # Geometries that sit entirely within one interior or ocean tile are settled by
+            # the coverage table, only the rest go through the tree.
+            resolved, countries = self.coverage.lookup_bounds(shapely.bounds(geometries))
+            result[resolved] = countries[resolved]
+            remaining = np.flatnonzero(~resolved)
+            if len(remaining) > 0:
+                result[remaining] = self._lookup_tree(geometries[remaining])
+            return result
+
+        return self._lookup_tree(geometries)
+
+    def _lookup_tree(self, geometries):
+        result = np.full(len(geometries), None, dtype=object)
+
+        # Bounding box candidates from the tree, then the exact test on just those pairs.
+        input_index, part_index = self.tree.query(geometries)
+        hits = shapely.intersects(self.parts[part_index], geometries[input_index])
+        input_index = input_index[hits]
+        country_index = self.part_country[part_index[hits]]
+
+        # A building on a border intersects more than one country; take the first country
+        # in the countries file so the result is deterministic.
+        order = np.lexsort((country_index, input_index))
+        input_index = input_index[order]
+        country_index = country_index[order]
+        first_input, first = np.unique(input_index, return_index=True)
+        result[first_input] = self.iso_codes[country_index[first]]
+        return result
+
+    def lookup_wkb(self, wkb):
+        """Same as lookup, but takes and returns Arrow arrays, with the geometries as WKB."""
+        if isinstance(wkb, pa.ChunkedArray):
+            wkb = wkb.combine_chunks()
+        geometries = shapely.from_wkb(wkb.to_numpy(zero_copy_only=False))
+        return pa.array(self.lookup(geometries), type=pa.string())
+
+
+class CountryCoverage:
+    """A quadtree of tiles, each one fully inside a country, outside all countries or on a border.
+
+    The leaves have different lengths, since a tile that is entirely inside (or outside) a
+    country isn't split any further, but together they cover the world exactly once down
+    to max_zoom.
+    """
+
+    def __init__(self, leaves, max_zoom):
+        # quadkey -> (status, list of candidate country codes)
+        self.leaves = leaves
+        self.max_zoom = max_zoom
+
+    @classmethod
+    def build(cls, country_index, max_zoom=12, verbose=False):
+        """Rasterizes the countries of a CountryIndex into a coverage quadtree down to max_zoom."""
+        leaves = {}
+        level = ['']
+        for zoom in range(0, max_zoom + 1):
+            if not level:
+                break
+            tiles = shapely.box(*np.array([_quadkey_bounds(qk) for qk in level]).T)
+            tile_index, part_index = country_index.tree.query(tiles)
+            hits = shapely.intersects(country_index.parts[part_index], tiles[tile_index])
+            contains = shapely.contains(country_index.parts[part_index], tiles[tile_index])
+            tile_index, part_index, contains = tile_index[hits], part_index[hits], contains[hits]
+            country_index_of_part = country_index.part_country[part_index]
+
+            candidates = [set() for _ in level]
+            inside = np.zeros(len(level), dtype=bool)
+            for t, c in zip(tile_index, country_index_of_part):
+                candidates[t].add(country_index.iso_codes[c])
+            inside[tile_index[contains]] = True
+
+            next_level = []
+            for i, qk in enumerate(level):
+                countries = sorted(candidates[i])
+                if not countries:
+                    leaves[qk] = (OUTSIDE, [])
+                elif len(countries) == 1 and inside[i]:
+                    leaves[qk] = (INSIDE, countries)
+                elif zoom == max_zoom:
+                    leaves[qk] = (BORDER, countries)
+                else:
+                    next_level.extend(qk + digit for digit in '0123')
+            if verbose:
+                print(f"Zoom {zoom}: {len(level)} tiles checked, {len(next_level)} to split further")
+            level = next_level
+        return cls(leaves, max_zoom)
+
+    @classmethod
+    def from_parquet(cls, coverage_path):
+        table = pq.read_table(coverage_path)
+        leaves = {
+            qk: (status, countries)
+            for qk, status, countries in zip(
+                table.column('quadkey').to_pylist(),
+                table.column('status').to_pylist(),
+                table.column('countries').to_pylist(),
+            )
+        }
+        max_zoom = int((table.schema.metadata or {}).get(b'max_zoom', max(len(qk) for qk in leaves)))
+        return cls(leaves, max_zoom)
+
+    def to_parquet(self, coverage_path):
+        quadkeys = sorted(self.leaves)
+        table = pa.table({
+            'quadkey': pa.array(quadkeys, type=pa.string()),
+            'status': pa.array([self.leaves[qk][0] for qk in quadkeys], type=pa.string()),
+            'countries': pa.array([self.leaves[qk][1] for qk in quadkeys], type=pa.list_(pa.string())),
+        })
+        table = table.replace_schema_metadata({'max_zoom': str(self.max_zoom)})
+        pq.write_table(table, coverage_path)
+
+    def leaf(self, quadkey):
+        """Returns the leaf quadkey containing a quadkey at max_zoom (or longer)."""
+        for length in range(0, min(len(quadkey), self.max_zoom) + 1):
+            if quadkey[:length] in self.leaves:
+                return quadkey[:length]
+        return None
+
+    def lookup_bounds(self, bounds):
+        """For an array of (minx, miny, maxx, maxy) returns a mask of the rows the coverage settles
+        on its own and an object array with their country (None when outside all countries)."""
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        # Tiles stop at the web mercator limits, anything past them goes to the tree.
+        valid = np.isfinite(bounds).all(axis=1) & (bounds[:, 1] > -MAX_LATITUDE) & (bounds[:, 3] < MAX_LATITUDE)
+        bounds = np.where(valid[:, None], bounds, 0.0)
+        low = self._leaves_for(lon_lat_to_quadkeys(bounds[:, 0], bounds[:, 1], self.max_zoom))
+        high = self._leaves_for(lon_lat_to_quadkeys(bounds[:, 2], bounds[:, 3], self.max_zoom))
+
+        # Both corners of the bbox in the same leaf means the whole geometry is in that leaf.
+        same_leaf = valid & (low == high)
+        status = np.array([self.leaves[leaf][0] if leaf is not None else None for leaf in low], dtype=object)
+        inside = same_leaf & (status == INSIDE)
+        resolved = inside | (same_leaf & (status == OUTSIDE))
+
+        countries = np.full(len(bounds), None, dtype=object)
+        countries[inside] = [self.leaves[leaf][1][0] for leaf in low[inside]]
+        return resolved, countries
+
+    def _leaves_for(self, quadkeys):
+        # Buildings are clustered, so a batch only has a handful of distinct tiles to look up.
+        encoded = quadkeys.dictionary_encode()
+        leaves = np.array([self.leaf(qk) for qk in encoded.dictionary.to_pylist()], dtype=object)
+        return leaves[encoded.indices.to_numpy(zero_copy_only=False)]
+
+    def countries_for_bounds(self, bounds):
+        """Returns the sorted list of countries whose tiles intersect a (minx, miny, maxx, maxy) box."""
+        minx, miny, maxx, maxy = bounds
+        found = set()
+        pending = ['']
+        while pending:
+            qk = pending.pop()
+            west, south, east, north = _quadkey_bounds(qk)
+            if west > maxx or east < minx or south > maxy or north < miny:
+                continue
+            if qk in self.leaves:
+                found.update(self.leaves[qk][1])
+            elif len(qk) < self.max_zoom:
+                pending.extend(qk + digit for digit in '0123')
+        return sorted(found)
+
+
+def _quadkey_bounds(quadkey):
+    return mercantile.bounds(mercantile.quadkey_to_tile(quadkey))
+
+
+def build_country_coverage(country_parquet_path, coverage_path, max_zoom=12, verbose=False):
+    """Builds a coverage table from a countries parquet file and writes it out as Parquet."""
+    with span('load_countries', file=country_parquet_path):
+        country_index = CountryIndex.from_parquet(country_parquet_path)
+    with span('build_coverage', max_zoom=max_zoom) as s:
+        coverage = CountryCoverage.build(country_index, max_zoom, verbose)
+        s.set(rows=len(coverage.leaves))
+    with span('write_coverage', file=coverage_path) as s:
+        coverage.to_parquet(coverage_path)
+        s.set(bytes=os.path.getsize(coverage_path))
+    return coverage
+
+
+def register_country_function(con, country_index, name='country_iso_for'):
+    """Registers country_iso_for(geometry_wkb) on a DuckDB connection, backed by the given CountryIndex."""
+    con.create_function(name, country_index.lookup_wkb, [BLOB], VARCHAR, type='arrow', null_handling='special')
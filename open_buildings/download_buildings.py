@@ -1,18 +1,35 @@
 import json
+import re
+from collections import Counter
 import click
 from math import tan, cos, log, pi
 from shapely.geometry import shape
 from typing import Tuple
 import mercantile 
-import duckdb
 import time
 import datetime
 import os
-import pandas as pd
-import geopandas as gpd
+import pyarrow as pa
 import subprocess
-from shapely import wkb
-import shutil
+from open_buildings.cache import cached_parquet_reader
+from open_buildings.connection import DEFAULT_S3_REGION, is_remote, shared_connection
+from open_buildings.countries import CountryCoverage
+from open_buildings.geoparquet import convert_parquet_to_geoparquet
+from open_buildings.quadkey import DEFAULT_MAX_TILES, quadkey_cover, quadkey_predicate, quadkey_ranges
+from open_buildings.partitions import (
+    add_summaries,
+    bbox_predicate,
+    country_predicate,
+    list_partition_files,
+    load_manifest,
+    manifest_entries,
+    prune_partition_files,
+    read_parquet_source,
+    row_group_summary,
+    select_manifest_files,
+    select_row_groups,
+)
+from open_buildings.profiling import execute, span
 
 
 def geojson_to_quadkey(data: dict) -> str:
@@ -106,7 +123,7 @@ def sql(geojson_input, only_quadkey, local):
     else:
         geojson_data = json.load(click.get_text_stream('stdin'))
 
-    quadkey = geojson_to_quadkey(geojson_data)
+    quadkeys = quadkey_cover(shape(geojson_data['geometry']))
     wkt = geojson_to_wkt(geojson_data)
 
     # Adjust the path in read_parquet based on the --local flag
@@ -114,7 +131,7 @@ def sql(geojson_input, only_quadkey, local):
     base_sql = f"select * from read_parquet('{path}')"
     
     # Construct the WHERE clause based on the options
-    where_clause = f"WHERE quadkey LIKE '{quadkey}%'"
+    where_clause = f"WHERE {quadkey_predicate(quadkeys)}"
     if not only_quadkey:
         where_clause += f" AND\nST_Within(ST_GeomFromWKB(geometry), ST_GeomFromText('{wkt}'))"
 
@@ -130,12 +147,84 @@ def quad2json(quadkey_input):
     click.echo(json.dumps(result, indent=2))
 
 
-def download(geojson_input, format, generate_sql, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso):
+OUTPUT_EXTENSIONS = {
+    'shapefile': '.shp',
+    'geojson': 'json',
+    'geopackage': '.gpkg',
+    'flatgeobuf': '.fgb',
+    'parquet': '.parquet'
+}
 
+GDAL_FORMATS = {
+    'shapefile': 'ESRI Shapefile',
+    'geojson': 'GeoJSON',
+    'geopackage': 'GPKG',
+    'flatgeobuf': 'FlatGeobuf'
+}
+
+
+OVERTURE_PATH = "s3://us-west-2.opendata.source.coop/cholmes/overture/geoparquet-country-quad-hive/*/*.parquet"
+
+# The Overture columns written to formats other than parquet, leaving out the structs that
+# GIS formats can't take.
+OVERTURE_COLUMNS = ["id", "level", "height", "numfloors", "class", "country_iso", "quadkey"]
+
+
+def output_columns(data_path, format):
+    """The columns to write besides the geometry, or None for all of them."""
+    if data_path == OVERTURE_PATH and format != "parquet":
+        return OVERTURE_COLUMNS
+    return None
+
+
+def read_columns(select_columns):
+    """The columns a query over select_columns reads, with the ones it filters on, or None for all."""
+    if select_columns is None:
+        return None
+    return select_columns + ['bbox', 'geometry']
+
+
+def timestamped_printer(silent):
     def print_timestamped_message(message):
         if not silent:
             current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             click.echo(f"[{current_time}] {message}")
+    return print_timestamped_message
+
+
+def output_format(dst, format=None):
+    """The format to write dst in, from its extension unless format is given, and dst with
+    the format's extension added if it doesn't have it."""
+    if not format:
+        for fmt, ext in OUTPUT_EXTENSIONS.items():
+            if dst.endswith(ext):
+                format = fmt
+                break
+        else:  # The for-else structure means the else block runs if the loop completes normally, without a break.
+            raise ValueError("Unknown file format. Please specify using --format option.")
+
+    if not dst.endswith(OUTPUT_EXTENSIONS[format]):
+        dst += OUTPUT_EXTENSIONS[format]
+    return dst, format
+
+
+def write_buildings(conn, relation, dst, format):
+    """Copies relation (a table, or a query in parentheses) to dst: as GeoParquet, or through GDAL."""
+    if format == 'parquet':
+        execute(conn, f"COPY {relation} TO '{dst}' WITH (FORMAT Parquet);", 'copy_to_parquet', file=dst)
+        try:
+            # Add the GeoParquet metadata a row group at a time, keeping the geometry as WKB
+            with span('geoparquet_convert', file=dst) as s:
+                s.set(rows=convert_parquet_to_geoparquet(dst), bytes=os.path.getsize(dst))
+        except Exception as e:
+            print(f"Error processing {dst} to geoparquet: {e}")
+    else:
+        execute(conn, f"COPY {relation} TO '{dst}' WITH (FORMAT GDAL, DRIVER '{GDAL_FORMATS[format]}');", f'copy_to_{format}', file=dst)
+
+
+def download(geojson_input, format, generate_sql, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso, coverage_path=None, cache=None, max_tiles=DEFAULT_MAX_TILES):
+
+    print_timestamped_message = timestamped_printer(silent)
 
     def print_elapsed_time(start_time):
         end_time = time.time()
@@ -165,64 +254,115 @@ def download(geojson_input, format, generate_sql, dst, silent, overwrite, verbos
 
     if verbose:
         print_timestamped_message("Converting GeoJSON to quadkey and WKT...")
-    quadkey = geojson_to_quadkey(geojson_data)
+    # The quadkey tiles that together cover the AOI, instead of the one tile that holds it all.
+    quadkeys = quadkey_cover(shape(geojson_data['geometry']), max_tiles)
     wkt = geojson_to_wkt(geojson_data)
+    aoi_bounds = shape(geojson_data['geometry']).bounds
+
+    # With a coverage table the countries the AOI touches can be worked out locally,
+    # which gives the same speed up as passing country_iso.
+    countries = [country_iso] if country_iso is not None else None
+    if countries is None and coverage_path:
+        countries = CountryCoverage.from_parquet(coverage_path).countries_for_bounds(aoi_bounds)
+        if verbose:
+            print_timestamped_message(f"Coverage table places the AOI in countries: {countries}")
+        # Buildings without a country are read too, so an AOI outside every country (like
+        # offshore) still gets them.
 
     country_info = ""
-    if country_iso is not None:
-        country_info = f"in country {country_iso}"
-    print_timestamped_message(f"Querying and downloading data for quadkey {quadkey} {country_info}...")
+    if countries:
+        country_info = f"in country {', '.join(countries)}"
+    print_timestamped_message(f"Querying and downloading data for quadkeys {', '.join(quadkeys)} {country_info}...")
     if verbose:
         print_timestamped_message(f"WKT: {wkt}")
     if country_info != "":
         print_timestamped_message(f"Expect query times of at least 5-10 seconds")
     else:
-        print_timestamped_message(f"Expect query times of at least 30 seconds - this can be lessened by using the --country-iso option")
+        print_timestamped_message(f"Expect longer query times if the AOI falls in countries that aren't split by quadkey - this can be lessened by using the --country-iso or --coverage option")
    
+    if not generate_sql:
+        # A cursor on a connection that's kept warm across downloads in the process, with the
+        # extensions loaded and S3 set up once.
+        extensions, s3_region = ('spatial',), None
+        if is_remote(data_path):
+            extensions = ('spatial', 'httpfs')
+            s3_region = DEFAULT_S3_REGION if data_path.startswith('s3://') else None
+        conn = shared_connection(extensions, s3_region=s3_region)
+
+    select_columns = output_columns(data_path, format)
     hive_value = 1 if hive_partitioning else 0
-    select_values = "* EXCLUDE geometry"
-    # if data path is overture and the output is not parquet, then name the values to get
-    # so we don't get the crazy structs that gis formats barf on
-    if data_path == "s3://us-west-2.opendata.source.coop/cholmes/overture/geoparquet-country-quad-hive/*/*.parquet" and format != "parquet":
-        select_values = "id, level, height, numfloors, class, country_iso, quadkey"
-    base_sql = f"select {select_values}, ST_AsWKB(ST_GeomFromWKB(geometry)) AS geometry from read_parquet('{data_path}', hive_partitioning={hive_value})"
+    source = f"read_parquet('{data_path}', hive_partitioning={hive_value})"
+    if not generate_sql:
+        # Work out which partition files can hold buildings for the AOI, and only read those
+        # rather than every file in the glob. The partition manifest has the bbox of each file;
+        # without one fall back to the country and quadkey in the file names.
+        manifest = load_manifest(conn, data_path)
+        if manifest is not None:
+            all_files = manifest['files']
+            files = select_manifest_files(manifest, data_path, aoi_bounds, countries, quadkeys)
+        else:
+            all_files = list_partition_files(conn, data_path)
+            files = prune_partition_files(all_files, countries, quadkeys)
+        print_timestamped_message(f"Reading {len(files)} of {len(all_files)} partition files.")
+        if verbose:
+            for f in files:
+                print_timestamped_message(f"  {f}")
+        if not files:
+            print_timestamped_message("No partition files match the GeoJSON input, so there are no buildings to download.")
+            return
+        source = read_parquet_source(files, hive_partitioning)
+        entries = manifest_entries(manifest, data_path) if manifest is not None else None
+        if cache is not None and is_remote(data_path):
+            # Read the files through the local cache, which only fetches the byte ranges it
+            # hasn't seen, and hand them to DuckDB as an Arrow stream. Row groups that can't
+            # hold buildings in the AOI are left out, and so are the columns the query doesn't
+            # use, so they're never fetched.
+            reader, pruning = cached_parquet_reader(cache, files, hive_partitioning, aoi_bounds, quadkeys, entries, columns=read_columns(select_columns))
+            conn.register('cached_partitions', reader)
+            source = 'cached_partitions'
+            columns = {field.name: str(field.type) for field in reader.schema}
+            print_timestamped_message(
+                f"Reading {pruning['row_groups'] - pruning['row_groups_skipped']} of {pruning['row_groups']} row groups, "
+                f"skipping {pruning['bytes_skipped'] / 1e6:.1f} of {pruning['bytes'] / 1e6:.1f} MB."
+            )
+        else:
+            columns = {row[0]: row[1] for row in conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+            if entries is not None:
+                # DuckDB reads the files itself, and skips row groups by their statistics
+                # with the bbox and quadkey conditions, so this is what it can skip.
+                pruning = {}
+                for f in files:
+                    row_groups = entries[f]['row_groups']
+                    pruning = add_summaries(pruning, row_group_summary(row_groups, select_row_groups(row_groups, aoi_bounds, quadkeys)))
+                print_timestamped_message(
+                    f"{pruning['row_groups_skipped']} of {pruning['row_groups']} row groups "
+                    f"({pruning['bytes_skipped'] / 1e6:.1f} of {pruning['bytes'] / 1e6:.1f} MB) can't hold buildings in the AOI."
+                )
+
+    select_values = "* EXCLUDE geometry" if select_columns is None else ", ".join(select_columns)
+    base_sql = f"select {select_values}, ST_AsWKB(ST_GeomFromWKB(geometry)) AS geometry from {source}"
     where_clause = "WHERE "
-    if country_iso:
-        where_clause += f"country_iso = '{country_iso}' AND "
-    where_clause += f"quadkey LIKE '{quadkey}%'"
+    if countries is not None:
+        # A coverage table can't place the buildings without a country, so keep those.
+        where_clause += f"{country_predicate(countries, include_null=country_iso is None)} AND "
+    where_clause += quadkey_predicate(quadkeys)
+    if not generate_sql and 'minx' in columns.get('bbox', ''):
+        # Compare the bbox struct first, so only the buildings whose bbox overlaps the AOI's
+        # get their geometry decoded for the exact test.
+        where_clause += f" AND\n{bbox_predicate(aoi_bounds)}"
     where_clause += f" AND\nST_Within(ST_GeomFromWKB(geometry), ST_GeomFromText('{wkt}'))"
 
-    output_extension = {
-        'shapefile': '.shp',
-        'geojson': 'json',
-        'geopackage': '.gpkg',
-        'flatgeobuf': '.fgb',
-        'parquet': '.parquet'
-    }
-
-    if not format:
-        for fmt, ext in output_extension.items():
-            if dst.endswith(ext):
-                format = fmt
-                break
-        else:  # The for-else structure means the else block runs if the loop completes normally, without a break.
-            raise ValueError("Unknown file format. Please specify using --format option.")
+    dst, format = output_format(dst, format)
 
-    if not dst.endswith(output_extension[format]):
-        dst += output_extension[format]
-
-    create_clause = f"CREATE TABLE buildings AS ({base_sql},\n{where_clause});"
+    # A temporary table belongs to this download's cursor, so it doesn't stay behind in the
+    # shared connection for the next one.
+    create_clause = f"CREATE TEMP TABLE buildings AS ({base_sql},\n{where_clause});"
     if generate_sql or verbose:
         print_timestamped_message(create_clause)
     if not generate_sql:
-        conn = duckdb.connect(database=':memory:')
-
-        spatial_extension_query = conn.execute("SELECT * FROM duckdb_extensions() WHERE installed IS TRUE AND extension_name = 'spatial';").fetchone()
-        if spatial_extension_query is None:
-            print_timestamped_message("Installing DuckDB spatial extension...")
-            conn.execute("INSTALL spatial;")
-        conn.execute("LOAD spatial;")
-        conn.execute(create_clause)
+        execute(conn, create_clause, 'query_buildings', source=data_path)
+        if source == 'cached_partitions':
+            print_timestamped_message(cache.summary())
 
         count = conn.execute("SELECT COUNT(*) FROM buildings;").fetchone()[0]
 
@@ -236,42 +376,265 @@ def download(geojson_input, format, generate_sql, dst, silent, overwrite, verbos
     if not generate_sql:
         print_timestamped_message(f"Writing to {dst}...")
 
-    if format == 'parquet':
-        copy_statement = f"COPY buildings TO '{dst}' WITH (FORMAT Parquet);"
-        if generate_sql or verbose:
-            print_timestamped_message(copy_statement)
-        if not generate_sql:
-            conn.execute(f"COPY buildings TO '{dst}' WITH (FORMAT Parquet);")
-            try:
-                df = pd.read_parquet(dst)
-
-                # Convert WKB geometry to geopandas geometry
-                df['geometry'] = df['geometry'].apply(wkb.loads, hex=True)
-                gdf = gpd.GeoDataFrame(df, geometry='geometry', crs="EPSG:4326")
-                # Change output file the input_filename with .parquet replaced with _geo.parquet
-                output_filename = dst.replace(".parquet", "_geo.parquet")
-            
-                gdf.to_parquet(output_filename)
-                # delete the original file
-                os.remove(dst)
-                # Rename (move) the output file to the input filename
-                shutil.move(output_filename, dst)
-                if verbose:
-                    print_timestamped_message(f"Finished processing {dst} at {time.ctime()}")
-            except Exception as e:
-                print(f"Error processing {dst} to geoparquet: {e}")
-    else:
-        gdal_format = {
-            'shapefile': 'ESRI Shapefile',
-            'geojson': 'GeoJSON',
-            'geopackage': 'GPKG',
-            'flatgeobuf': 'FlatGeobuf'
-        }
-        conn.execute(f"COPY buildings TO '{dst}' WITH (FORMAT GDAL, DRIVER '{gdal_format[format]}');")
-          
+    if format == 'parquet' and (generate_sql or verbose):
+        print_timestamped_message(f"COPY buildings TO '{dst}' WITH (FORMAT Parquet);")
+    if not generate_sql:
+        write_buildings(conn, 'buildings', dst, format)
+        if verbose:
+            print_timestamped_message(f"Finished processing {dst} at {time.ctime()}")
+
     if verbose:
         print_elapsed_time(start_time)
 
+def read_aois(text, id_property=None):
+    """The AOIs in a GeoJSON FeatureCollection, Feature or geometry, or in newline-delimited
+    GeoJSON with one of those on each line, as a list of (id, geometry). The id is the
+    id_property of the feature's properties if given, otherwise the feature's id, otherwise
+    its position in the input. Ids have to be unique, as they name the outputs."""
+    try:
+        objects = [json.loads(text)]
+    except json.JSONDecodeError:
+        # Also takes GeoJSON text sequences, which start each line with a record separator.
+        lines = [line.strip('\x1e \t\r') for line in text.splitlines()]
+        objects = [json.loads(line) for line in lines if line]
+    features = []
+    for obj in objects:
+        if obj.get('type') == 'FeatureCollection':
+            features.extend(obj['features'])
+        elif obj.get('type') == 'Feature':
+            features.append(obj)
+        else:
+            features.append({'type': 'Feature', 'geometry': obj})
+
+    aois = []
+    for i, feature in enumerate(features):
+        if id_property is not None:
+            aoi_id = (feature.get('properties') or {}).get(id_property)
+            if aoi_id is None:
+                raise ValueError(f"Feature {i} has no '{id_property}' property.")
+        else:
+            aoi_id = feature.get('id', i)
+        aois.append((str(aoi_id), shape(feature['geometry'])))
+    repeated = sorted(aoi_id for aoi_id, count in Counter(aoi_id for aoi_id, _ in aois).items() if count > 1)
+    if repeated:
+        raise ValueError(f"AOI ids have to be unique, but these repeat: {', '.join(repeated)}")
+    return aois
+
+
+def group_aois(aoi_files):
+    """Groups the AOIs that read any of the same partition files, given the list of files each
+    AOI reads. No file is in two groups, so querying a group at a time reads every file once,
+    for all the AOIs that need it. Returns (files, AOI indexes) pairs in the order of their
+    first AOI, leaving out AOIs without any files."""
+    parent = {}
+
+    def find(f):
+        while parent[f] != f:
+            parent[f] = parent[parent[f]]
+            f = parent[f]
+        return f
+
+    for files in aoi_files:
+        for f in files:
+            parent.setdefault(f, f)
+            root, first = find(f), find(files[0])
+            if root != first:
+                parent[root] = first
+
+    groups = {}
+    for i, files in enumerate(aoi_files):
+        if files:
+            group_files, indexes = groups.setdefault(find(files[0]), (set(), []))
+            group_files.update(files)
+            indexes.append(i)
+    return [(sorted(group_files), indexes) for group_files, indexes in groups.values()]
+
+
+def output_name(aoi_id):
+    """An AOI id made safe to use in a file name."""
+    return re.sub(r'[^\w.=-]', '_', aoi_id)
+
+
+def batch_query(source, where_clause, columns=None, has_bbox=False):
+    """The query that joins the buildings in source that pass where_clause to the AOIs in the
+    batch_aois and batch_ranges tables: a row for each building and AOI it's within, with the
+    AOI's id in aoi_id. columns are the building columns to keep, or all of them if None.
+
+    Buildings are first matched to the quadkey ranges of the AOIs' tiles, then to the AOIs'
+    bboxes, and only the pairs left get the exact test on their geometries."""
+    projection = "b.* EXCLUDE (geometry)" if columns is None else ", ".join(f"b.{c}" for c in columns)
+    conditions = ["a.aoi_id = r.aoi_id"]
+    if has_bbox:
+        conditions.append(bbox_predicate(('a.aoi_minx', 'a.aoi_miny', 'a.aoi_maxx', 'a.aoi_maxy'), 'b.bbox'))
+    conditions.append("ST_Within(ST_GeomFromWKB(b.geometry), a.aoi_geometry)")
+    return (
+        f"SELECT r.aoi_id, {projection}, ST_AsWKB(ST_GeomFromWKB(b.geometry)) AS geometry\n"
+        f"FROM (SELECT * FROM {source} {where_clause}) b\n"
+        f"JOIN batch_ranges r ON b.quadkey >= r.quadkey_start AND b.quadkey < r.quadkey_end\n"
+        f"JOIN batch_aois a ON {' AND '.join(conditions)}"
+    )
+
+
+def download_batch(geojson_input, dst, silent, overwrite, verbose, data_path, hive_partitioning, country_iso, coverage_path=None, cache=None, max_tiles=DEFAULT_MAX_TILES, id_property=None, format=None):
+    """Downloads the buildings in every feature of a FeatureCollection (or of newline-delimited
+    GeoJSON) in one run, instead of a run per feature.
+
+    The features are grouped by the partition files they need, and each group is one query
+    that reads its files once and joins the buildings to all of its AOIs. If dst has {id} in
+    it every AOI is written to its own file, with its id in the name, and AOIs whose file is
+    already there are skipped unless overwrite is set. Otherwise all the buildings go in the
+    one file dst, with the id of their AOI in an aoi_id column.
+    """
+    print_timestamped_message = timestamped_printer(silent)
+    start_time = time.time()
+
+    text = geojson_input.read() if geojson_input else click.get_text_stream('stdin').read()
+    aois = read_aois(text, id_property)
+    print_timestamped_message(f"Read {len(aois)} AOIs.")
+
+    split = '{id}' in dst
+    if split:
+        template, format = output_format(dst, format)
+        outputs = [template.replace('{id}', output_name(aoi_id)) for aoi_id, _ in aois]
+        # Ids like a/b and a_b are different, but would write the same file.
+        repeated = sorted(path for path, count in Counter(outputs).items() if count > 1)
+        if repeated:
+            raise ValueError(f"AOI ids have to give different file names, but these are shared: {', '.join(repeated)}")
+        existing = [i for i, path in enumerate(outputs) if os.path.exists(path)]
+        if existing and not overwrite:
+            print_timestamped_message(f"Skipping {len(existing)} AOIs that are already downloaded. Use --overwrite to download them again.")
+            existing = set(existing)
+            aois = [aoi for i, aoi in enumerate(aois) if i not in existing]
+            outputs = [path for i, path in enumerate(outputs) if i not in existing]
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    else:
+        dst, format = output_format(dst, format)
+        if os.path.exists(dst):
+            if not overwrite:
+                print_timestamped_message(f"File at {dst} already exists. Use --overwrite to overwrite it.")
+                return
+            os.remove(dst)
+    if not aois:
+        return
+
+    coverage = CountryCoverage.from_parquet(coverage_path) if coverage_path and country_iso is None else None
+    quadkeys, countries = [], []
+    for aoi_id, geometry in aois:
+        quadkeys.append(quadkey_cover(geometry, max_tiles))
+        if country_iso is not None:
+            countries.append([country_iso])
+        elif coverage is not None:
+            countries.append(coverage.countries_for_bounds(geometry.bounds))
+        else:
+            countries.append(None)
+
+    extensions, s3_region = ('spatial',), None
+    if is_remote(data_path):
+        extensions = ('spatial', 'httpfs')
+        s3_region = DEFAULT_S3_REGION if data_path.startswith('s3://') else None
+    conn = shared_connection(extensions, s3_region=s3_region)
+
+    # The partition files each AOI needs, worked out as for a single download.
+    manifest = load_manifest(conn, data_path)
+    all_files = manifest['files'] if manifest is not None else list_partition_files(conn, data_path)
+    entries = manifest_entries(manifest, data_path) if manifest is not None else None
+    aoi_files = []
+    for (aoi_id, geometry), aoi_quadkeys, aoi_countries in zip(aois, quadkeys, countries):
+        if manifest is not None:
+            aoi_files.append(select_manifest_files(manifest, data_path, geometry.bounds, aoi_countries, aoi_quadkeys))
+        else:
+            aoi_files.append(prune_partition_files(all_files, aoi_countries, aoi_quadkeys))
+    groups = group_aois(aoi_files)
+    no_files = sum(1 for files in aoi_files if not files)
+    print_timestamped_message(
+        f"Querying {len(aois) - no_files} AOIs in {len(groups)} groups, reading {sum(len(files) for files, _ in groups)} "
+        f"of {len(all_files)} partition files once each."
+    )
+    if no_files:
+        print_timestamped_message(f"{no_files} AOIs don't match any partition files, so have no buildings to download.")
+
+    select_columns = output_columns(data_path, format)
+
+    total = 0
+    for number, (files, indexes) in enumerate(groups, 1):
+        if verbose:
+            print_timestamped_message(f"Group {number} of {len(groups)}: {len(indexes)} AOIs in {len(files)} files.")
+        group_aoi_ids = [aois[i][0] for i in indexes]
+        group_geometries = [aois[i][1] for i in indexes]
+        group_quadkeys = [qk for i in indexes for qk in quadkeys[i]]
+        ranges = [(aois[i][0], start, end or '4') for i in indexes for start, end in quadkey_ranges(quadkeys[i])]
+        bounds = [g.bounds for g in group_geometries]
+        conn.register('batch_aoi_rows', pa.table({
+            'aoi_id': group_aoi_ids,
+            'aoi_minx': [b[0] for b in bounds],
+            'aoi_miny': [b[1] for b in bounds],
+            'aoi_maxx': [b[2] for b in bounds],
+            'aoi_maxy': [b[3] for b in bounds],
+            'aoi_wkt': [g.wkt for g in group_geometries],
+        }))
+        conn.register('batch_range_rows', pa.table({
+            'aoi_id': [r[0] for r in ranges],
+            'quadkey_start': [r[1] for r in ranges],
+            'quadkey_end': [r[2] for r in ranges],
+        }))
+        conn.execute("CREATE OR REPLACE TEMP TABLE batch_aois AS SELECT * EXCLUDE (aoi_wkt), ST_GeomFromText(aoi_wkt) AS aoi_geometry FROM batch_aoi_rows;")
+        conn.execute("CREATE OR REPLACE TEMP TABLE batch_ranges AS SELECT * FROM batch_range_rows;")
+
+        source = read_parquet_source(files, hive_partitioning)
+        if cache is not None and is_remote(data_path):
+            # Only the row groups that can hold buildings in one of the AOIs are fetched.
+            reader, pruning = cached_parquet_reader(cache, files, hive_partitioning, entries=entries, areas=[(b, quadkeys[i]) for b, i in zip(bounds, indexes)], columns=read_columns(select_columns))
+            conn.register('cached_partitions', reader)
+            source = 'cached_partitions'
+            columns = {field.name: str(field.type) for field in reader.schema}
+            if verbose:
+                print_timestamped_message(f"Reading {pruning['row_groups'] - pruning['row_groups_skipped']} of {pruning['row_groups']} row groups.")
+        else:
+            columns = {row[0]: row[1] for row in conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+        has_bbox = 'minx' in columns.get('bbox', '')
+
+        # Conditions on the whole group, which let the reader skip row groups none of its AOIs need.
+        where_clause = "WHERE "
+        if all(countries[i] is not None for i in indexes):
+            group_countries = sorted({c for i in indexes for c in countries[i]})
+            where_clause += f"{country_predicate(group_countries, include_null=country_iso is None)} AND "
+        where_clause += quadkey_predicate(group_quadkeys)
+        if has_bbox:
+            group_bounds = (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds))
+            where_clause += f" AND {bbox_predicate(group_bounds)}"
+
+        create_clause = f"CREATE OR REPLACE TEMP TABLE batch_buildings AS ({batch_query(source, where_clause, select_columns, has_bbox)});"
+        if verbose:
+            print_timestamped_message(create_clause)
+        execute(conn, create_clause, 'query_buildings', source=data_path, aois=len(indexes), files=len(files))
+        counts = dict(conn.execute("SELECT aoi_id, COUNT(*) FROM batch_buildings GROUP BY aoi_id").fetchall())
+        total += sum(counts.values())
+
+        if split:
+            # AOIs without buildings don't get a file, as with a single download.
+            for i in indexes:
+                aoi_id = aois[i][0]
+                if counts.get(aoi_id):
+                    write_buildings(conn, f"(SELECT * EXCLUDE (aoi_id) FROM batch_buildings WHERE aoi_id = '{aoi_id.replace(chr(39), chr(39) * 2)}')", outputs[i], format)
+        elif number == 1:
+            conn.execute("CREATE OR REPLACE TEMP TABLE buildings AS SELECT * FROM batch_buildings;")
+        else:
+            conn.execute("INSERT INTO buildings BY NAME SELECT * FROM batch_buildings;")
+    if cache is not None and is_remote(data_path):
+        print_timestamped_message(cache.summary())
+
+    print_timestamped_message(f"Downloaded {total} features for {len(aois)} AOIs.")
+    if not split and groups and total > 0:
+        print_timestamped_message(f"Writing to {dst}...")
+        write_buildings(conn, 'buildings', dst, format)
+    for table in ('batch_aois', 'batch_ranges', 'batch_buildings', 'buildings'):
+        conn.execute(f"DROP TABLE IF EXISTS {table};")
+    if verbose:
+        print_timestamped_message(f"Operation took {time.time() - start_time:.2f} seconds.")
+
 # Registering the commands with the main group
 cli.add_command(quadkey)
 cli.add_command(WKT)
@@ -0,0 +1,203 @@
+"""
+In-process GeoParquet writing. DuckDB writes plain Parquet with the geometry as WKB, so
+until now every output was written once by DuckDB and then rewritten in full by
+`gpq convert` (or pandas) just to add the 'geo' metadata. The writer here takes Arrow
+record batches - usually streamed straight out of a DuckDB query - writes them through
+pyarrow, and works out the bbox and geometry types as the batches go by, so the file is
+written once with its GeoParquet metadata in the footer.
+
+Files that were already written as plain Parquet can be converted with
+convert_parquet_to_geoparquet, which reads them a row group at a time and keeps the
+geometry as WKB bytes, so memory stays bounded by one row group however big the file is.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyproj
+import shapely
+
+GEOPARQUET_VERSION = '1.0.0'
+
+# shapely type ids to GeoParquet geometry type names
+GEOMETRY_TYPE_NAMES = {
+    0: 'Point',
+    1: 'LineString',
+    2: 'LineString',  # LinearRing
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection',
+}
+
+# Rows fetched from DuckDB per record batch when streaming a query.
+BATCH_SIZE = 100000
+
+
+class GeoParquetWriter:
+    """Writes record batches with a WKB geometry column to a GeoParquet file.
+
+    Batches are buffered until there are row_group_size rows, so the row groups come out
+    the requested size no matter how the batches arrive.
+    """
+
+    def __init__(self, path, schema, geometry_column='geometry', row_group_size=None, compression='snappy', crs=None):
+        self.path = path
+        self.crs = crs
+        self.geometry_column = geometry_column
+        self.row_group_size = row_group_size
+        # The geo metadata only goes in the footer once the bbox is known at close. Readers take
+        # the schema metadata from the stored Arrow schema when there is one, which would hide
+        # it, so don't store the Arrow schema.
+        self.writer = pq.ParquetWriter(path, schema, compression=compression, store_schema=False)
+        self.bbox = [np.inf, np.inf, -np.inf, -np.inf]
+        self.geometry_types = set()
+        self.num_rows = 0
+        self._pending = []
+        self._pending_rows = 0
+
+    def write_batch(self, batch):
+        if batch.num_rows == 0:
+            return
+        self._update_geo(batch.column(self.geometry_column))
+        self._pending.append(batch)
+        self._pending_rows += batch.num_rows
+        self.num_rows += batch.num_rows
+        if self.row_group_size is None or self._pending_rows >= self.row_group_size:
+            self._flush()
+
+    def _update_geo(self, wkb):
+        geometries = shapely.from_wkb(wkb.to_numpy(zero_copy_only=False))
+        bounds = shapely.bounds(geometries)
+        if not np.isnan(bounds).all():
+            self.bbox = [
+                min(self.bbox[0], np.nanmin(bounds[:, 0])),
+                min(self.bbox[1], np.nanmin(bounds[:, 1])),
+                max(self.bbox[2], np.nanmax(bounds[:, 2])),
+                max(self.bbox[3], np.nanmax(bounds[:, 3])),
+            ]
+        type_ids = np.unique(shapely.get_type_id(geometries))
+        self.geometry_types.update(GEOMETRY_TYPE_NAMES[t] for t in type_ids if t >= 0)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        table = pa.Table.from_batches(self._pending)
+        if self.row_group_size is None:
+            self.writer.write_table(table)
+            self._pending, self._pending_rows = [], 0
+            return
+        # Write out whole row groups and keep the remainder for the next batch.
+        full = (table.num_rows // self.row_group_size) * self.row_group_size
+        if full > 0:
+            self.writer.write_table(table.slice(0, full), row_group_size=self.row_group_size)
+        rest = table.slice(full)
+        self._pending = rest.to_batches() if rest.num_rows > 0 else []
+        self._pending_rows = rest.num_rows
+
+    def geo_metadata(self):
+        column = {
+            'encoding': 'WKB',
+            'geometry_types': sorted(self.geometry_types),
+        }
+        if self.bbox[0] <= self.bbox[2]:
+            column['bbox'] = [float(v) for v in self.bbox]
+        if self.crs is not None:
+            # Without a crs readers assume OGC:CRS84, so only write it when it's something else.
+            column['crs'] = pyproj.CRS(self.crs).to_json_dict()
+        return {
+            'version': GEOPARQUET_VERSION,
+            'primary_column': self.geometry_column,
+            'columns': {self.geometry_column: column},
+        }
+
+    def close(self):
+        # Whatever is left becomes the last (smaller) row group.
+        if self._pending:
+            table = pa.Table.from_batches(self._pending)
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+            self._pending, self._pending_rows = [], 0
+        self.writer.add_key_value_metadata({'geo': json.dumps(self.geo_metadata())})
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """Closes the file without the geo metadata and removes it, so a write that failed
+        partway doesn't leave something that looks like a finished GeoParquet file."""
+        try:
+            self.writer.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def write_geoparquet(reader, path, row_group_size=None, compression='snappy', geometry_column='geometry', crs=None):
+    """Writes everything from a pyarrow RecordBatchReader to a GeoParquet file, returning the row count."""
+    with GeoParquetWriter(path, reader.schema, geometry_column, row_group_size, compression, crs) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    return writer.num_rows
+
+
+def write_query_to_geoparquet(conn, query, path, row_group_size=None, compression='snappy', geometry_column='geometry'):
+    """Streams the result of a DuckDB query into a GeoParquet file, returning the row count."""
+    reader = conn.execute(query).fetch_record_batch(BATCH_SIZE)
+    return write_geoparquet(reader, path, row_group_size, compression, geometry_column)
+
+
+def _binary_geometry_schema(schema, geometry_column):
+    index = schema.get_field_index(geometry_column)
+    field = schema.field(index)
+    if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+        return schema.set(index, field.with_type(pa.binary()))
+    return schema
+
+
+def _binary_geometry_batch(batch, schema, geometry_column):
+    index = batch.schema.get_field_index(geometry_column)
+    wkb = batch.column(index)
+    if not batch.schema.field(index).type.equals(schema.field(index).type):
+        # Hex encoded WKB, which is rare enough that going through shapely to decode it is fine.
+        wkb = pa.array(shapely.to_wkb(shapely.from_wkb(wkb.to_numpy(zero_copy_only=False))), type=pa.binary())
+    return pa.RecordBatch.from_arrays(batch.columns[:index] + [wkb] + batch.columns[index + 1:], schema=schema)
+
+
+def convert_parquet_to_geoparquet(input_path, output_path=None, row_group_size=None, compression='snappy', geometry_column='geometry'):
+    """Rewrites a Parquet file with a WKB geometry column as GeoParquet, streaming it a row group
+    (or row_group_size rows) at a time. Without an output_path the input file is replaced.
+    Returns the row count."""
+    parquet_file = pq.ParquetFile(input_path)
+    schema = _binary_geometry_schema(parquet_file.schema_arrow, geometry_column)
+    if row_group_size is None:
+        batches = (batch for i in range(parquet_file.num_row_groups) for batch in parquet_file.read_row_group(i).combine_chunks().to_batches())
+    else:
+        batches = parquet_file.iter_batches(batch_size=row_group_size)
+
+    if output_path is None:
+        # Next to the input, named from its file name only, so a .parquet in a folder name is left alone.
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        target_path = os.path.join(os.path.dirname(input_path), f'{name}_geo.parquet')
+    else:
+        target_path = output_path
+    with GeoParquetWriter(target_path, schema, geometry_column, row_group_size, compression) as writer:
+        for batch in batches:
+            writer.write_batch(_binary_geometry_batch(batch, schema, geometry_column))
+    parquet_file.close()
+
+    if output_path is None:
+        os.remove(input_path)
+        shutil.move(target_path, input_path)
+    return writer.num_rows
@@ -7,54 +7,41 @@
 # The other thing that would be nice to make it truly generic is to be able to supply the 
 # table name, since this should work fine with other types of data. Could also just call it
 # 'features' by default, the table name doesn't really matter in these processings. Should probably check
-# to be sure it works with lines and points too. So this could use clean up, also just
-# removing the 'midpoint' code. 
+# to be sure it works with lines and points too. So this could use clean up.
 
 import os
-import duckdb
 import time
 import tempfile
 import subprocess
 import glob
-from duckdb.typing import *
-import mercantile
-from shapely import wkt
 import shutil
-
-def lat_lon_to_quadkey(wkt_point: VARCHAR, level: INTEGER) -> VARCHAR:
-
-    geom = wkt.loads(wkt_point)
-
-    # convert geom to tile
-    tile = mercantile.tile(geom.x, geom.y, level)
-    
-    # Convert the tile to a quadkey
-    quadKey = mercantile.quadkey(tile)
-    return quadKey
-
-def midpoint(minval: DOUBLE, maxval: DOUBLE) -> DOUBLE:
-    return (minval + maxval) / 2.0
+from open_buildings.connection import connect
+from open_buildings.geoparquet import write_query_to_geoparquet
+from open_buildings.quadkey import register_quadkey_function
+from open_buildings.countries import CountryIndex, register_country_function
 
 def add_quadkey(con):
 
-    # Register Python UDFs
-    con.create_function('lat_lon_to_quadkey', lat_lon_to_quadkey, [VARCHAR, INTEGER], VARCHAR)
-    con.create_function('midpoint', midpoint, [DOUBLE, DOUBLE], DOUBLE)
+    # Register the vectorized quadkey function, which DuckDB calls once per vector of rows
+    register_quadkey_function(con)
 
     # Add a quadkey column to the table if it doesn't exist
     con.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS quadkey VARCHAR")
 
-    # Update the quadkey column
+    # Update the quadkey column from the centroid of the geometry
     con.execute("""
     UPDATE buildings 
-    SET quadkey = lat_lon_to_quadkey(ST_Centroid(ST_GeomFromWKB(geometry)),  
+    SET quadkey = lat_lon_to_quadkey(
+        ST_Y(ST_Centroid(ST_GeomFromWKB(geometry))),
+        ST_X(ST_Centroid(ST_GeomFromWKB(geometry))),
         12
     );
     """)
 
 def add_country_iso(con, country_parquet_path):
-    # Load country parquet file into duckdb
-    con.execute(f"CREATE TABLE countries AS SELECT * FROM read_parquet('{country_parquet_path}')")
+    # Index the country polygons in an STRtree, so each building is only tested
+    # against the countries whose bounding box it touches
+    register_country_function(con, CountryIndex.from_parquet(country_parquet_path))
 
     # Add a country_iso column to the buildings table
     con.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS country_iso VARCHAR")
@@ -62,12 +49,10 @@ def add_country_iso(con, country_parquet_path):
     # Update the country_iso column in the buildings table
     con.execute("""
     UPDATE buildings 
-    SET country_iso = countries.isocountrycodealpha2 
-    FROM countries 
-    WHERE ST_Intersects(ST_GeomFromWKB(countries.geometry), ST_GeomFromWKB(buildings.geometry))
+    SET country_iso = country_iso_for(geometry)
     """)
 
-def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False):
+def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, geo_conversion='none'):
     # Ensure output_folder exists
     os.makedirs(output_folder, exist_ok=True)
     
@@ -92,9 +77,7 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     print(f"Starting processing for file {input_parquet_path} at {time.ctime(timestamp)}")
     
     # Connect to DuckDB
-    con = duckdb.connect(output_db_path)
-    
-    con.execute('LOAD spatial;')
+    con = connect(output_db_path)
 
     # Load parquet file into duckdb
     con.execute(f"CREATE TABLE buildings AS SELECT * FROM read_parquet('{input_parquet_path}')")
@@ -105,10 +88,16 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     if add_country_iso_option:
         add_country_iso(con, country_parquet_path)
 
-    # Write out to Parquet
-    con.execute(f"COPY (SELECT * FROM buildings ORDER BY quadkey) TO '{output_parquet_path}' WITH (FORMAT Parquet)")
+    query = "SELECT * FROM buildings ORDER BY quadkey"
+    if geo_conversion == 'native':
+        # Write GeoParquet directly, so the file only gets written once
+        print(f"Writing geoparquet: {output_parquet_path}")
+        write_query_to_geoparquet(con, query, output_parquet_path)
+    else:
+        # Write out to Parquet
+        con.execute(f"COPY ({query}) TO '{output_parquet_path}' WITH (FORMAT Parquet)")
     
-    if (False):
+    if geo_conversion == 'gpq':
         print(f"Converting to geoparquet: {output_parquet_path}")
         # Create a temporary file
         temp_file = tempfile.NamedTemporaryFile(suffix=".parquet", delete=False)
@@ -130,13 +119,13 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     if (remove_duckdb):
         os.remove(output_db_path)
 
-def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False):
+def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, geo_conversion='none'):
     # If input_path is a directory, process all Parquet files in it
     if os.path.isdir(input_path):
         for file in glob.glob(os.path.join(input_path, "*.parquet")):
-            process_parquet_file(file, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option)
+            process_parquet_file(file, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, geo_conversion)
     else:
-        process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option)
+        process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, geo_conversion)
 
 # Call the function
 input_path = '/Users/cholmes/geodata/google-buildings-v3/geoparquet/'
@@ -11,17 +11,16 @@ Those quadkeys will be further partitioned if necessary until the number of rows
 quadkey is less than or equal to the maximum number of rows per file. 
 """
 
-import duckdb
 import datetime
 import subprocess
 import tempfile
 import os
 import click
 import shutil
-import geopandas as gpd
-from shapely import wkb
-import pandas as pd
 import time
+from open_buildings.connection import connect
+from open_buildings.geoparquet import convert_parquet_to_geoparquet, write_query_to_geoparquet
+from open_buildings.profiling import execute, span
 
 def current_time_str():
     return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -52,22 +51,11 @@ def convert_gpq(input_filename, row_group_size, verbose):
     #    os.remove(initial_temp_filename)
 
 def convert_pandas(input_filename, rg_size, verbose):
-    # Placeholder function to be fleshed out
-    print_verbose("Starting conversion using pandas.", verbose)
+    # Streams the file through a row group at a time, keeping the geometry as WKB, so a
+    # big country file doesn't have to fit in memory as shapely objects.
+    print_verbose("Starting conversion to GeoParquet.", verbose)
     try:
-        df = pd.read_parquet(input_filename)
-
-        # Convert WKB geometry to geopandas geometry
-        df['geometry'] = df['geometry'].apply(wkb.loads, hex=True)
-        gdf = gpd.GeoDataFrame(df, geometry='geometry', crs="EPSG:4326")
-        # Change output file the input_filename with .parquet replaced with _geo.parquet
-        output_filename = input_filename.replace(".parquet", "_geo.parquet")
-    
-        gdf.to_parquet(output_filename, row_group_size=rg_size)
-        # delete the original file
-        os.remove(input_filename)
-        # Rename (move) the output file to the input filename
-        shutil.move(output_filename, input_filename)
+        convert_parquet_to_geoparquet(input_filename, row_group_size=rg_size)
         print(f"Finished processing {input_filename} at {time.ctime()}")
     except Exception as e:
         print(f"Error processing {input_filename}: {e}")
@@ -120,17 +108,36 @@ def fetch_quadkeys(conn, table_name, country_code, length, verbose, prev_qk=""):
 
 def convert_to_geoparquet(parquet_path, geo_conversion, row_group_size, verbose):
     if geo_conversion == 'gpq':
-        convert_gpq(parquet_path, row_group_size, verbose)
+        with span('gpq_convert', file=parquet_path) as s:
+            convert_gpq(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with gpq", verbose)
     elif geo_conversion == 'pandas':
-        convert_pandas(parquet_path, row_group_size, verbose)
+        with span('pandas_convert', file=parquet_path) as s:
+            convert_pandas(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with pandas", verbose)
     elif geo_conversion == 'ogr':
-        convert_ogr(parquet_path, row_group_size, verbose)
+        with span('ogr_convert', file=parquet_path) as s:
+            convert_ogr(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with ogr", verbose)
+    elif geo_conversion == 'native':
+        print_verbose(f"File: {parquet_path} written directly as GeoParquet", verbose)
     else:
         print_verbose(f"File: {parquet_path} written without converting to GeoParquet", verbose)
 
+def copy_to_parquet(conn, query, output_filename, geo_conversion, row_group_size, verbose):
+    if geo_conversion == 'native':
+        # Stream the query result through the GeoParquet writer, so the file is only written once
+        print_verbose(f'Writing GeoParquet to {output_filename} from: {query}', verbose)
+        with span('write_geoparquet', file=output_filename) as s:
+            s.set(rows=write_query_to_geoparquet(conn, query, output_filename, row_group_size), bytes=os.path.getsize(output_filename))
+    else:
+        copy_cmd = f"COPY ({query}) TO '{output_filename}' WITH (FORMAT PARQUET);"
+        print_verbose(f'Executing: {copy_cmd}', verbose)
+        execute(conn, copy_cmd, 'copy_to_parquet', file=output_filename)
+
 #TODO: go all the way into the quad to find the smallest quadkey that contains less than max_per_file rows
 def process_quadkey_recursive(conn, table_name, country_code, output_folder, length, geo_conversion, row_group_size, verbose, max_per_file, current_qk=""):
     distinct_quadkeys = fetch_quadkeys(conn, table_name, country_code, length, verbose, current_qk)
@@ -149,9 +156,8 @@ def process_quadkey_recursive(conn, table_name, country_code, output_folder, len
             if os.path.exists(quad_output_filename):
                 print_verbose(f"Output file {quad_output_filename} already exists, skipping...", verbose)
             else:
-                copy_cmd = f"COPY (SELECT * FROM {table_name} WHERE country_iso = '{country_code}' AND SUBSTR(quadkey, 1, {length}) = '{qk_str}' ORDER BY quadkey) TO '{quad_output_filename}' WITH (FORMAT PARQUET);"
-                print_verbose(f'Executing: {copy_cmd}', verbose)
-                conn.execute(copy_cmd)
+                query = f"SELECT * FROM {table_name} WHERE country_iso = '{country_code}' AND SUBSTR(quadkey, 1, {length}) = '{qk_str}' ORDER BY quadkey"
+                copy_to_parquet(conn, query, quad_output_filename, geo_conversion, row_group_size, verbose)
                 convert_to_geoparquet(quad_output_filename, geo_conversion, row_group_size, verbose)
 
 
@@ -162,7 +168,7 @@ def process_quadkey_recursive(conn, table_name, country_code, output_folder, len
 @click.command()
 @click.argument('duckdb-path', type=click.Path(exists=True))
 @click.option('--output-folder', default=os.getcwd(), type=click.Path(), help='Folder to store the output files')
-@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'none', 'pandas', 'ogr'], case_sensitive=False))
+@click.option('--geo-conversion', default='gpq', type=click.Choice(['gpq', 'native', 'none', 'pandas', 'ogr'], case_sensitive=False))
 @click.option('--verbose', is_flag=True, default=False, help='Print verbose output')
 @click.option('--max-per-file', default=10000000, type=int, help='Maximum number of rows per file')
 @click.option('--row-group-size', default=10000, type=int, help='Row group size for Parquet files')
@@ -171,8 +177,7 @@ def process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file
     table_name = 'buildings'
     # create output folder if it does not exist
     os.makedirs(output_folder, exist_ok=True)
-    conn = duckdb.connect(duckdb_path)
-    conn.execute('LOAD spatial;')
+    conn = connect(duckdb_path)
     cursor = conn.execute('SELECT DISTINCT country_iso FROM buildings')
     countries = cursor.fetchall()
     
@@ -195,9 +200,8 @@ def process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file
         print_verbose(f"Country {country_code} has {count} rows", verbose)
 
         if count <= max_per_file:
-            copy_cmd = f"COPY (SELECT * FROM {table_name} WHERE country_iso = '{country_code}' ORDER BY quadkey) TO '{output_filename}' WITH (FORMAT PARQUET);"
-            print_verbose(f'Executing: {copy_cmd}', verbose)
-            conn.execute(copy_cmd)
+            query = f"SELECT * FROM {table_name} WHERE country_iso = '{country_code}' ORDER BY quadkey"
+            copy_to_parquet(conn, query, output_filename, geo_conversion, row_group_size, verbose)
             convert_to_geoparquet(output_filename, geo_conversion, row_group_size, verbose)
         else:
             process_quadkey_recursive(conn, table_name, country_code, write_folder, 1, geo_conversion, row_group_size, verbose, max_per_file)
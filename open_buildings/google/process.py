@@ -3,21 +3,33 @@ import subprocess
 import time
 from datetime import datetime, timedelta
 import json
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import click
 import glob
-import duckdb
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyproj
+import shapely
 from shapely import wkt
-from shapely.geometry import mapping
-from openlocationcode import openlocationcode as olc
+from pyogrio.raw import write_arrow
+from tabulate import tabulate
+
+from open_buildings.benchmark import measure, phase, run_cell, skipped_cell
+from open_buildings import profiling
+from open_buildings.profiling import execute, span
+from open_buildings.connection import connect
+from open_buildings.geoparquet import write_geoparquet, write_query_to_geoparquet
+from open_buildings.plus_codes import encode as encode_plus_codes, register_plus_code_function
 
 # Global variable, that runs GPQ (https://github.com/planetlabs/gpq) after DuckDB writes the Parquet file.
 # This is necessary because DuckDB does not write the GeoParquet metadata (yet). Once DuckDB implements
 # this feature can be removed. Setting it to false will give a sense of how fast DuckDB will be, but
-# if you want to actually use the output GeoParquet files, set it to True.
+# if you want to actually use the output GeoParquet files, set it to True. The 'native' geo
+# conversion writes the GeoParquet metadata directly and doesn't need GPQ at all.
 RUN_GPQ_CONVERSION = True
+DEFAULT_GEO_CONVERSION = 'gpq' if RUN_GPQ_CONVERSION else 'none'
 
 # Global variable, that sets the compression type for the Parquet files. The two options that
 # will work for both DuckDB and pandas are 'snappy' and 'gzip'. 'snappy' is the default. You can
@@ -31,6 +43,12 @@ PARQUET_COMPRESSION = 'snappy'
 # It means longer runs and puts one big time on the graphs.
 SKIP_DUCK_GPKG = True
 
+# Rough peak memory of converting a CSV, as a multiple of its size on disk, used to keep
+# parallel conversions within --memory-budget. pandas holds the whole frame plus a shapely
+# object per row, DuckDB works out of its database file so needs far less.
+PANDAS_MEMORY_FACTOR = 8
+DUCKDB_MEMORY_FACTOR = 2
+
 @click.group()
 def cli():
     pass
@@ -44,6 +62,11 @@ def define_output_paths(input_file_path, output_directory, format):
     return output_file_path, duckdb_file_path
 
 
+# The rows the split passes through untouched. A plain NOT LIKE would be NULL for a missing geometry
+# and drop the row, so those are kept explicitly.
+NOT_MULTIPOLYGON = "geometry IS NULL OR geometry NOT LIKE 'MULTIPOLYGON%'"
+
+
 def remove_existing_files(output_file_path, duckdb_file_path, overwrite):
     if overwrite:
         if os.path.exists(output_file_path):
@@ -59,94 +82,55 @@ def process_with_duckdb(
     verbose,
     format,
     output_file_path,
+    geo_conversion=DEFAULT_GEO_CONVERSION,
 ):
     # new duckdb at input file path but with .duckdb
-    conn = duckdb.connect(duckdb_file_path)
+    # Spatial is only installed the first time it's needed in the process.
+    conn = connect(duckdb_file_path)
     c = conn.cursor()
-    c.execute(f"install spatial;")
-    c.execute(f"load spatial;")
-    c.execute(
-        f"create table buildings as (select * EXCLUDE (latitude, longitude) from '{input_file_path}');"
-    )
+    with phase('read'):
+        execute(
+            c,
+            f"create table buildings as (select * EXCLUDE (latitude, longitude) from '{input_file_path}');",
+            'read_csv',
+            file=input_file_path,
+        )
 
     if verbose:
         c.execute("SELECT COUNT(*) FROM buildings")
         print(f"Original rows: {c.fetchone()[0]}")
 
-    if split_multipolygons:
-        # Fetch the multipolygons
-        c.execute("SELECT * FROM buildings WHERE geometry LIKE 'MULTIPOLYGON%'")
-        results = c.fetchall()
-        columns = [desc[0] for desc in c.description]
-
-        multipolygon_count = 0
-
-        # Process each multipolygon
-        for row in results:
-            multipolygon_count += 1
-            row_dict = dict(zip(columns, row))
-            multipolygon = wkt.loads(row_dict['geometry'])
-
+    with phase('transform'):
+        if split_multipolygons:
+            register_plus_code_function(c)
             if verbose:
-                # Print the original MultiPolygon
-                feature = {
-                    "type": "Feature",
-                    "properties": {
-                        k: v for k, v in row_dict.items() if k != 'geometry'
-                    },
-                    "geometry": multipolygon.__geo_interface__,
-                }
-                print("Original MultiPolygon:")
-                print(json.dumps(feature))
-
-            for polygon in multipolygon.geoms:
-                # Convert the polygon to a GeoSeries in order to project it
-                polygon_projected = gpd.GeoSeries([polygon], crs="EPSG:4326").to_crs(
-                    'EPSG:6933'
-                )
-
-                # Compute the new area (geopandas calculates area in square meters for projected CRS)
-                new_area = polygon_projected.area.values[0]
-
-                # Compute the centroid and encode it into a Plus Code
-                centroid = polygon.centroid
-                new_plus_code = olc.encode(centroid.y, centroid.x, codeLength=12)
-
-                # Create new properties for the polygon
-                properties = {k: v for k, v in row_dict.items() if k != 'geometry'}
-                properties['area_in_meters'] = new_area
-                properties['full_plus_code'] = new_plus_code
-
-                if verbose:
-                    # Print the new Polygon
-                    feature = {
-                        "type": "Feature",
-                        "properties": properties,
-                        "geometry": polygon.__geo_interface__,
-                    }
-                    print("Component Polygon:")
-                    print(json.dumps(feature))
-
-                # Insert new polygon into buildings table
-                columns_str = ', '.join(
-                    [f'"{k}"' for k in properties.keys()] + ['geometry']
-                )
-                values_str = ', '.join(
-                    [
-                        f"'{v}'" if isinstance(v, str) else str(v)
-                        for v in properties.values()
-                    ]
-                    + [f"'{polygon.wkt}'"]
+                c.execute("SELECT COUNT(*) FROM buildings WHERE geometry LIKE 'MULTIPOLYGON%'")
+                print(f"Splitting {c.fetchone()[0]} multipolygons.")
+
+            # Split the multipolygons into their parts in one statement, recomputing the area in an
+            # equal area projection and the Plus Code from the centroid of each part.
+            execute(
+                c,
+                f"""
+                CREATE TABLE buildings_split AS
+                WITH parts AS (
+                    SELECT * EXCLUDE geometry, UNNEST(ST_Dump(ST_GeomFromText(geometry))).geom AS part
+                    FROM buildings
+                    WHERE geometry LIKE 'MULTIPOLYGON%'
                 )
-                c.execute(
-                    f"INSERT INTO buildings ({columns_str}) VALUES ({values_str})"
-                )
-
-        if verbose:
-            print(f"Processed {multipolygon_count} multipolygons.")
-
-        # Delete the original multipolygons
-        c.execute("DELETE FROM buildings WHERE geometry LIKE 'MULTIPOLYGON%'")
+                SELECT * FROM buildings WHERE {NOT_MULTIPOLYGON}
+                UNION ALL BY NAME
+                SELECT * EXCLUDE (part) REPLACE (
+                        ST_Area(ST_Transform(part, 'EPSG:4326', 'EPSG:6933', true)) AS area_in_meters,
+                        plus_code(ST_Y(ST_Centroid(part)), ST_X(ST_Centroid(part))) AS full_plus_code
+                    ),
+                    ST_AsText(part) AS geometry
+                FROM parts;
+                """,
+                'split_multis',
+            )
+            c.execute("DROP TABLE buildings;")
+            c.execute("ALTER TABLE buildings_split RENAME TO buildings;")
 
     if verbose:
         c.execute("SELECT COUNT(*) FROM buildings")
@@ -158,129 +142,212 @@ def process_with_duckdb(
         c.execute("SELECT COUNT(*) FROM buildings WHERE geometry LIKE 'POLYGON%'")
         print(f"Output polygons: {c.fetchone()[0]}")
 
-    if format == 'fgb':
-        c.execute(
-            f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
-                TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'FlatGeobuf');"
-        )
-    elif format == 'parquet':
-        c.execute(
-            f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
-                TO '{output_file_path}' WITH  (FORMAT PARQUET, COMPRESSION '{PARQUET_COMPRESSION}');"
-        )
-        if RUN_GPQ_CONVERSION:
-            print(
-                f"Running gpq convert on {output_file_path}. This takes extra time but ensures the output is valid GeoParquet."
-            )
-            base_name, ext = os.path.splitext(output_file_path)
-            temp_output_file_path = base_name + '_temp' + ext
-
-            # convert from parquet file with a geometry column named wkb to GeoParquet
-            command = ['gpq', 'convert', output_file_path, temp_output_file_path]
-            gpq_start_time = time.time()
-            subprocess.run(command, check=True)
-            os.rename(temp_output_file_path, output_file_path)
-            gpq_end_time = time.time()
-            gpq_elapsed_time = gpq_end_time - gpq_start_time
-            print(f"Time taken to run gpq: {gpq_elapsed_time:.2f} seconds")
-        else:
-            print(
-                f"Skipping gpq convert on {output_file_path}. This means the output will be WKB, but it will need to be converted to GeoParquet."
-            )
-    elif format == 'gpkg':
-        if SKIP_DUCK_GPKG:
-            print(
-                f"Skipping duckdb-gpkg conversion on {output_file_path}, since SKIP_DUCK_GPKG is set to True. There is likely a bug, since it takes way longer and skews the graphs"
+    with phase('write'):
+        if format == 'fgb':
+            execute(
+                c,
+                f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
+                    TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'FlatGeobuf');",
+                'copy_to_fgb',
+                file=output_file_path,
             )
-        else:
-            c.execute(
+        elif format == 'parquet':
+            query = "SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings"
+            if geo_conversion == 'native':
+                # Write the GeoParquet in one pass, streaming the rows out of DuckDB through pyarrow
+                with span('write_geoparquet', file=output_file_path) as s:
+                    s.set(rows=write_query_to_geoparquet(c, query, output_file_path, compression=PARQUET_COMPRESSION))
+            else:
+                execute(
+                    c,
+                    f"COPY ({query}) TO '{output_file_path}' WITH  (FORMAT PARQUET, COMPRESSION '{PARQUET_COMPRESSION}');",
+                    'copy_to_parquet',
+                    file=output_file_path,
+                )
+            if geo_conversion == 'gpq':
+                print(
+                    f"Running gpq convert on {output_file_path}. This takes extra time but ensures the output is valid GeoParquet."
+                )
+                base_name, ext = os.path.splitext(output_file_path)
+                temp_output_file_path = base_name + '_temp' + ext
+
+                # convert from parquet file with a geometry column named wkb to GeoParquet
+                command = ['gpq', 'convert', output_file_path, temp_output_file_path]
+                gpq_start_time = time.time()
+                with span('gpq_convert', file=output_file_path) as s:
+                    subprocess.run(command, check=True)
+                    os.rename(temp_output_file_path, output_file_path)
+                    s.set(bytes=os.path.getsize(output_file_path))
+                gpq_end_time = time.time()
+                gpq_elapsed_time = gpq_end_time - gpq_start_time
+                print(f"Time taken to run gpq: {gpq_elapsed_time:.2f} seconds")
+            elif geo_conversion == 'none':
+                print(
+                    f"Skipping gpq convert on {output_file_path}. This means the output will be WKB, but it will need to be converted to GeoParquet."
+                )
+        elif format == 'gpkg':
+            if SKIP_DUCK_GPKG:
+                print(
+                    f"Skipping duckdb-gpkg conversion on {output_file_path}, since SKIP_DUCK_GPKG is set to True. There is likely a bug, since it takes way longer and skews the graphs"
+                )
+            else:
+                execute(
+                    c,
+                    f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
+                        TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'GPKG');",
+                    'copy_to_gpkg',
+                    file=output_file_path,
+                )
+        elif format == 'shp':
+            execute(
+                c,
                 f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
-                    TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'GPKG');"
+                    TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'ESRI Shapefile');",
+                'copy_to_shp',
+                file=output_file_path,
             )
-    elif format == 'shp':
-        c.execute(
-            f"COPY (SELECT * EXCLUDE geometry, ST_AsWKB(ST_GeomFromText(geometry)) AS geometry from buildings) \
-                TO '{output_file_path}' WITH  (FORMAT GDAL, DRIVER 'ESRI Shapefile');"
-        )
 
     conn.close()
 
 
-def process_with_pandas(
-    input_file_path, split_multipolygons, verbose, format, output_file_path
-):
-    df = pd.read_csv(input_file_path)
-    df['geometry'] = df['geometry'].apply(wkt.loads)
+def split_multipolygons_gdf(gdf, verbose=False):
+    """Splits each MultiPolygon into its component Polygons, giving every part its own
+    area_in_meters and full_plus_code. The parts come first, in order, followed by the
+    original Polygons."""
+    multipolygons = gdf[gdf.geometry.type == 'MultiPolygon']
+    if verbose:
+        for i, row in multipolygons.iterrows():
+            # Print the original MultiPolygon
+            feature = {
+                "type": "Feature",
+                "properties": row.drop('geometry').to_dict(),
+                "geometry": row.geometry.__geo_interface__,
+            }
+            print("Original MultiPolygon:")
+            print(json.dumps(feature))
 
-    # Drop the 'latitude' and 'longitude' columns
-    df = df.drop(['latitude', 'longitude'], axis=1)
+    parts = multipolygons.explode(index_parts=False, ignore_index=True)
 
-    # Convert the DataFrame to a GeoDataFrame
-    gdf = gpd.GeoDataFrame(df, geometry='geometry')
-    gdf.set_crs("EPSG:4326", inplace=True)
+    # Project all the parts at once to get their areas (in square meters for EPSG:6933)
+    parts['area_in_meters'] = parts.geometry.to_crs('EPSG:6933').area.values
 
-    # Create an empty GeoDataFrame for the output
-    output_gdf = gpd.GeoDataFrame(columns=list(gdf.columns), crs=gdf.crs)
+    # Compute the centroids and encode them into Plus Codes
+    centroids = shapely.centroid(parts.geometry.values)
+    parts['full_plus_code'] = encode_plus_codes(
+        shapely.get_y(centroids), shapely.get_x(centroids), 12
+    ).to_numpy(zero_copy_only=False)
 
-    if split_multipolygons:
-        multipolygons = gdf[gdf.geometry.type == 'MultiPolygon']
-        multipolygon_count = 0
-        for i, row in multipolygons.iterrows():
-            multipolygon_count += 1
-            # Print the original MultiPolygon
+    if verbose:
+        for i, row in parts.iterrows():
+            # Print the new Polygon
             feature = {
                 "type": "Feature",
                 "properties": row.drop('geometry').to_dict(),
                 "geometry": row.geometry.__geo_interface__,
             }
-            if verbose:
-                print("Original MultiPolygon:")
-                print(json.dumps(feature))
-
-            # Print each component Polygon
-            for polygon in row.geometry.geoms:
-                # Convert the polygon to a GeoSeries in order to project it
-                polygon_projected = gpd.GeoSeries([polygon], crs=gdf.crs).to_crs(
-                    'EPSG:6933'
-                )
+            print("Component Polygon:")
+            print(json.dumps(feature))
+
+    print(f"Processed {len(multipolygons)} multipolygons.")
+    # Add the original Polygons to the output
+    polygons = gdf[gdf.geometry.type == 'Polygon']
+    return pd.concat([parts, polygons], ignore_index=True)
+
+
+# OGR drivers for the formats the pandas path writes.
+OGR_DRIVERS = {'fgb': 'FlatGeobuf', 'gpkg': 'GPKG', 'shp': 'ESRI Shapefile'}
+
+
+def read_csv_chunks(input_file_path, chunk_size, split_multipolygons, verbose):
+    """Reads a CSV chunk_size rows at a time, yielding a GeoDataFrame for each chunk."""
+    reader = pd.read_csv(input_file_path, chunksize=chunk_size)
+    while True:
+        with phase('read'), span('read_csv', file=input_file_path) as s:
+            df = next(reader, None)
+            if df is None:
+                return
+            df = df.drop(['latitude', 'longitude'], axis=1)
+            gdf = gpd.GeoDataFrame(df, geometry=shapely.from_wkt(df['geometry'].values), crs="EPSG:4326")
+            s.set(rows=len(gdf))
+        if split_multipolygons:
+            with phase('transform'), span('split_multis') as s:
+                gdf = split_multipolygons_gdf(gdf, verbose)
+                s.set(rows=len(gdf))
+        yield gdf
+
+
+def gdf_to_table(gdf, schema=None):
+    """A GeoDataFrame as an Arrow table with the geometry as WKB, cast to schema if given."""
+    table = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns='geometry')), preserve_index=False)
+    table = table.append_column('geometry', pa.array(shapely.to_wkb(gdf.geometry.values), type=pa.binary()))
+    if schema is not None:
+        # pandas infers the types of each chunk on its own, so keep them to the first chunk's.
+        table = table.cast(schema)
+    return table
+
+
+def process_with_pandas_chunked(
+    input_file_path, split_multipolygons, verbose, format, output_file_path, chunk_size
+):
+    chunks = read_csv_chunks(input_file_path, chunk_size, split_multipolygons, verbose)
+    first = gdf_to_table(next(chunks))
+    rows = [first.num_rows]
+
+    def batches():
+        yield from first.to_batches()
+        for gdf in chunks:
+            table = gdf_to_table(gdf, first.schema)
+            rows.append(table.num_rows)
+            yield from table.to_batches()
+
+    # Each chunk goes straight to the output writer, so only one is in memory at a time. The
+    # reading and splitting of later chunks happens inside the writer, in their own phases.
+    reader = pa.RecordBatchReader.from_batches(first.schema, batches())
+    with phase('write'), span(f'write_{format}', file=output_file_path) as s:
+        if format == 'parquet':
+            write_geoparquet(reader, output_file_path, compression=PARQUET_COMPRESSION, crs='EPSG:4326')
+        else:
+            write_arrow(
+                reader,
+                output_file_path,
+                driver=OGR_DRIVERS[format],
+                geometry_name='geometry',
+                geometry_type='Polygon' if split_multipolygons or format == 'shp' else 'Unknown',
+                crs=pyproj.CRS('EPSG:4326').to_wkt(),
+            )
+        s.set(rows=sum(rows), bytes=output_size(output_file_path))
 
-                # Compute the new area (geopandas calculates area in square meters for projected CRS)
-                new_area = polygon_projected.area.values[0]
-
-                # Compute the centroid and encode it into a Plus Code
-                centroid = polygon.centroid
-                new_plus_code = olc.encode(centroid.y, centroid.x, codeLength=12)
-
-                # Create new properties for the polygon
-                properties = row.drop('geometry').to_dict()
-                properties['area_in_meters'] = new_area
-                properties['full_plus_code'] = new_plus_code
-
-                # Append to the output GeoDataFrame
-                output_gdf = pd.concat(
-                    [
-                        output_gdf,
-                        gpd.GeoDataFrame([properties], geometry=[polygon], crs=gdf.crs),
-                    ],
-                    ignore_index=True,
-                )
+    if verbose:
+        print(f"Output rows: {sum(rows)} in {len(rows)} chunks of up to {chunk_size} input rows")
 
-                # Print the new Polygon
-                feature = {
-                    "type": "Feature",
-                    "properties": properties,
-                    "geometry": polygon.__geo_interface__,
-                }
-                if verbose:
-                    print("Component Polygon:")
-                    print(json.dumps(feature))
-
-        print(f"Processed {multipolygon_count} multipolygons.")
-        # Add the original Polygons to the output
-        polygons = gdf[gdf.geometry.type == 'Polygon']
-        output_gdf = pd.concat([output_gdf, polygons], ignore_index=True)
-    else:
-        output_gdf = gdf
+
+def process_with_pandas(
+    input_file_path, split_multipolygons, verbose, format, output_file_path, chunk_size=None
+):
+    if chunk_size:
+        return process_with_pandas_chunked(
+            input_file_path, split_multipolygons, verbose, format, output_file_path, chunk_size
+        )
+
+    with phase('read'), span('read_csv', file=input_file_path) as s:
+        df = pd.read_csv(input_file_path)
+        df['geometry'] = df['geometry'].apply(wkt.loads)
+
+        # Drop the 'latitude' and 'longitude' columns
+        df = df.drop(['latitude', 'longitude'], axis=1)
+
+        # Convert the DataFrame to a GeoDataFrame
+        gdf = gpd.GeoDataFrame(df, geometry='geometry')
+        gdf.set_crs("EPSG:4326", inplace=True)
+        s.set(rows=len(gdf))
+
+    with phase('transform'):
+        if split_multipolygons:
+            with span('split_multis') as s:
+                output_gdf = split_multipolygons_gdf(gdf, verbose)
+                s.set(rows=len(output_gdf))
+        else:
+            output_gdf = gdf
 
     if verbose:
         # Print the number of original rows in the datafram, and the number of rows in the output
@@ -293,15 +360,17 @@ def process_with_pandas(
         print(
             f"Output polygons: {len(output_gdf[output_gdf.geometry.type == 'Polygon'])}"
         )
-    # Write the output GeoDataFrame to a file
-    if format == 'fgb':
-        output_gdf.to_file(output_file_path, driver="FlatGeobuf")
-    elif format == 'parquet':
-        output_gdf.to_parquet(output_file_path, compression=PARQUET_COMPRESSION)
-    elif format == 'gpkg':
-        output_gdf.to_file(output_file_path, driver='GPKG')
-    elif format == 'shp':
-        output_gdf.to_file(output_file_path, driver='ESRI Shapefile')
+    with phase('write'), span(f'write_{format}', file=output_file_path) as s:
+        # Write the output GeoDataFrame to a file
+        if format == 'fgb':
+            output_gdf.to_file(output_file_path, driver="FlatGeobuf")
+        elif format == 'parquet':
+            output_gdf.to_parquet(output_file_path, compression=PARQUET_COMPRESSION)
+        elif format == 'gpkg':
+            output_gdf.to_file(output_file_path, driver='GPKG')
+        elif format == 'shp':
+            output_gdf.to_file(output_file_path, driver='ESRI Shapefile')
+        s.set(rows=len(output_gdf), bytes=output_size(output_file_path))
 
 
 def process_with_ogr2ogr(
@@ -348,7 +417,9 @@ def process_with_ogr2ogr(
         print(' '.join(cmd))
 
     # Run the command
-    subprocess.run(cmd, check=True)
+    with span('ogr2ogr', file=output_file_path) as s:
+        subprocess.run(cmd, check=True)
+        s.set(bytes=output_size(output_file_path))
 
     if verbose:
         print(f"Converted {input_file_path} to {output_file_path} using ogr2ogr.")
@@ -362,6 +433,8 @@ def process_csv_file(
     process,
     split_multipolygons,
     verbose,
+    geo_conversion=DEFAULT_GEO_CONVERSION,
+    chunk_size=None,
 ):
     output_file_path, duckdb_file_path = define_output_paths(
         input_file_path, output_directory, format
@@ -370,7 +443,7 @@ def process_csv_file(
 
     if os.path.exists(output_file_path):
         print(f'Skipping {input_file_path} as {output_file_path} already exists.')
-        return
+        return {'file': input_file_path, 'output': output_file_path, 'seconds': 0.0, 'skipped': True}
     else:
         print(
             f'Started converting {input_file_path} with {process} to {format} at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}...'
@@ -386,10 +459,11 @@ def process_csv_file(
             verbose,
             format,
             output_file_path,
+            geo_conversion,
         )
     elif process == 'pandas':
         process_with_pandas(
-            input_file_path, split_multipolygons, verbose, format, output_file_path
+            input_file_path, split_multipolygons, verbose, format, output_file_path, chunk_size
         )
     elif process == 'ogr':
         process_with_ogr2ogr(
@@ -400,6 +474,99 @@ def process_csv_file(
     print(
         f'Finished processing {output_file_path} at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}. Execution time: {str(timedelta(seconds=execution_time))}'
     )
+    return {'file': input_file_path, 'output': output_file_path, 'seconds': execution_time, 'skipped': False}
+
+
+def estimate_conversion_memory(input_file_path, process):
+    factor = PANDAS_MEMORY_FACTOR if process == 'pandas' else DUCKDB_MEMORY_FACTOR
+    return os.path.getsize(input_file_path) * factor
+
+
+def next_file_to_start(pending, running, estimates, memory_budget):
+    """Returns the first (biggest) pending file whose memory estimate fits alongside the
+    running files, or None if none fit. A file bigger than the whole budget still runs,
+    just on its own."""
+    if memory_budget is None or not running:
+        return pending[0] if pending else None
+    in_use = sum(estimates[f] for f in running)
+    for f in pending:
+        if in_use + estimates[f] <= memory_budget:
+            return f
+    return None
+
+
+def process_csv_files_parallel(
+    csv_files,
+    output_directory,
+    format,
+    overwrite,
+    process,
+    split_multipolygons,
+    verbose,
+    geo_conversion,
+    jobs,
+    memory_budget=None,
+    chunk_size=None,
+):
+    # Biggest files first, so a large one doesn't start last and hold up the end of the run.
+    pending = sorted(csv_files, key=os.path.getsize, reverse=True)
+    estimates = {f: estimate_conversion_memory(f, process) for f in pending}
+    results = []
+    running = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            while pending and len(running) < jobs:
+                input_file_path = next_file_to_start(pending, running.values(), estimates, memory_budget)
+                if input_file_path is None:
+                    break
+                pending.remove(input_file_path)
+                # Through profiling.call, so a --profile run gets the worker's spans back too.
+                future = executor.submit(
+                    profiling.call,
+                    profiling.settings(),
+                    process_csv_file,
+                    input_file_path,
+                    output_directory,
+                    format,
+                    overwrite,
+                    process,
+                    split_multipolygons,
+                    verbose,
+                    geo_conversion,
+                    chunk_size,
+                )
+                running[future] = input_file_path
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                result = profiling.merge(future.result())
+                results.append(result)
+                status = 'skipped' if result['skipped'] else f"{result['seconds']:.2f}s"
+                print(
+                    f'[{len(results)}/{len(csv_files)}] {os.path.basename(result["file"])}: {status}, '
+                    f'{len(running)} running, {len(pending)} waiting'
+                )
+
+    print_conversion_summary(results, time.perf_counter() - start)
+    return results
+
+
+def print_conversion_summary(results, elapsed):
+    if not results:
+        return
+    results = sorted(results, key=lambda r: r['seconds'], reverse=True)
+    table = [
+        [
+            os.path.basename(r['file']),
+            f"{os.path.getsize(r['file']) / 1e6:.1f}",
+            'skipped' if r['skipped'] else f"{r['seconds']:.2f}",
+        ]
+        for r in results
+    ]
+    print(tabulate(table, headers=['file', 'size (MB)', 'time (s)'], tablefmt="simple"))
+    print(f"Converted {len(results)} files in {elapsed:.2f} seconds")
 
 
 def process_geometries(
@@ -410,12 +577,31 @@ def process_geometries(
     process,
     split_multipolygons,
     verbose,
+    geo_conversion=DEFAULT_GEO_CONVERSION,
+    jobs=1,
+    memory_budget=None,
+    chunk_size=None,
 ):
     # Check if the provided path is a directory or a file
     if os.path.isdir(input_path):
         # List all csv files in the directory
         csv_files = glob.glob(os.path.join(input_path, '*.csv'))
 
+        if jobs > 1:
+            return process_csv_files_parallel(
+                csv_files,
+                output_directory,
+                format,
+                overwrite,
+                process,
+                split_multipolygons,
+                verbose,
+                geo_conversion,
+                jobs,
+                memory_budget,
+                chunk_size,
+            )
+
         # Sort files by size in ascending order
         csv_files.sort(key=lambda x: os.path.getsize(x))
 
@@ -429,6 +615,8 @@ def process_geometries(
                 process,
                 split_multipolygons,
                 verbose,
+                geo_conversion,
+                chunk_size,
             )
     elif os.path.isfile(input_path) and input_path.endswith('.csv'):
         # Process the single csv file
@@ -440,39 +628,85 @@ def process_geometries(
             process,
             split_multipolygons,
             verbose,
+            geo_conversion,
+            chunk_size,
         )
     else:
         raise ValueError(f"Invalid input path: {input_path}")
 
 
+def output_size(output_file_path):
+    """Size in bytes of an output, including the sidecar files of a shapefile."""
+    if not output_file_path.endswith('.shp'):
+        return os.path.getsize(output_file_path) if os.path.exists(output_file_path) else 0
+    base_name = output_file_path[:-4]
+    return sum(os.path.getsize(base_name + ext) for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg') if os.path.exists(base_name + ext))
+
+
+def run_benchmark_cell(
+    input_path,
+    output_directory,
+    process,
+    format,
+    split_multipolygons,
+    verbose,
+    geo_conversion=DEFAULT_GEO_CONVERSION,
+):
+    """One measured benchmark run: converts input_path with process to format, timing only
+    the conversion. Module level so that it can be run in a fresh process."""
+    if os.path.isdir(input_path):
+        csv_files = glob.glob(os.path.join(input_path, '*.csv'))
+    else:
+        csv_files = [input_path]
+    outputs = [define_output_paths(f, output_directory, format) for f in csv_files]
+    # Clear out the previous run's outputs before the clock starts.
+    for output_file_path, duckdb_file_path in outputs:
+        remove_existing_files(output_file_path, duckdb_file_path, True)
+
+    result = measure(
+        process_geometries,
+        input_path,
+        output_directory,
+        format,
+        False,
+        process,
+        split_multipolygons,
+        verbose,
+        geo_conversion,
+    )
+    result['output_bytes'] = sum(output_size(output_file_path) for output_file_path, _ in outputs)
+    return result
+
+
 def process_benchmark(
-    input_path, output_directory, processes, formats, split_multipolygons, verbose
+    input_path,
+    output_directory,
+    processes,
+    formats,
+    split_multipolygons,
+    verbose,
+    geo_conversion=DEFAULT_GEO_CONVERSION,
+    warmup=1,
+    repetitions=5,
 ):
     results = []
     for process in processes:
         for format in formats:
-            start_time = time.time()
-            process_geometries(
-                input_path,
-                output_directory,
-                format,
-                True,
-                process,
-                split_multipolygons,
-                verbose,
-            )
-            execution_time = time.time() - start_time
             if process == 'duckdb' and format == 'gpkg' and SKIP_DUCK_GPKG:
-                execution_time = 0
-            results.append(
-                {
-                    'process': process,
-                    'format': format,
-                    #'execution_time': str(timedelta(seconds=execution_time)),
-                    'execution_time': execution_time,
-                }
-            )
+                # Nothing gets written, so report it as missing rather than as instant.
+                print(f'Skipping duckdb to gpkg, since SKIP_DUCK_GPKG is set to True.')
+                result = skipped_cell()
+            else:
+                print(f'Benchmarking {process} to {format}: {warmup} warmup and {repetitions} measured runs...')
+                result = run_cell(
+                    run_benchmark_cell,
+                    (input_path, output_directory, process, format, split_multipolygons, verbose, geo_conversion),
+                    warmup,
+                    repetitions,
+                )
+            results.append({'process': process, 'format': format, 'execution_time': result['median'], **result})
     return results
 
+
 if __name__ == "__main__":
     cli()
@@ -1,65 +1,100 @@
 # This script is used to take an Overture Parquet file and add columns
 # useful for partitioning - it can put in both a quadkey and the country
-# ISO code. And then it will write out parquet and use gpq to convert the
-# parquet to geoparquet.
+# ISO code. And then it will write out GeoParquet, either directly (native) or
+# by writing parquet and using gpq to convert the parquet to geoparquet.
+# By default the columns are computed in a single query from the input file to
+# the output, in an in-memory DuckDB. With keep_duckdb the buildings are instead
+# loaded into a DuckDB database per file, which is kept.
+# A folder of files is processed in parallel, and each output is written under a
+# .partial name and renamed when done. A ledger in the output folder records the
+# files completed, with checksums, so an interrupted run can pick up where it stopped.
 
 
 import os
-import duckdb
+import re
+import json
+import hashlib
 import time
 import tempfile
 import subprocess
 import glob
-from duckdb.typing import *
-import mercantile
 import shutil
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from open_buildings import profiling
+from open_buildings.connection import connect
+from open_buildings.quadkey import register_quadkey_function
+from open_buildings.countries import CountryIndex, register_country_function
+from open_buildings.geoparquet import write_query_to_geoparquet
+from open_buildings.profiling import execute, span
 
-def lat_lon_to_quadkey(lat: DOUBLE, lon: DOUBLE, level: INTEGER) -> VARCHAR:
-    # Convert latitude and longitude to tile using mercantile
-    tile = mercantile.tile(lon, lat, level)
-    
-    # Convert the tile to a quadkey
-    quadKey = mercantile.quadkey(tile)
-    return quadKey
+# Outputs are written under this suffix and renamed when complete.
+PARTIAL_SUFFIX = '.partial'
+
+# The batch driver's record of the files it has completed, in the output folder.
+LEDGER_NAME = 'add_columns_ledger.jsonl'
+
+# Memory to plan on for each worker when there's no memory limit.
+WORKER_MEMORY = 4 * 2**30
 
-def midpoint(minval: DOUBLE, maxval: DOUBLE) -> DOUBLE:
-    return (minval + maxval) / 2.0
+MEMORY_UNITS = {
+    'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
+    'KIB': 2**10, 'MIB': 2**20, 'GIB': 2**30, 'TIB': 2**40,
+}
 
 def add_quadkey(con):
 
-    # Register Python UDFs
-    con.create_function('lat_lon_to_quadkey', lat_lon_to_quadkey, [DOUBLE, DOUBLE, INTEGER], VARCHAR)
-    con.create_function('midpoint', midpoint, [DOUBLE, DOUBLE], DOUBLE)
+    # Register the vectorized quadkey function, which DuckDB calls once per vector of rows
+    register_quadkey_function(con)
 
     # Add a quadkey column to the table if it doesn't exist
     con.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS quadkey VARCHAR")
 
-    # Update the quadkey column
-    con.execute("""
+    # Update the quadkey column, using the midpoint of the bbox struct
+    execute(con, """
     UPDATE buildings 
     SET quadkey = lat_lon_to_quadkey(
-        midpoint(bbox.miny, bbox.maxy), 
-        midpoint(bbox.minx, bbox.maxx), 
+        (bbox.miny + bbox.maxy) / 2.0, 
+        (bbox.minx + bbox.maxx) / 2.0, 
         12
     );
-    """)
+    """, 'add_quadkey')
 
-def add_country_iso(con, country_parquet_path):
-    # Load country parquet file into duckdb
-    con.execute(f"CREATE TABLE countries AS SELECT * FROM read_parquet('{country_parquet_path}')")
+def add_country_iso(con, country_parquet_path, coverage_path=None):
+    # Index the country polygons in an STRtree, so each building is only tested
+    # against the countries whose bounding box it touches. With a coverage table
+    # buildings in tiles entirely inside one country skip the geometry test.
+    with span('load_countries', file=country_parquet_path):
+        register_country_function(con, CountryIndex.from_parquet(country_parquet_path, coverage_path=coverage_path))
 
     # Add a country_iso column to the buildings table
     con.execute("ALTER TABLE buildings ADD COLUMN IF NOT EXISTS country_iso VARCHAR")
     
     # Update the country_iso column in the buildings table
-    con.execute("""
+    execute(con, """
     UPDATE buildings 
-    SET country_iso = countries.isocountrycodealpha2 
-    FROM countries 
-    WHERE ST_Intersects(ST_GeomFromWKB(countries.geometry), ST_GeomFromWKB(buildings.geometry))
-    """)
+    SET country_iso = country_iso_for(geometry)
+    """, 'country_join')
 
-def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, verbose=False):
+def add_columns_query(input_parquet_path, add_quadkey_option, add_country_iso_option):
+    """A single SELECT that reads the input Parquet and computes the new columns as it goes,
+    ordered by quadkey when there is one. Columns already in the input get replaced."""
+    input_columns = pq.read_schema(input_parquet_path).names
+    new_columns = {}
+    if add_quadkey_option:
+        new_columns['quadkey'] = "lat_lon_to_quadkey((bbox.miny + bbox.maxy) / 2.0, (bbox.minx + bbox.maxx) / 2.0, 12)"
+    if add_country_iso_option:
+        new_columns['country_iso'] = "country_iso_for(geometry)"
+
+    replaced = [f"{expression} AS {name}" for name, expression in new_columns.items() if name in input_columns]
+    added = [f"{expression} AS {name}" for name, expression in new_columns.items() if name not in input_columns]
+    select = f"* REPLACE ({', '.join(replaced)})" if replaced else "*"
+    query = f"SELECT {', '.join([select] + added)} FROM read_parquet('{input_parquet_path}')"
+    if 'quadkey' in input_columns or add_quadkey_option:
+        query += " ORDER BY quadkey"
+    return query
+
+def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, verbose=False, coverage_path=None, geo_conversion='gpq', keep_duckdb=False, memory_limit=None, temp_directory=None, threads=None):
     # Ensure output_folder exists
     os.makedirs(output_folder, exist_ok=True)
     
@@ -70,60 +105,252 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     output_db_path = os.path.join(output_folder, f'{unique_id}.duckdb')
     output_parquet_path = os.path.join(output_folder, f'{unique_id}.parquet')
     
-    # Check if output files exist
-    if (os.path.exists(output_db_path) or os.path.exists(output_parquet_path)) and not overwrite:
+    # Everything is written to a partial file and renamed to the output at the end, so an
+    # output that exists is always complete.
+    partial_parquet_path = output_parquet_path + PARTIAL_SUFFIX
+
+    # Check if the output file exists
+    if os.path.exists(output_parquet_path) and not overwrite:
         print(f'Files with ID {unique_id} already exist. Skipping...')
-        return
+        return None
     
-    # Overwrite mode: remove existing files
-    if overwrite:
-        for file_path in [output_db_path, output_parquet_path]:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+    # Remove existing files, and anything left by a run that didn't finish
+    for file_path in [output_db_path, output_parquet_path, partial_parquet_path]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
     timestamp = time.time()
     print(f"Starting processing for file {input_parquet_path} at {time.ctime(timestamp)}")
     
-    # Connect to DuckDB
-    con = duckdb.connect(output_db_path)
-    
-    con.execute('LOAD spatial;')
+    settings = dict(memory_limit=memory_limit, temp_directory=temp_directory, threads=threads)
+    if keep_duckdb:
+        # Materialize the buildings in a DuckDB database next to the output, add the columns
+        # with an UPDATE each, and keep the database around (for partition to read).
+        con = connect(output_db_path, **settings)
 
-    # Load parquet file into duckdb
-    con.execute(f"CREATE TABLE buildings AS SELECT * FROM read_parquet('{input_parquet_path}')")
-    
-    if add_quadkey_option:
-        add_quadkey(con)
+        # Load parquet file into duckdb
+        execute(con, f"CREATE TABLE buildings AS SELECT * FROM read_parquet('{input_parquet_path}')", 'read_parquet', file=input_parquet_path)
+        
+        if add_quadkey_option:
+            add_quadkey(con)
 
-    if add_country_iso_option:
-        add_country_iso(con, country_parquet_path)
+        if add_country_iso_option:
+            add_country_iso(con, country_parquet_path, coverage_path)
 
-    # Write out to Parquet
-    con.execute(f"COPY (SELECT * FROM buildings ORDER BY quadkey) TO '{output_parquet_path}' WITH (FORMAT Parquet)")
-    
-    #TODO: turn this into an option to convert to geoparquet or not
-    if (True):
+        query = "SELECT * FROM buildings ORDER BY quadkey"
+    else:
+        # Compute the columns in one query straight from the input file to the output, so the
+        # data is read once and written once. Only the sort has to hold on to rows, and past
+        # the memory limit DuckDB spills it to the temp directory.
+        # The new columns come from Python functions, so no extensions are needed.
+        con = connect(extensions=(), **settings)
+        if add_quadkey_option:
+            register_quadkey_function(con)
+        if add_country_iso_option:
+            with span('load_countries', file=country_parquet_path):
+                register_country_function(con, CountryIndex.from_parquet(country_parquet_path, coverage_path=coverage_path))
+        query = add_columns_query(input_parquet_path, add_quadkey_option, add_country_iso_option)
+        if verbose:
+            print(f"Streaming: {query}")
+
+    if geo_conversion == 'native':
+        # Write GeoParquet directly, so the file only gets written once
+        print(f"Writing geoparquet: {output_parquet_path}")
+        with span('write_geoparquet', file=output_parquet_path) as s:
+            s.set(rows=write_query_to_geoparquet(con, query, partial_parquet_path), bytes=os.path.getsize(partial_parquet_path))
+    else:
+        # Write out to Parquet
+        execute(con, f"COPY ({query}) TO '{partial_parquet_path}' WITH (FORMAT Parquet)", 'copy_to_parquet', file=output_parquet_path)
+    con.close()
+
+    if geo_conversion == 'gpq':
         print(f"Converting to geoparquet: {output_parquet_path}")
         # Create a temporary file
         temp_file = tempfile.NamedTemporaryFile(suffix=".parquet", delete=False)
         temp_file.close()  # Close the file so gpq can open it
 
         # Convert the Parquet file to a GeoParquet file using gpq
-        gpq_cmd = ['gpq', 'convert', f'{output_parquet_path}', temp_file.name]
-        subprocess.run(gpq_cmd, check=True)
+        gpq_cmd = ['gpq', 'convert', f'{partial_parquet_path}', temp_file.name]
+        with span('gpq_convert', file=output_parquet_path) as s:
+            subprocess.run(gpq_cmd, check=True)
 
-        # Rename the temp file to the final filename
-        shutil.move(temp_file.name, f'{output_parquet_path}')
-        #os.rename(temp_file.name, f'{output_parquet_path}')
+            # Move the temp file back over the partial file
+            shutil.move(temp_file.name, partial_parquet_path)
+            s.set(bytes=os.path.getsize(partial_parquet_path))
 
+    os.replace(partial_parquet_path, output_parquet_path)
     print(f"Processing complete for file {input_parquet_path}")
+    return output_parquet_path
 
-def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, verbose=False):
-    # If input_path is a directory, process all Parquet files in it
+def parse_memory_limit(memory_limit):
+    """Bytes in a DuckDB style memory limit, like 4GB or 500MiB."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]i?B|B)?\s*', memory_limit, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory limit: {memory_limit}")
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_UNITS[(unit or 'B').upper()])
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def worker_settings(jobs=None, memory_limit=None, threads=None):
+    """How many files to process at once, and the DuckDB memory limit and threads of each.
+    Without jobs there is a worker per core, as long as each one gets its memory limit (or
+    WORKER_MEMORY without one) out of 80% of the machine's memory, which is what DuckDB
+    would take for a single connection. The cores and memory are then split between them."""
+    cpus = os.cpu_count() or 1
+    memory = total_memory()
+    usable_memory = int(memory * 0.8) if memory else None
+    if jobs is None:
+        jobs = cpus
+        if usable_memory:
+            per_worker = parse_memory_limit(memory_limit) if memory_limit else WORKER_MEMORY
+            jobs = max(1, min(jobs, usable_memory // per_worker))
+    if memory_limit is None and usable_memory and jobs > 1:
+        memory_limit = f"{usable_memory // jobs // 2**20}MiB"
+    if threads is None and jobs > 1:
+        threads = max(1, cpus // jobs)
+    return jobs, memory_limit, threads
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def ledger_path(output_folder):
+    return os.path.join(output_folder, LEDGER_NAME)
+
+def load_ledger(output_folder):
+    """The completed files recorded in the output folder's ledger, by input file name. The
+    ledger is a line of JSON per completed file, so a line cut off by a crash is just ignored."""
+    entries = {}
+    path = ledger_path(output_folder)
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry['input']] = entry
+    return entries
+
+def record_completed(output_folder, entry):
+    with open(ledger_path(output_folder), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def is_completed(entry, input_parquet_path, output_folder, verify=False):
+    """Whether a ledger entry still stands for the input file: the input hasn't changed since,
+    and the output is still there at the same size (and with verify, the same checksum)."""
+    if entry is None:
+        return False
+    stat = os.stat(input_parquet_path)
+    if entry['input_size'] != stat.st_size or entry['input_mtime'] != stat.st_mtime:
+        return False
+    output = os.path.join(output_folder, entry['output'])
+    if not os.path.exists(output) or os.path.getsize(output) != entry['output_size']:
+        return False
+    return not verify or file_checksum(output) == entry['checksum']
+
+def process_ledger_file(input_parquet_path, output_folder, country_parquet_path, add_quadkey_option, add_country_iso_option, verbose, coverage_path, geo_conversion, keep_duckdb, memory_limit, temp_directory, threads):
+    """Processes a file for the batch driver, returning its ledger entry."""
+    start = time.perf_counter()
+    # Outputs that aren't in the ledger are redone, as nothing says they're complete.
+    output_parquet_path = process_parquet_file(
+        input_parquet_path, output_folder, country_parquet_path, True, add_quadkey_option, add_country_iso_option,
+        verbose, coverage_path, geo_conversion, keep_duckdb, memory_limit, temp_directory, threads,
+    )
+    stat = os.stat(input_parquet_path)
+    return {
+        'input': os.path.basename(input_parquet_path),
+        'input_size': stat.st_size,
+        'input_mtime': stat.st_mtime,
+        'output': os.path.basename(output_parquet_path),
+        'output_size': os.path.getsize(output_parquet_path),
+        'checksum': file_checksum(output_parquet_path),
+        'seconds': time.perf_counter() - start,
+    }
+
+def run_ledger_files(files, jobs, args):
+    """Yields (file, ledger entry, error) for each file, with error set to the exception instead
+    of an entry when it failed. One job runs in this process."""
+    if jobs == 1:
+        for file in files:
+            try:
+                yield file, process_ledger_file(file, *args), None
+            except Exception as e:
+                yield file, None, e
+        return
+    # A new pool each round, so a worker that died (and broke the pool) doesn't stop the retries.
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(profiling.call, profiling.settings(), process_ledger_file, file, *args): file for file in files}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], profiling.merge(future.result()), None
+            except Exception as e:
+                yield futures[future], None, e
+
+def process_parquet_files_parallel(input_files, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, verbose=False, coverage_path=None, geo_conversion='gpq', keep_duckdb=False, memory_limit=None, temp_directory=None, threads=None, jobs=None, retries=2, verify=False):
+    """Processes the files in a pool of workers, recording each one completed in a ledger in the
+    output folder. A rerun skips the files in the ledger, unless overwrite, and redoes anything
+    else. Files that fail are retried up to retries times. Returns the files that still failed."""
+    os.makedirs(output_folder, exist_ok=True)
+    jobs, memory_limit, threads = worker_settings(jobs, memory_limit, threads)
+    if overwrite and os.path.exists(ledger_path(output_folder)):
+        os.remove(ledger_path(output_folder))
+    ledger = load_ledger(output_folder)
+
+    pending = [f for f in input_files if not is_completed(ledger.get(os.path.basename(f)), f, output_folder, verify)]
+    print(f"{len(input_files) - len(pending)} of {len(input_files)} files already done, processing {len(pending)} "
+          f"with {jobs} workers (memory limit {memory_limit or 'default'}, threads {threads or 'default'})")
+    # Biggest files first, so a large one doesn't start last and hold up the end of the run.
+    pending.sort(key=os.path.getsize, reverse=True)
+
+    args = (output_folder, country_parquet_path, add_quadkey_option, add_country_iso_option, verbose, coverage_path,
+            geo_conversion, keep_duckdb, memory_limit, temp_directory, threads)
+    start = time.perf_counter()
+    done = 0
+    errors = {}
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            print(f"Retrying {len(pending)} failed files (attempt {attempt + 1} of {retries + 1})")
+        failed = []
+        for file, entry, error in run_ledger_files(pending, min(jobs, len(pending)), args):
+            if error is not None:
+                print(f"Failed to process {file}: {error}")
+                errors[file] = error
+                failed.append(file)
+                continue
+            record_completed(output_folder, entry)
+            errors.pop(file, None)
+            done += 1
+            print(f"[{done}/{len(input_files)}] {entry['input']}: {entry['seconds']:.2f}s")
+        pending = failed
+
+    print(f"Processed {done} files in {time.perf_counter() - start:.2f} seconds")
+    for file in pending:
+        print(f"Gave up on {file} after {retries + 1} attempts: {errors[file]}")
+    return pending
+
+def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, verbose=False, coverage_path=None, geo_conversion='gpq', keep_duckdb=False, memory_limit=None, temp_directory=None, threads=None, jobs=None, retries=2, verify=False):
+    # If input_path is a directory, process all Parquet files in it with the batch driver
     if os.path.isdir(input_path):
-        for file in glob.glob(os.path.join(input_path, "*")):
-            process_parquet_file(file, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, verbose)
-    else:
-        process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, verbose)
+        input_files = sorted(f for f in glob.glob(os.path.join(input_path, "*")) if os.path.isfile(f))
+        return process_parquet_files_parallel(
+            input_files, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, verbose,
+            coverage_path, geo_conversion, keep_duckdb, memory_limit, temp_directory, threads, jobs, retries, verify,
+        )
+    process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, verbose, coverage_path, geo_conversion, keep_duckdb, memory_limit, temp_directory, threads)
+    return []
 
 # Call the function - uncomment if you want to call this directly from python and put values in here.
 #input_path = '/Volumes/fastdata/overture/s3-data/buildings/'
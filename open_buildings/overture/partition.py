@@ -9,19 +9,34 @@ If the number of rows for a country is greater than the maximum number of rows p
 it will partition the country into quadkeys and create GeoParquet files for each quadkey.
 Those quadkeys will be further partitioned if necessary until the number of rows for a
 quadkey is less than or equal to the maximum number of rows per file. 
+
+The split is planned up front from a single GROUP BY of row counts per country and quadkey,
+rather than a DISTINCT and COUNT query per candidate prefix. The rows are then read in one
+scan sorted by partition and streamed out, with a new file started wherever the partition
+changes. With more than one worker the planned files are instead handed out, in runs of
+consecutive files, to a pool of processes, each with its own read-only connection, that
+stream and convert their run independently, so the GeoParquet conversion of one file
+overlaps with the writing of others.
 """
 
-import duckdb
 import datetime
 import subprocess
 import tempfile
 import os
 import click
 import shutil
-import geopandas as gpd
-from shapely import wkb
-import pandas as pd
 import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tabulate import tabulate
+from open_buildings.connection import connect
+from open_buildings.partitions import write_manifest
+from open_buildings.geoparquet import BATCH_SIZE, GeoParquetWriter, convert_parquet_to_geoparquet
+from open_buildings import profiling
+from open_buildings.profiling import execute, span
 
 def current_time_str():
     return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -52,22 +67,11 @@ def convert_gpq(input_filename, row_group_size, verbose):
     #    os.remove(initial_temp_filename)
 
 def convert_pandas(input_filename, rg_size, verbose):
-    # Placeholder function to be fleshed out
-    print_verbose("Starting conversion using pandas.", verbose)
+    # Streams the file through a row group at a time, keeping the geometry as WKB, so a
+    # big country file doesn't have to fit in memory as shapely objects.
+    print_verbose("Starting conversion to GeoParquet.", verbose)
     try:
-        df = pd.read_parquet(input_filename)
-
-        # Convert WKB geometry to geopandas geometry
-        df['geometry'] = df['geometry'].apply(wkb.loads, hex=True)
-        gdf = gpd.GeoDataFrame(df, geometry='geometry', crs="EPSG:4326")
-        # Change output file the input_filename with .parquet replaced with _geo.parquet
-        output_filename = input_filename.replace(".parquet", "_geo.parquet")
-    
-        gdf.to_parquet(output_filename, row_group_size=rg_size)
-        # delete the original file
-        os.remove(input_filename)
-        # Rename (move) the output file to the input filename
-        shutil.move(output_filename, input_filename)
+        convert_parquet_to_geoparquet(input_filename, row_group_size=rg_size)
         print(f"Finished processing {input_filename} at {time.ctime()}")
     except Exception as e:
         print(f"Error processing {input_filename}: {e}")
@@ -108,83 +112,250 @@ def convert_ogr(input_filename, rg_size, verbose):
 
  
 
-def fetch_quadkeys(conn, table_name, country_code, length, verbose, prev_qk=""):
-    query = f"SELECT DISTINCT SUBSTR(quadkey, 1, {length}) FROM {table_name} WHERE country_iso = '{country_code}'"
-    if prev_qk:
-        query += f" AND SUBSTR(quadkey, 1, {len(prev_qk)}) = '{prev_qk}'"
-    print_verbose(f'Executing: {query}', verbose)
-    return conn.execute(query).fetchall()
-
 def convert_to_geoparquet(parquet_path, geo_conversion, row_group_size, verbose):
     if geo_conversion == 'gpq':
-        convert_gpq(parquet_path, row_group_size, verbose)
+        with span('gpq_convert', file=parquet_path) as s:
+            convert_gpq(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with gpq", verbose)
     elif geo_conversion == 'pandas':
-        convert_pandas(parquet_path, row_group_size, verbose)
+        with span('pandas_convert', file=parquet_path) as s:
+            convert_pandas(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with pandas", verbose)
     elif geo_conversion == 'ogr':
-        convert_ogr(parquet_path, row_group_size, verbose)
+        with span('ogr_convert', file=parquet_path) as s:
+            convert_ogr(parquet_path, row_group_size, verbose)
+            s.set(bytes=os.path.getsize(parquet_path))
         print_verbose(f"File: {parquet_path} written with ogr", verbose)
+    elif geo_conversion == 'native':
+        print_verbose(f"File: {parquet_path} written directly as GeoParquet", verbose)
     else:
         print_verbose(f"File: {parquet_path} written without converting to GeoParquet", verbose)
 
-#TODO: go all the way into the quad to find the smallest quadkey that contains less than max_per_file rows
-def process_quadkey_recursive(conn, table_name, country_code, output_folder, length, geo_conversion, row_group_size, verbose, max_per_file, current_qk=""):
-    distinct_quadkeys = fetch_quadkeys(conn, table_name, country_code, length, verbose, current_qk)
-    print_verbose(f"The list of quadkeys for country {country_code} and length {length} is {distinct_quadkeys}", verbose)
-    #num_distinct_qk = len(distinct_quadkeys)
-    for qk in distinct_quadkeys:
-        qk_str = qk[0]
-        qk_count_query = f"SELECT COUNT(*) FROM {table_name} WHERE country_iso = '{country_code}' AND SUBSTR(quadkey, 1, {length}) = '{qk_str}'"
-        print_verbose(f'Executing: {qk_count_query}', verbose)
-        qk_count = conn.execute(qk_count_query).fetchone()[0]
-        print_verbose(f"Quadkey {qk_str} has {qk_count} rows", verbose)
-        if qk_count > max_per_file:
-            process_quadkey_recursive(conn, table_name, country_code, output_folder, length + 1, geo_conversion, row_group_size, verbose, max_per_file, qk_str)
+def fetch_histogram(conn, table_name, verbose):
+    # One pass over the table gives the row count of every zoom 12 quadkey in every country,
+    # which is all that's needed to plan the whole split.
+    query = f"SELECT country_iso, quadkey, COUNT(*) FROM {table_name} WHERE country_iso IS NOT NULL GROUP BY country_iso, quadkey"
+    print_verbose(f'Executing: {query}', verbose)
+    histogram = defaultdict(dict)
+    for country_code, quadkey, count in execute(conn, query, 'partition_histogram').fetchall():
+        histogram[country_code][quadkey] = count
+    return histogram
+
+def split_quadkeys(quadkey_counts, length, max_per_file):
+    """Splits a set of quadkey counts by prefix, going one level deeper for any prefix with more
+    than max_per_file rows. Yields (prefix, quadkeys, row count) for each file."""
+    groups = defaultdict(dict)
+    for quadkey, count in quadkey_counts.items():
+        # rows without a quadkey can't be put in a quadkey file
+        if quadkey is not None:
+            groups[quadkey[:length]][quadkey] = count
+    for prefix in sorted(groups):
+        group = groups[prefix]
+        count = sum(group.values())
+        # stop once the prefix is the whole quadkey, even if that one tile is over the limit
+        if count > max_per_file and any(len(qk) > length for qk in group):
+            yield from split_quadkeys(group, length + 1, max_per_file)
         else:
-            quad_output_filename = os.path.join(output_folder, f'{country_code}_{qk_str}.parquet')
-            if os.path.exists(quad_output_filename):
-                print_verbose(f"Output file {quad_output_filename} already exists, skipping...", verbose)
-            else:
-                copy_cmd = f"COPY (SELECT * FROM {table_name} WHERE country_iso = '{country_code}' AND SUBSTR(quadkey, 1, {length}) = '{qk_str}' ORDER BY quadkey) TO '{quad_output_filename}' WITH (FORMAT PARQUET);"
-                print_verbose(f'Executing: {copy_cmd}', verbose)
-                conn.execute(copy_cmd)
-                convert_to_geoparquet(quad_output_filename, geo_conversion, row_group_size, verbose)
+            yield prefix, list(group), count
 
+def plan_partitions(histogram, max_per_file, verbose):
+    """Returns a list of (country_code, quadkey prefix or None, quadkeys, row count), one per output file."""
+    partitions = []
+    for country_code in sorted(histogram):
+        quadkey_counts = histogram[country_code]
+        count = sum(quadkey_counts.values())
+        print_verbose(f"Country {country_code} has {count} rows", verbose)
+        if count <= max_per_file:
+            partitions.append((country_code, None, list(quadkey_counts), count))
+        else:
+            for prefix, quadkeys, qk_count in split_quadkeys(quadkey_counts, 1, max_per_file):
+                print_verbose(f"Quadkey {prefix} of country {country_code} has {qk_count} rows", verbose)
+                partitions.append((country_code, prefix, quadkeys, qk_count))
+    return partitions
 
-def process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name):
-    # create output folder if it does not exist
-    os.makedirs(output_folder, exist_ok=True)
-    conn = duckdb.connect(duckdb_path)
-    conn.execute('LOAD spatial;')
-    cursor = conn.execute(f'SELECT DISTINCT country_iso FROM {table_name}')
-    countries = cursor.fetchall()
-    
-    print_verbose(f'Found {len(countries)} unique countries', verbose)
-    #countries.reverse()
-    for country in countries:
-        country_code = country[0]
-        write_folder = output_folder
-        if (hive):
-            write_folder = os.path.join(output_folder, f'country_iso={country_code}')
-            os.makedirs(write_folder, exist_ok=True)
-        output_filename = os.path.join(write_folder, f'{country_code}.parquet')
+def partition_filename(output_folder, country_code, prefix, hive):
+    write_folder = output_folder
+    if (hive):
+        write_folder = os.path.join(output_folder, f'country_iso={country_code}')
+    name = f'{country_code}.parquet' if prefix is None else f'{country_code}_{prefix}.parquet'
+    return os.path.join(write_folder, name)
+
+def pending_jobs(partitions, output_folder, hive, verbose):
+    """Numbers the planned files in plan order, which is by country and then quadkey, and leaves out the
+    ones already written. Returns (partition_id, output filename, country_code, quadkeys, row count) for each."""
+    jobs = []
+    for partition_id, (country_code, prefix, quadkeys, count) in enumerate(partitions):
+        output_filename = partition_filename(output_folder, country_code, prefix, hive)
         if os.path.exists(output_filename):
-            print_verbose(f"Output file for country {country_code} already exists, skipping...", verbose)
+            print_verbose(f"Output file {output_filename} already exists, skipping...", verbose)
             continue
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        jobs.append((partition_id, output_filename, country_code, quadkeys, count))
+    return jobs
 
-        count_query = f"SELECT COUNT(*) FROM {table_name} WHERE country_iso = '{country_code}'"
-        print_verbose(f'Executing: {count_query}', verbose)
-        count = conn.execute(count_query).fetchone()[0]
-        print_verbose(f"Country {country_code} has {count} rows", verbose)
+def open_partition_file(output_filename, schema, geo_conversion, row_group_size):
+    # With native conversion the file is written as GeoParquet straight away, otherwise as plain
+    # Parquet that's converted once it's closed.
+    if geo_conversion == 'native':
+        return GeoParquetWriter(output_filename, schema, row_group_size=row_group_size)
+    return pq.ParquetWriter(output_filename, schema)
 
-        if count <= max_per_file:
-            copy_cmd = f"COPY (SELECT * FROM {table_name} WHERE country_iso = '{country_code}' ORDER BY quadkey) TO '{output_filename}' WITH (FORMAT PARQUET);"
-            print_verbose(f'Executing: {copy_cmd}', verbose)
-            conn.execute(copy_cmd)
-            convert_to_geoparquet(output_filename, geo_conversion, row_group_size, verbose)
-        else:
-            process_quadkey_recursive(conn, table_name, country_code, output_folder, 1, geo_conversion, row_group_size, verbose, max_per_file)
+def convert_partition_file(output_filename, rows, opened, geo_conversion, row_group_size, verbose):
+    written = time.perf_counter()
+    convert_to_geoparquet(output_filename, geo_conversion, row_group_size, verbose)
+    converted = time.perf_counter()
+    return {'file': output_filename, 'rows': rows, 'write_seconds': written - opened, 'convert_seconds': converted - written}
+
+def stream_partitions(conn, table_name, jobs, geo_conversion, row_group_size, verbose):
+    """Writes and converts the files of jobs from a single scan of the table, ordered by file and then
+    quadkey, starting the next file wherever the partition id changes. Returns the row count and
+    timings of each file."""
+    # Map every (country, quadkey) to the id of its file. Only the rows of these files make it
+    # through the join, and DuckDB passes the range of their keys down to the scan of the table.
+    plan_rows = [(country_code, quadkey, partition_id) for partition_id, _, country_code, quadkeys, _ in jobs for quadkey in quadkeys]
+    partition_plan = pa.table({
+        'country_iso': pa.array([r[0] for r in plan_rows], type=pa.string()),
+        'quadkey': pa.array([r[1] for r in plan_rows], type=pa.string()),
+        'partition_id': pa.array([r[2] for r in plan_rows], type=pa.int32()),
+    })
+    filenames = {partition_id: output_filename for partition_id, output_filename, _, _, _ in jobs}
+    query = f"""SELECT t.*, p.partition_id AS _partition_id FROM {table_name} t
+        JOIN partition_plan p ON t.country_iso = p.country_iso AND t.quadkey IS NOT DISTINCT FROM p.quadkey
+        ORDER BY _partition_id, t.quadkey"""
+    print_verbose(f'Executing: {query}', verbose)
+
+    # The sorted rows are streamed out of the query rather than kept in a second, sorted copy of
+    # the table, so only DuckDB's sort (which spills to disk when it has to) holds them.
+    conn.register('partition_plan', partition_plan)
+    results = []
+    writer = None
+    current = None
+    try:
+        with span('stream_partitions', files=len(jobs)) as s:
+            reader = conn.execute(query).fetch_record_batch(BATCH_SIZE)
+            schema = reader.schema.remove(reader.schema.get_field_index('_partition_id'))
+            for batch in reader:
+                if batch.num_rows == 0:
+                    continue
+                ids = batch.column('_partition_id').to_numpy()
+                cuts = [0, *(np.flatnonzero(ids[1:] != ids[:-1]) + 1), len(ids)]
+                rows = batch.drop_columns(['_partition_id'])
+                for begin, end in zip(cuts[:-1], cuts[1:]):
+                    if ids[begin] != current:
+                        if writer is not None:
+                            writer.close()
+                            writer = None
+                            results.append(convert_partition_file(filenames[current], written_rows, opened, geo_conversion, row_group_size, verbose))
+                        current = ids[begin]
+                        print_verbose(f'Writing {filenames[current]}', verbose)
+                        opened = time.perf_counter()
+                        writer = open_partition_file(filenames[current], schema, geo_conversion, row_group_size)
+                        written_rows = 0
+                    writer.write_batch(rows.slice(begin, end - begin))
+                    written_rows += end - begin
+            if writer is not None:
+                writer.close()
+                writer = None
+                results.append(convert_partition_file(filenames[current], written_rows, opened, geo_conversion, row_group_size, verbose))
+            s.set(rows=sum(r['rows'] for r in results))
+    except BaseException:
+        # Don't leave a partial or unconverted file behind for a rerun to skip as already written.
+        if writer is not None:
+            writer.close()
+        if current is not None and not (results and results[-1]['file'] == filenames[current]):
+            if os.path.exists(filenames[current]):
+                os.remove(filenames[current])
+        raise
+    finally:
+        conn.unregister('partition_plan')
+    return results
+
+def write_partitions(conn, table_name, partitions, output_folder, geo_conversion, row_group_size, verbose, hive):
+    jobs = pending_jobs(partitions, output_folder, hive, verbose)
+    if not jobs:
+        return []
+    return stream_partitions(conn, table_name, jobs, geo_conversion, row_group_size, verbose)
+
+def contiguous_chunks(jobs, chunks):
+    """Splits the jobs into about the given number of runs of consecutive files with similar row counts."""
+    target = sum(job[4] for job in jobs) / chunks
+    runs = [[]]
+    rows = 0
+    for job in jobs:
+        if runs[-1] and rows + job[4] > target:
+            runs.append([])
+            rows = 0
+        runs[-1].append(job)
+        rows += job[4]
+    return runs
+
+# Each worker process keeps its own read-only connection for all the files it writes.
+_worker_conn = None
+
+def init_worker(duckdb_path, threads):
+    global _worker_conn
+    _worker_conn = connect(duckdb_path, read_only=True, threads=threads)
+
+def run_worker_job(table_name, jobs, geo_conversion, row_group_size, verbose):
+    return stream_partitions(_worker_conn, table_name, jobs, geo_conversion, row_group_size, verbose)
+
+def write_partitions_parallel(duckdb_path, table_name, partitions, output_folder, geo_conversion, row_group_size, verbose, hive, workers):
+    jobs = pending_jobs(partitions, output_folder, hive, verbose)
+    # Each worker job is a run of consecutive files, streamed out of one ordered scan like write_partitions
+    # does for all of them. A few runs per worker keeps the workers busy to the end, and the biggest go
+    # first, so a large one doesn't start last and hold up the end of the run.
+    chunks = contiguous_chunks(jobs, workers * 4) if jobs else []
+    chunks.sort(key=lambda chunk: sum(job[4] for job in chunk), reverse=True)
+
+    # Split DuckDB's threads between the workers instead of each one using every core.
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(duckdb_path, threads)) as executor:
+        futures = [
+            executor.submit(profiling.call, profiling.settings(), run_worker_job, table_name, chunk, geo_conversion, row_group_size, verbose)
+            for chunk in chunks
+        ]
+        for future in as_completed(futures):
+            for result in profiling.merge(future.result()):
+                results.append(result)
+                print(f"[{current_time_str()}] [{len(results)}/{len(jobs)}] {os.path.basename(result['file'])}: {result['rows']} rows, "
+                      f"write {result['write_seconds']:.2f}s, convert {result['convert_seconds']:.2f}s")
+
+    print_partition_summary(results, time.perf_counter() - start)
+    return results
+
+def print_partition_summary(results, elapsed):
+    if not results:
+        return
+    results = sorted(results, key=lambda r: r['write_seconds'] + r['convert_seconds'], reverse=True)
+    table = [[os.path.basename(r['file']), r['rows'], f"{r['write_seconds']:.2f}", f"{r['convert_seconds']:.2f}",
+              f"{r['write_seconds'] + r['convert_seconds']:.2f}"] for r in results]
+    print(tabulate(table, headers=['file', 'rows', 'write (s)', 'convert (s)', 'total (s)'], tablefmt="simple"))
+    print(f"Wrote {len(results)} files in {elapsed:.2f} seconds")
+
+
+def process_db(duckdb_path, output_folder, geo_conversion, verbose, max_per_file, row_group_size, hive, table_name, workers=1):
+    # create output folder if it does not exist
+    os.makedirs(output_folder, exist_ok=True)
+    # with workers the database is opened read-only everywhere, so all the processes can share it
+    conn = connect(duckdb_path, read_only=workers > 1)
+    histogram = fetch_histogram(conn, table_name, verbose)
+    print_verbose(f'Found {len(histogram)} unique countries', verbose)
+
+    partitions = plan_partitions(histogram, max_per_file, verbose)
+    print_verbose(f'Planned {len(partitions)} output files', verbose)
+    if workers > 1:
+        conn.close()
+        write_partitions_parallel(duckdb_path, table_name, partitions, output_folder, geo_conversion, row_group_size, verbose, hive, workers)
+    else:
+        write_partitions(conn, table_name, partitions, output_folder, geo_conversion, row_group_size, verbose, hive)
+
+    # Record the extent, row count and row group bboxes of every file, so readers can pick
+    # files without listing and opening each one.
+    write_manifest(output_folder, verbose)
 
 if __name__ == "__main__":
     process_db()
\ No newline at end of file
@@ -1,7 +1,8 @@
 # This script is used to take an Overture Parquet file and add columns
 # useful for partitioning - it can put in both a quadkey and the country
 # ISO code. And then it will write out parquet and use gpq to convert the
-# parquet to geoparquet.
+# parquet to geoparquet, or with geo_conversion='native' write the geoparquet
+# directly in one pass.
 #
 # There is much more to do, my plan is to incorporate it into the open_buildings
 # CLI and let people pick which of the columns they want to add. Also could
@@ -14,27 +15,20 @@
 # ideally work with any of the Overture data types, and let you choose
 # your table names.
 import os
-import duckdb
 import time
 import tempfile
 import subprocess
 import glob
-from duckdb.typing import *
-import mercantile
 import shutil
-
-def lat_lon_to_quadkey(lat: DOUBLE, lon: DOUBLE, level: INTEGER) -> VARCHAR:
-    # Convert latitude and longitude to tile using mercantile
-    tile = mercantile.tile(lon, lat, level)
-    
-    # Convert the tile to a quadkey
-    quadKey = mercantile.quadkey(tile)
-    return quadKey
+from open_buildings.connection import connect
+from open_buildings.geoparquet import write_query_to_geoparquet
+from open_buildings.quadkey import register_quadkey_function
+from open_buildings.countries import CountryIndex, register_country_function
 
 def add_quadkey(con):
 
-    # Register Python UDFs
-    con.create_function('lat_lon_to_quadkey', lat_lon_to_quadkey, [DOUBLE, DOUBLE, INTEGER], VARCHAR)
+    # Register the vectorized quadkey function, which DuckDB calls once per vector of rows
+    register_quadkey_function(con)
 
     # Add a quadkey column to the table if it doesn't exist
     con.execute("ALTER TABLE places ADD COLUMN IF NOT EXISTS quadkey VARCHAR")
@@ -51,21 +45,20 @@ def add_quadkey(con):
     """)
 
 def add_country_iso(con, country_parquet_path):
-    # Load country parquet file into duckdb
-    con.execute(f"CREATE TABLE countries AS SELECT * FROM read_parquet('{country_parquet_path}')")
+    # Index the country polygons in an STRtree, so each place is only tested
+    # against the countries whose bounding box it touches
+    register_country_function(con, CountryIndex.from_parquet(country_parquet_path))
 
-    # Add a country_iso column to the buildings table
+    # Add a country_iso column to the places table
     con.execute("ALTER TABLE places ADD COLUMN IF NOT EXISTS country_iso VARCHAR")
     
-    # Update the country_iso column in the buildings table
+    # Update the country_iso column in the places table
     con.execute("""
     UPDATE places 
-    SET country_iso = countries.isocountrycodealpha2 
-    FROM countries 
-    WHERE ST_Intersects(ST_GeomFromWKB(countries.geometry), ST_GeomFromWKB(places.geometry))
+    SET country_iso = country_iso_for(geometry)
     """)
 
-def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False):
+def process_parquet_file(input_parquet_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, geo_conversion='gpq'):
     # Ensure output_folder exists
     os.makedirs(output_folder, exist_ok=True)
     
@@ -90,9 +83,7 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     print(f"Starting processing for file {input_parquet_path} at {time.ctime(timestamp)}")
     
     # Connect to DuckDB
-    con = duckdb.connect(output_db_path)
-    
-    con.execute('LOAD spatial;')
+    con = connect(output_db_path)
 
     # Load parquet file into duckdb
     con.execute(f"CREATE TABLE places AS SELECT * FROM read_parquet('{input_parquet_path}')")
@@ -103,10 +94,16 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
     if add_country_iso_option:
         add_country_iso(con, country_parquet_path)
 
-    # Write out to Parquet
-    con.execute(f"COPY (SELECT * FROM places ORDER BY quadkey) TO '{output_parquet_path}' WITH (FORMAT Parquet)")
+    query = "SELECT * FROM places ORDER BY quadkey"
+    if geo_conversion == 'native':
+        # Write GeoParquet directly, so the file only gets written once
+        print(f"Writing geoparquet: {output_parquet_path}")
+        write_query_to_geoparquet(con, query, output_parquet_path)
+    else:
+        # Write out to Parquet
+        con.execute(f"COPY ({query}) TO '{output_parquet_path}' WITH (FORMAT Parquet)")
     
-    if (True):
+    if geo_conversion == 'gpq':
         print(f"Converting to geoparquet: {output_parquet_path}")
         # Create a temporary file
         temp_file = tempfile.NamedTemporaryFile(suffix=".parquet", delete=False)
@@ -122,15 +119,15 @@ def process_parquet_file(input_parquet_path, output_folder, country_parquet_path
 
     print(f"Processing complete for file {input_parquet_path}")
 
-def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False):
+def process_parquet_files(input_path, output_folder, country_parquet_path, overwrite=False, add_quadkey_option=False, add_country_iso_option=False, geo_conversion='gpq'):
     # If output_folder doesn't exist, create it
     os.makedirs(output_folder, exist_ok=True)
     # If input_path is a directory, process all Parquet files in it
     if os.path.isdir(input_path):
         for file in glob.glob(os.path.join(input_path, "*")):
-            process_parquet_file(file, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option)
+            process_parquet_file(file, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, geo_conversion)
     else:
-        process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option)
+        process_parquet_file(input_path, output_folder, country_parquet_path, overwrite, add_quadkey_option, add_country_iso_option, geo_conversion)
 
 # Call the function 
 input_path = '/Volumes/fastdata/overture/s3-data/places/'
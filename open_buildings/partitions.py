@@ -0,0 +1,284 @@
+"""
+Helpers for working with the country / quadkey partitioned GeoParquet files written by the
+partition commands. Files are named after their country and, when a country had to be split,
+the quadkey prefix its rows share, e.g. `country_iso=US/US_0231.parquet`. Readers can use
+those names to work out which files could hold rows for an area of interest, and hand
+just that list to read_parquet instead of a glob over every partition.
+
+The partitioner also writes a manifest (_manifest.json) next to the files, listing each
+file with its country, quadkey prefix, bbox, row count, size and the bbox, quadkey range and
+size of each row group. When a manifest is there, readers pick files from it instead of
+listing the bucket, and can skip the row groups that can't hold rows for the area. Without
+one the same row group details can be read from the statistics in each file's footer.
+"""
+
+import glob
+import json
+import os
+import re
+
+import duckdb
+import pyarrow.parquet as pq
+import shapely
+
+MANIFEST_NAME = '_manifest.json'
+
+COUNTRY_PARTITION = re.compile(r'country_iso=([^/\\]+)')
+QUADKEY = re.compile(r'[0-3]*')
+
+# How a NULL country_iso shows up in a partition path: DuckDB and Hive's default partition,
+# and the google partitioner's folder for rows without a country.
+NULL_COUNTRIES = {'__HIVE_DEFAULT_PARTITION__', 'NULL', 'None'}
+
+
+def parse_partition_path(path):
+    """Returns the (country_iso, quadkey prefix) of a partition file. The country is None if it
+    can't be read from the path or the file holds the rows without a country, and the quadkey
+    is '' for files that hold a whole country."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    country, _, quadkey = name.partition('_')
+    match = COUNTRY_PARTITION.search(path)
+    if match:
+        # Only a name that starts with the country has a quadkey in it, not one like DuckDB's data_0.
+        if country != match.group(1):
+            quadkey = ''
+        country = match.group(1)
+    elif not country.isalpha():
+        country = None
+    if country in NULL_COUNTRIES:
+        country = None
+    if not QUADKEY.fullmatch(quadkey):
+        quadkey = ''
+    return country, quadkey
+
+
+def quadkeys_overlap(a, b):
+    """Two quadkey tiles overlap if one of them contains the other."""
+    return a.startswith(b) or b.startswith(a)
+
+
+def prune_partition_files(files, countries=None, quadkeys=None):
+    """Keeps only the partition files that can hold rows in one of the countries (if given) and
+    in one of the quadkey tiles (if given)."""
+    selected = []
+    for path in files:
+        country, file_quadkey = parse_partition_path(path)
+        if countries is not None and country is not None and country not in countries:
+            continue
+        if quadkeys and not any(quadkeys_overlap(file_quadkey, qk) for qk in quadkeys):
+            continue
+        selected.append(path)
+    return selected
+
+
+def list_partition_files(conn, data_path):
+    """Expands a (possibly remote) glob into the list of files, using DuckDB's glob function."""
+    return [row[0] for row in conn.execute(f"SELECT file FROM glob('{data_path}') ORDER BY file").fetchall()]
+
+
+def read_parquet_source(files, hive_partitioning):
+    """The read_parquet(...) call for an explicit list of files."""
+    file_list = ", ".join(f"'{f}'" for f in files)
+    return f"read_parquet([{file_list}], hive_partitioning={1 if hive_partitioning else 0})"
+
+
+def _union_bounds(bounds):
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+        return None
+    return [min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)]
+
+
+def _column_stats(row_group, path):
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.path_in_schema == path:
+            stats = column.statistics
+            if stats is not None and stats.has_min_max:
+                return stats.min, stats.max
+    return None
+
+
+def _bbox_stats(row_group):
+    """The bounds of a row group from the statistics of its bbox struct, or None without one."""
+    stats = [_column_stats(row_group, f'bbox.{name}') for name in ('minx', 'miny', 'maxx', 'maxy')]
+    if all(s is not None for s in stats):
+        return [stats[0][0], stats[1][0], stats[2][1], stats[3][1]]
+    return None
+
+
+def _row_group_bytes(row_group):
+    return sum(row_group.column(i).total_compressed_size for i in range(row_group.num_columns))
+
+
+def _row_group_bounds(parquet_file, index):
+    # Overture data has a bbox struct, so the bounds come straight from the footer statistics.
+    bounds = _bbox_stats(parquet_file.metadata.row_group(index))
+    if bounds is not None:
+        return bounds
+    # Otherwise read just the geometry column of the row group.
+    geometries = shapely.from_wkb(parquet_file.read_row_group(index, columns=['geometry']).column('geometry').to_numpy(zero_copy_only=False))
+    if len(geometries) == 0:
+        return None
+    return [float(v) for v in shapely.total_bounds(geometries)]
+
+
+def describe_partition_file(path, root):
+    """Returns the manifest entry for one partition file."""
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    country, quadkey = parse_partition_path(path)
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        entry = {
+            'num_rows': metadata.row_group(i).num_rows,
+            'num_bytes': _row_group_bytes(metadata.row_group(i)),
+            'bbox': _row_group_bounds(parquet_file, i),
+        }
+        quadkey_stats = _column_stats(metadata.row_group(i), 'quadkey')
+        if quadkey_stats is not None:
+            entry['quadkey_min'], entry['quadkey_max'] = quadkey_stats
+        row_groups.append(entry)
+    return {
+        'path': os.path.relpath(path, root).replace(os.sep, '/'),
+        'country_iso': country,
+        'quadkey': quadkey,
+        'bbox': _union_bounds(rg['bbox'] for rg in row_groups),
+        'num_rows': metadata.num_rows,
+        'num_bytes': os.path.getsize(path),
+        'row_groups': row_groups,
+    }
+
+
+def write_manifest(output_folder, verbose=False):
+    """Describes every parquet file under output_folder and writes them out as _manifest.json."""
+    files = sorted(glob.glob(os.path.join(output_folder, '**', '*.parquet'), recursive=True))
+    entries = [describe_partition_file(f, output_folder) for f in files]
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    with open(manifest_path, 'w') as f:
+        json.dump({'version': 1, 'files': entries}, f)
+    if verbose:
+        print(f"Wrote manifest of {len(entries)} files to {manifest_path}")
+    return manifest_path
+
+
+def data_root(data_path):
+    """The folder a data path glob like s3://bucket/data/*/*.parquet starts from."""
+    glob_start = min([i for i in (data_path.find('*'), data_path.find('?'), data_path.find('[')) if i >= 0], default=len(data_path))
+    return data_path[:glob_start].rsplit('/', 1)[0] + '/'
+
+
+def load_manifest(conn, data_path):
+    """Reads the manifest that sits at the root of a data path, or returns None if there isn't one."""
+    manifest_url = data_root(data_path) + MANIFEST_NAME
+    try:
+        row = conn.execute("SELECT content FROM read_text(?)", [manifest_url]).fetchone()
+    except duckdb.Error:
+        return None
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def bounds_intersect(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+
+def select_manifest_files(manifest, data_path, bounds, countries=None, quadkeys=None):
+    """Returns the full paths of the manifest files whose bbox intersects bounds, optionally
+    also filtering on country and quadkey."""
+    root = data_root(data_path)
+    selected = []
+    for entry in manifest['files']:
+        if entry['bbox'] is None or not bounds_intersect(entry['bbox'], bounds):
+            continue
+        if countries is not None and entry['country_iso'] is not None and entry['country_iso'] not in countries:
+            continue
+        if quadkeys and not any(quadkeys_overlap(entry['quadkey'], qk) for qk in quadkeys):
+            continue
+        selected.append(root + entry['path'])
+    return selected
+
+
+def footer_row_groups(metadata):
+    """Row group entries like the manifest's, from the statistics in a file's footer. The bbox
+    is None when the file has no bbox struct, as the geometry isn't read."""
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        entry = {'num_rows': row_group.num_rows, 'num_bytes': _row_group_bytes(row_group), 'bbox': _bbox_stats(row_group)}
+        quadkey_stats = _column_stats(row_group, 'quadkey')
+        if quadkey_stats is not None:
+            entry['quadkey_min'], entry['quadkey_max'] = quadkey_stats
+        row_groups.append(entry)
+    return row_groups
+
+
+def quadkey_range_overlaps(quadkey, minimum, maximum):
+    """Whether a row group with quadkeys from minimum to maximum can hold any in the quadkey
+    tile. Quadkeys in the tile sort from the quadkey itself up to (but not including) the
+    quadkey followed by '4', one past the last quadkey digit."""
+    return minimum < quadkey + '4' and maximum >= quadkey
+
+
+def row_group_can_match(row_group, bounds, quadkeys=None):
+    """Whether a row group entry (from the manifest or footer_row_groups) can hold rows in
+    bounds and one of the quadkey tiles. Anything without the details to tell is kept."""
+    if row_group.get('bbox') is not None and not bounds_intersect(row_group['bbox'], bounds):
+        return False
+    if quadkeys and 'quadkey_min' in row_group:
+        return any(quadkey_range_overlaps(qk, row_group['quadkey_min'], row_group['quadkey_max']) for qk in quadkeys)
+    return True
+
+
+def select_row_groups(row_groups, bounds, quadkeys=None):
+    """The indexes of the row groups that can hold rows in bounds and the quadkey tiles."""
+    return [i for i, row_group in enumerate(row_groups) if row_group_can_match(row_group, bounds, quadkeys)]
+
+
+def select_row_groups_for_areas(row_groups, areas):
+    """The indexes of the row groups that can hold rows in any of the areas, each a pair of
+    bounds and quadkey tiles."""
+    return [i for i, row_group in enumerate(row_groups) if any(row_group_can_match(row_group, b, q) for b, q in areas)]
+
+
+def manifest_entries(manifest, data_path):
+    """The manifest entries by full path, as select_manifest_files gives them."""
+    root = data_root(data_path)
+    return {root + entry['path']: entry for entry in manifest['files']}
+
+
+def row_group_summary(row_groups, selected):
+    """Counts of the row groups and bytes that will and won't be read."""
+    selected = set(selected)
+    skipped = [rg for i, rg in enumerate(row_groups) if i not in selected]
+    return {
+        'row_groups': len(row_groups),
+        'row_groups_skipped': len(skipped),
+        'bytes': sum(rg.get('num_bytes') or 0 for rg in row_groups),
+        'bytes_skipped': sum(rg.get('num_bytes') or 0 for rg in skipped),
+    }
+
+
+def add_summaries(a, b):
+    return {key: a.get(key, 0) + b.get(key, 0) for key in set(a) | set(b)}
+
+
+def country_predicate(countries, include_null=False, column='country_iso'):
+    """A WHERE condition for rows in one of the countries. With include_null rows without a
+    country pass too: buildings outside the simplified country polygons, like some on the coast
+    or offshore, get a NULL country_iso, and a coverage table can't place them in a country."""
+    conditions = []
+    if countries:
+        conditions.append(f"{column} IN ({', '.join(repr(c) for c in countries)})")
+    if include_null or not conditions:
+        conditions.append(f"{column} IS NULL")
+    return conditions[0] if len(conditions) == 1 else "(" + " OR ".join(conditions) + ")"
+
+
+def bbox_predicate(bounds, column='bbox'):
+    """A WHERE condition that rows' bbox structs overlap bounds. It's cheap next to decoding the
+    geometry, and DuckDB can also skip row groups with it from the bbox statistics."""
+    minx, miny, maxx, maxy = bounds
+    return (f"{column}.minx <= {maxx} AND {column}.maxx >= {minx} AND "
+            f"{column}.miny <= {maxy} AND {column}.maxy >= {miny}")
@@ -0,0 +1,273 @@
+"""
+Profiling spans for the conversion, add_columns and partition pipelines. Code marks the
+steps it wants to see with `span`, like
+
+    with span('read_csv', file=input_file_path) as s:
+        df = pd.read_csv(input_file_path)
+        s.set(rows=len(df))
+
+and runs DuckDB statements worth seeing through `execute`. When no profile is being
+recorded both just get out of the way. With one started (every `ob` command takes
+--profile) each span records its wall time, the CPU time of the process over it, and any
+rows and bytes it was told about. With --profile-sql the DuckDB statements also run with
+DuckDB's own profiling on, and its timings, row counts and operator tree for the statement
+go into the span.
+
+At the end the spans are written as a Chrome trace, which chrome://tracing or
+https://ui.perfetto.dev can show as a timeline, and summed up by name in a table. Worker
+processes record their own spans when the work handed to them goes through `call`, and
+the parent adds them in with `merge`, each under its own pid.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+# The profile being recorded in this process, or None.
+_profiler = None
+
+
+class Profiler:
+    def __init__(self, sql=False, origin=None):
+        self.sql = sql
+        # Timestamps in the trace are relative to the start of the run. perf_counter is the
+        # same clock in every process on a machine, so workers are given the parent's origin.
+        self.origin = time.perf_counter() if origin is None else origin
+        self.events = []
+        self._sql_output = None
+
+    def settings(self):
+        return {'sql': self.sql, 'origin': self.origin}
+
+    def sql_output(self):
+        if self._sql_output is None:
+            fd, self._sql_output = tempfile.mkstemp(suffix='.json', prefix='duckdb_profile_')
+            os.close(fd)
+        return self._sql_output
+
+    def close(self):
+        if self._sql_output is not None and os.path.exists(self._sql_output):
+            os.remove(self._sql_output)
+
+
+class Span:
+    """A running span. Rows, bytes and anything else worth keeping can be added with set."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.rows = None
+        self.bytes = None
+
+    def set(self, rows=None, bytes=None, **args):
+        if rows is not None:
+            self.rows = rows
+        if bytes is not None:
+            self.bytes = bytes
+        self.args.update(args)
+
+
+class _NullSpan:
+    """Stands in for a Span when nothing is being recorded."""
+
+    def set(self, rows=None, bytes=None, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    """Whether spans are being recorded, for skipping work (like counting rows) that's only for the profile."""
+    return _profiler is not None
+
+
+@contextmanager
+def span(name, **args):
+    """Records the block as a span called name, with args as extra details."""
+    if _profiler is None:
+        yield _NULL_SPAN
+        return
+    current = Span(name, args)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield current
+    finally:
+        wall_end = time.perf_counter()
+        cpu_seconds = time.process_time() - cpu_start
+        _profiler.events.append({
+            'name': name,
+            'start': wall_start - _profiler.origin,
+            'seconds': wall_end - wall_start,
+            'cpu_seconds': cpu_seconds,
+            'rows': current.rows,
+            'bytes': current.bytes,
+            'args': current.args,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        })
+
+
+class FetchedResult:
+    """The rows of a statement that was run with SQL profiling, with the fetch methods of a connection."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+
+def execute(conn, sql, name, **args):
+    """Runs a DuckDB statement in a span called name, returning what conn.execute returns.
+    With SQL profiling on, the statement's DuckDB profile goes in the span, and the result is
+    read up front, so only fetchone and fetchall can be used on it."""
+    with span(name, **args) as current:
+        if _profiler is None or not _profiler.sql:
+            return conn.execute(sql)
+        output = _profiler.sql_output()
+        conn.execute("PRAGMA enable_profiling='json'")
+        conn.execute(f"PRAGMA profiling_output='{output}'")
+        try:
+            # DuckDB only writes the profile once the result has been read, and turning profiling
+            # back off would throw the result away, so read it all here.
+            result = FetchedResult(conn.execute(sql).fetchall())
+        finally:
+            conn.execute("PRAGMA disable_profiling")
+        with open(output) as f:
+            profile = json.load(f)
+        current.set(
+            rows=profile.get('rows_returned'),
+            sql=sql.strip(),
+            duckdb_latency=profile.get('latency'),
+            duckdb_cpu_time=profile.get('cpu_time'),
+            duckdb_rows_scanned=profile.get('cumulative_rows_scanned'),
+            duckdb_peak_memory=profile.get('system_peak_buffer_memory'),
+            duckdb_plan=profile.get('children'),
+        )
+        return result
+
+
+def start(sql=False, origin=None):
+    """Starts recording spans in this process."""
+    global _profiler
+    _profiler = Profiler(sql, origin)
+
+
+def stop():
+    """Stops recording, returning the spans recorded."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return []
+    profiler.close()
+    return profiler.events
+
+
+def settings():
+    """What a worker process needs to record spans the same way, or None when not recording."""
+    return _profiler.settings() if _profiler is not None else None
+
+
+def call(profile_settings, function, *args):
+    """Runs function(*args) in a worker process, recording its spans if profile_settings
+    (from `settings` in the parent) says to. Returns the result and the spans, for `merge`."""
+    global _profiler
+    if profile_settings is None:
+        return function(*args), []
+    # Put back whatever was recording before, in case this is run in the same process.
+    previous = _profiler
+    start(**profile_settings)
+    try:
+        result = function(*args)
+    finally:
+        events = stop()
+        _profiler = previous
+    return result, events
+
+
+def merge(call_result):
+    """Adds the spans from a `call` in a worker process to this process's profile, returning the result."""
+    result, events = call_result
+    if _profiler is not None:
+        _profiler.events.extend(events)
+    return result
+
+
+def chrome_trace(events):
+    """The spans in Chrome trace event format."""
+    trace_events = []
+    for event in events:
+        args = {'cpu_ms': round(event['cpu_seconds'] * 1000, 3), **event['args']}
+        if event['rows'] is not None:
+            args['rows'] = event['rows']
+        if event['bytes'] is not None:
+            args['bytes'] = event['bytes']
+        trace_events.append({
+            'name': event['name'],
+            'cat': 'open_buildings',
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['seconds'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_trace(events, path):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(events), f, default=str)
+
+
+def summarize(events):
+    """Totals of each span name: count, wall and CPU seconds, rows and bytes."""
+    totals = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0, 'bytes': 0})
+    for event in events:
+        total = totals[event['name']]
+        total['count'] += 1
+        total['seconds'] += event['seconds']
+        total['cpu_seconds'] += event['cpu_seconds']
+        total['rows'] += event['rows'] or 0
+        total['bytes'] += event['bytes'] or 0
+    return dict(totals)
+
+
+def print_summary(events):
+    totals = sorted(summarize(events).items(), key=lambda item: item[1]['seconds'], reverse=True)
+    table = [
+        [name, t['count'], f"{t['seconds']:.3f}", f"{t['cpu_seconds']:.3f}", t['rows'] or '', f"{t['bytes'] / 1e6:.1f}" if t['bytes'] else '']
+        for name, t in totals
+    ]
+    print(tabulate(table, headers=['span', 'count', 'wall (s)', 'cpu (s)', 'rows', 'MB written'], tablefmt="simple"))
+
+
+@contextmanager
+def profile(path, sql=False):
+    """Records spans for the duration of the block, then writes them as a Chrome trace to path
+    and prints a summary."""
+    start(sql)
+    try:
+        yield
+    finally:
+        events = stop()
+        write_trace(events, path)
+        print_summary(events)
+        print(f"Wrote profile of {len(events)} spans to {path}")
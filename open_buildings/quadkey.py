@@ -0,0 +1,210 @@
+"""
+Vectorized quadkey computation. The add_columns scripts used to register a scalar Python
+UDF that called mercantile once per row, which means one round-trip into the interpreter
+for every building. The functions here work on whole NumPy / Arrow arrays of longitudes and
+latitudes, so DuckDB can hand over a full vector at a time through an 'arrow' UDF. The tile
+math follows mercantile exactly (including its EPSILON nudge at tile edges), so the output
+matches mercantile.quadkey(mercantile.tile(lon, lat, level)).
+"""
+
+import heapq
+
+import mercantile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import shapely
+from duckdb.typing import DOUBLE, INTEGER, VARCHAR
+
+from open_buildings.common import arrow_to_numpy
+
+# Same value mercantile uses to push points on the right/bottom edge of a tile into the next tile.
+EPSILON = 1e-14
+
+# The level of the quadkey column the add_columns scripts write.
+QUADKEY_LEVEL = 12
+
+# Most tiles a cover uses. More tiles fit an AOI closer but make a longer WHERE clause.
+DEFAULT_MAX_TILES = 16
+
+
+def lon_lat_to_tiles(lon, lat, level):
+    """Returns the x and y tile indices at the given zoom level for arrays of lon and lat."""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+
+    x = lon / 360.0 + 0.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sinlat = np.sin(np.radians(lat))
+        y = 0.5 - 0.25 * np.log((1.0 + sinlat) / (1.0 - sinlat)) / np.pi
+
+    z2 = 2 ** level
+    xtile = _to_tile_index(x, z2)
+    ytile = _to_tile_index(y, z2)
+    return xtile, ytile
+
+
+def _to_tile_index(v, z2):
+    # Mirrors the clamping in mercantile.tile: <= 0 goes to the first tile, >= 1 to the last.
+    with np.errstate(invalid='ignore'):
+        index = np.floor((v + EPSILON) * z2)
+        index = np.where(v <= 0, 0, index)
+        index = np.where(v >= 1, z2 - 1, index)
+    return np.nan_to_num(index, nan=0).astype(np.int64)
+
+
+def tiles_to_quadkeys(xtile, ytile, level):
+    """Returns a pyarrow string array of quadkeys for arrays of tile x and y at the given level."""
+    n = len(xtile)
+    # One byte per zoom level, filled with the ascii digit, then handed to Arrow as a
+    # fixed-width string buffer so no Python strings are created per row.
+    digits = np.empty((n, level), dtype=np.uint8)
+    for i, z in enumerate(range(level, 0, -1)):
+        mask = 1 << (z - 1)
+        digits[:, i] = ((xtile & mask) != 0) + 2 * ((ytile & mask) != 0) + ord('0')
+    offsets = np.arange(n + 1, dtype=np.int32) * level
+    return pa.StringArray.from_buffers(n, pa.py_buffer(offsets), pa.py_buffer(digits.tobytes()))
+
+
+def lon_lat_to_quadkeys(lon, lat, level):
+    """Returns a pyarrow string array with the quadkey of each lon / lat pair at the given level.
+
+    NaN coordinates produce null quadkeys.
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    xtile, ytile = lon_lat_to_tiles(lon, lat, level)
+    quadkeys = tiles_to_quadkeys(xtile, ytile, level)
+    invalid = np.isnan(lon) | np.isnan(lat)
+    if invalid.any():
+        quadkeys = pc.if_else(pa.array(invalid), pa.scalar(None, pa.string()), quadkeys)
+    return quadkeys
+
+
+def arrow_lat_lon_to_quadkey(lat, lon, level):
+    """DuckDB 'arrow' UDF: takes Arrow arrays of lat, lon and level and returns Arrow quadkeys."""
+    lat = arrow_to_numpy(lat)
+    lon = arrow_to_numpy(lon)
+    levels = arrow_to_numpy(level).astype(np.int64)
+    unique_levels = np.unique(levels)
+    if len(unique_levels) == 1:
+        return lon_lat_to_quadkeys(lon, lat, int(unique_levels[0]))
+
+    # The level is almost always a constant, but handle a column of levels too.
+    result = np.empty(len(lat), dtype=object)
+    for lvl in unique_levels:
+        mask = levels == lvl
+        result[mask] = lon_lat_to_quadkeys(lon[mask], lat[mask], int(lvl)).to_numpy(zero_copy_only=False)
+    return pa.array(result, type=pa.string())
+
+
+def register_quadkey_function(con, name='lat_lon_to_quadkey'):
+    """Registers the vectorized lat_lon_to_quadkey(lat, lon, level) function on a DuckDB connection."""
+    con.create_function(name, arrow_lat_lon_to_quadkey, [DOUBLE, DOUBLE, INTEGER], VARCHAR, type='arrow')
+
+
+def tile_box(tile):
+    """The bounds of a tile as a polygon. Tiles in the top and bottom rows reach to the poles,
+    since points past the edge of web mercator get those tiles' quadkeys."""
+    west, south, east, north = mercantile.bounds(tile)
+    if tile.y == 0:
+        north = 90.0
+    if tile.y == 2 ** tile.z - 1:
+        south = -90.0
+    return shapely.box(west, south, east, north)
+
+
+def enclosing_tile(bounds, max_zoom=QUADKEY_LEVEL):
+    """The smallest tile, up to max_zoom, that contains all of bounds."""
+    west, south, east, north = bounds
+    for zoom in range(max_zoom, 0, -1):
+        tiles = list(mercantile.tiles(west, south, east, north, zooms=zoom))
+        if len(tiles) == 1:
+            return tiles[0]
+    return mercantile.Tile(0, 0, 0)
+
+
+def quadkey_cover(geometry, max_tiles=DEFAULT_MAX_TILES, max_zoom=QUADKEY_LEVEL):
+    """A sorted list of at most max_tiles quadkeys, none deeper than max_zoom, whose tiles
+    together cover the geometry.
+
+    It starts from the smallest tile that holds the whole geometry and keeps splitting the
+    tile with the most area outside the geometry into its children that touch it, as long as
+    that stays within max_tiles. So an AOI that straddles a tile edge gets a few tiles on each
+    side instead of the one big tile above them, and an irregular one leaves out the tiles
+    it doesn't reach.
+    """
+    if max_tiles < 1:
+        raise ValueError(f"max_tiles has to be at least 1, not {max_tiles}")
+    shapely.prepare(geometry)
+    area = geometry.area
+
+    def waste(tile, box):
+        return box.area - (shapely.intersection(box, geometry).area if area > 0 else 0.0)
+
+    start = enclosing_tile(geometry.bounds, max_zoom)
+    # Min heap on negative waste, so the tile with the most area outside the geometry comes first.
+    start_box = tile_box(start)
+    heap = [(-waste(start, start_box), mercantile.quadkey(start), start)]
+    done = []
+    while heap:
+        negative_waste, quadkey, tile = heapq.heappop(heap)
+        if tile.z >= max_zoom or negative_waste == 0:
+            done.append(quadkey)
+            continue
+        children = []
+        for child in mercantile.children(tile):
+            box = tile_box(child)
+            if geometry.intersects(box) and not geometry.touches(box):
+                children.append((child, box))
+        if not children or len(done) + len(heap) + len(children) > max_tiles:
+            done.append(quadkey)
+            continue
+        for child, box in children:
+            heapq.heappush(heap, (-waste(child, box), mercantile.quadkey(child), child))
+    return sorted(done)
+
+
+def quadkey_upper_bound(prefix):
+    """The smallest string past every quadkey that starts with prefix, or None for ''. Quadkeys
+    only use the digits 0 to 3, so it's the prefix with trailing 3s dropped and its last digit
+    bumped: everything starting with 023 sorts from '023' up to (not including) '03'."""
+    prefix = prefix.rstrip('3')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def quadkey_ranges(quadkeys):
+    """The quadkey tiles as merged [start, end) string ranges, with end None for no limit."""
+    ranges = []
+    for quadkey in sorted(set(quadkeys)):
+        start, end = quadkey, quadkey_upper_bound(quadkey)
+        if ranges and (ranges[-1][1] is None or start <= ranges[-1][1]):
+            previous_start, previous_end = ranges[-1]
+            if previous_end is not None and (end is None or end > previous_end):
+                ranges[-1] = (previous_start, end)
+            continue
+        ranges.append((start, end))
+    return ranges
+
+
+def quadkey_predicate(quadkeys, column='quadkey', level=QUADKEY_LEVEL):
+    """A WHERE condition for rows whose quadkey is in one of the quadkey tiles: an IN list
+    for whole tiles at the column's level and a range for each run of larger ones. Ranges on
+    the sorted quadkey column let the reader skip row groups on their statistics."""
+    exact = []
+    conditions = []
+    for start, end in quadkey_ranges(quadkeys):
+        if end is None:
+            # A run reaching the last quadkey still has a lower bound worth pruning on.
+            conditions.append(f"{column} >= '{start}'")
+        elif len(start) == level and end == quadkey_upper_bound(start):
+            exact.append(start)
+        else:
+            conditions.append(f"({column} >= '{start}' AND {column} < '{end}')")
+    if exact:
+        conditions.insert(0, f"{column} IN ({', '.join(repr(q) for q in exact)})")
+    if not conditions:
+        return "FALSE"
+    return conditions[0] if len(conditions) == 1 else "(" + " OR ".join(conditions) + ")"
@@ -0,0 +1,184 @@
+"""
+Synthetic building datasets, for benchmarking without downloading anything. The real Google
+Open Buildings CSVs and Overture files vary in size from one country to the next, and aren't
+available offline, so timings on them can't be compared from one machine or run to another.
+The generators here write files with the same schema as the real ones at any number of rows,
+with a chosen share of multipolygons and spread of buildings:
+
+- uniform puts buildings anywhere in the bounds.
+- clustered gathers them around cluster centers of very different sizes, like towns and
+  cities, so that some quadkeys are crowded and most are empty, as in the real data.
+
+Buildings are rotated rectangles between 5 and 30 meters a side, and a multipolygon is two
+of them side by side. Rows are generated BATCH_SIZE at a time, each batch with its own
+random generator seeded from the seed and the batch number, so the same arguments always
+give the same file, and memory stays bounded at 100 million rows.
+"""
+
+import math
+from collections import namedtuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import shapely
+
+from open_buildings.geoparquet import GeoParquetWriter
+from open_buildings.plus_codes import encode as encode_plus_codes
+
+DISTRIBUTIONS = ['uniform', 'clustered']
+
+# Rows generated at a time. Changing it changes the output for a given seed.
+BATCH_SIZE = 100000
+
+# The latitudes with nearly all of the world's buildings.
+DEFAULT_BOUNDS = (-180.0, -56.0, 180.0, 72.0)
+
+CLUSTER_COUNT = 200
+
+# Meters per degree of latitude, and of longitude at the equator.
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LON = 111320.0
+
+OVERTURE_CLASSES = ['residential', 'commercial', 'industrial', 'education', 'religious', 'agricultural']
+
+SyntheticBatch = namedtuple('SyntheticBatch', ['geometry', 'latitude', 'longitude', 'area_in_meters', 'rng'])
+
+
+def _cluster_centers(bounds, seed):
+    """Centers, spreads in degrees and relative sizes of the clusters. Sizes follow a power
+    law, so a few clusters hold most of the buildings."""
+    rng = np.random.default_rng([seed, 0xC1])
+    minx, miny, maxx, maxy = bounds
+    centers = np.column_stack([rng.uniform(minx, maxx, CLUSTER_COUNT), rng.uniform(miny, maxy, CLUSTER_COUNT)])
+    # From villages a few hundred meters across to cities of tens of kilometers.
+    spreads = np.exp(rng.uniform(np.log(0.003), np.log(0.1), CLUSTER_COUNT))
+    weights = rng.pareto(1.2, CLUSTER_COUNT) + 1
+    return centers, spreads, weights / weights.sum()
+
+
+def _locations(rng, n, distribution, bounds, clusters):
+    minx, miny, maxx, maxy = bounds
+    if distribution == 'uniform':
+        lon = rng.uniform(minx, maxx, n)
+        lat = rng.uniform(miny, maxy, n)
+    else:
+        centers, spreads, weights = clusters
+        cluster = rng.choice(len(weights), size=n, p=weights)
+        lon = centers[cluster, 0] + rng.normal(0, 1, n) * spreads[cluster]
+        lat = centers[cluster, 1] + rng.normal(0, 1, n) * spreads[cluster]
+    # Keep a margin so no building crosses the bounds.
+    return np.clip(lon, minx + 0.001, maxx - 0.001), np.clip(lat, miny + 0.001, maxy - 0.001)
+
+
+def _rectangles(lon, lat, width, height, angle):
+    """Polygons for rectangles of width x height meters, rotated by angle, centered on lon / lat."""
+    corners = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5], [-0.5, -0.5]])
+    dx = corners[:, 0] * width[:, None]
+    dy = corners[:, 1] * height[:, None]
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    x = dx * cos - dy * sin
+    y = dx * sin + dy * cos
+    coords = np.stack(
+        [
+            lon[:, None] + x / (METERS_PER_DEGREE_LON * np.cos(np.radians(lat))[:, None]),
+            lat[:, None] + y / METERS_PER_DEGREE_LAT,
+        ],
+        axis=-1,
+    )
+    return shapely.polygons(coords)
+
+
+def building_batches(rows, multipolygon_ratio=0.05, distribution='clustered', bounds=DEFAULT_BOUNDS, seed=0):
+    """Yields a SyntheticBatch of up to BATCH_SIZE buildings at a time, rows in all. Each has
+    the shapely geometries, the latitude and longitude of their centroids, their area, and the
+    batch's random generator for any other columns."""
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Invalid distribution: {distribution}")
+    if not 0 <= multipolygon_ratio <= 1:
+        raise ValueError(f"multipolygon_ratio has to be between 0 and 1, not {multipolygon_ratio}")
+    clusters = _cluster_centers(bounds, seed) if distribution == 'clustered' else None
+
+    for batch_index in range(math.ceil(rows / BATCH_SIZE)):
+        n = min(BATCH_SIZE, rows - batch_index * BATCH_SIZE)
+        rng = np.random.default_rng([seed, batch_index])
+        lon, lat = _locations(rng, n, distribution, bounds, clusters)
+        width = rng.uniform(5, 30, n)
+        height = rng.uniform(5, 30, n)
+        angle = rng.uniform(0, np.pi / 2, n)
+        geometry = _rectangles(lon, lat, width, height, angle)
+        area = width * height
+
+        multi = rng.random(n) < multipolygon_ratio
+        if multi.any():
+            # A second building beside the first, along its rotated x axis with a gap of a few meters.
+            other_width = rng.uniform(5, 30, n)[multi]
+            other_height = rng.uniform(5, 30, n)[multi]
+            offset = width[multi] / 2 + rng.uniform(2, 10, multi.sum()) + other_width / 2
+            other_lon = lon[multi] + offset * np.cos(angle[multi]) / (METERS_PER_DEGREE_LON * np.cos(np.radians(lat[multi])))
+            other_lat = lat[multi] + offset * np.sin(angle[multi]) / METERS_PER_DEGREE_LAT
+            others = _rectangles(other_lon, other_lat, other_width, other_height, angle[multi])
+            geometry[multi] = shapely.multipolygons(np.column_stack([geometry[multi], others]))
+            area[multi] += other_width * other_height
+
+        centroids = shapely.centroid(geometry)
+        yield SyntheticBatch(geometry, shapely.get_y(centroids), shapely.get_x(centroids), area, rng)
+
+
+def write_google_csv(path, rows, multipolygon_ratio=0.05, distribution='clustered', bounds=DEFAULT_BOUNDS, seed=0):
+    """Writes a CSV in the Google Open Buildings schema, returning the number of rows."""
+    writer = None
+    for batch in building_batches(rows, multipolygon_ratio, distribution, bounds, seed):
+        table = pa.table({
+            'latitude': batch.latitude.round(7),
+            'longitude': batch.longitude.round(7),
+            'area_in_meters': batch.area_in_meters.round(4),
+            'confidence': batch.rng.uniform(0.65, 1.0, len(batch.geometry)).round(4),
+            'geometry': shapely.to_wkt(batch.geometry, rounding_precision=7),
+            'full_plus_code': encode_plus_codes(batch.latitude, batch.longitude),
+        })
+        if writer is None:
+            # The header and string columns get quoted, unlike the real files, which makes no
+            # difference to pandas, DuckDB or GDAL. Numbers are left unquoted.
+            writer = pacsv.CSVWriter(path, table.schema, write_options=pacsv.WriteOptions(quoting_style='needed'))
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+    return rows
+
+
+def overture_batch(batch, start):
+    """A record batch in the Overture buildings schema for a SyntheticBatch whose first row is number start."""
+    n = len(batch.geometry)
+    bounds = shapely.bounds(batch.geometry)
+    rng = batch.rng
+    # Most Overture buildings have no height or class.
+    height = rng.uniform(3, 40, n).round(1)
+    has_height = rng.random(n) < 0.3
+    classes = np.array(OVERTURE_CLASSES, dtype=object)[rng.integers(0, len(OVERTURE_CLASSES), n)]
+    has_class = rng.random(n) < 0.2
+    return pa.record_batch({
+        'id': pa.array([f'{i:032x}' for i in range(start, start + n)], type=pa.string()),
+        'height': pa.array(height, mask=~has_height, type=pa.float64()),
+        'class': pa.array(classes, mask=~has_class, type=pa.string()),
+        'bbox': pa.StructArray.from_arrays(
+            [pa.array(bounds[:, 0]), pa.array(bounds[:, 2]), pa.array(bounds[:, 1]), pa.array(bounds[:, 3])],
+            names=['minx', 'maxx', 'miny', 'maxy'],
+        ),
+        'geometry': pa.array(shapely.to_wkb(batch.geometry), type=pa.binary()),
+    })
+
+
+def write_overture_parquet(path, rows, multipolygon_ratio=0.0, distribution='clustered', bounds=DEFAULT_BOUNDS, seed=0, row_group_size=None):
+    """Writes a GeoParquet file in the Overture buildings schema, with its bbox struct, returning the number of rows."""
+    writer = None
+    start = 0
+    for batch in building_batches(rows, multipolygon_ratio, distribution, bounds, seed):
+        record_batch = overture_batch(batch, start)
+        if writer is None:
+            writer = GeoParquetWriter(path, record_batch.schema, row_group_size=row_group_size)
+        writer.write_batch(record_batch)
+        start += record_batch.num_rows
+    if writer is not None:
+        writer.close()
+    return rows
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""Tests for the benchmark harness."""
+
+
+import math
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from open_buildings.benchmark import (
+    baseline_differences,
+    compare_results,
+    load_baseline,
+    measure,
+    percentile,
+    phase,
+    run_cell,
+    save_baseline,
+    skipped_cell,
+    summarize,
+)
+from open_buildings.cli import main
+from open_buildings.google.process import process_benchmark
+
+
+def phased_work():
+    with phase('read'):
+        time.sleep(0.02)
+        with phase('transform'):
+            time.sleep(0.03)
+    with phase('write'):
+        time.sleep(0.01)
+
+
+def measured_phased_work():
+    result = measure(phased_work)
+    result['output_bytes'] = 42
+    return result
+
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for `open_buildings.benchmark`."""
+
+    def test_phase_outside_run(self):
+        # Marking phases when nothing is being measured doesn't do anything.
+        with phase('read'):
+            pass
+
+    def test_nested_phases(self):
+        result = measure(phased_work)
+        phases = result['phases']
+        self.assertEqual(sorted(phases), ['read', 'transform', 'write'])
+        # Time in the inner transform phase doesn't count towards read.
+        self.assertGreaterEqual(phases['read'], 0.02)
+        self.assertLess(phases['read'], 0.05)
+        self.assertGreaterEqual(phases['transform'], 0.03)
+        self.assertGreaterEqual(result['seconds'], sum(phases.values()))
+        self.assertGreater(result['peak_rss'], 0)
+
+    def test_no_resource_module(self):
+        # Windows has no resource module, so there's no peak memory, but the timings still work.
+        with mock.patch.dict(sys.modules, {'resource': None}):
+            result = run_cell(measured_phased_work, (), warmup=0, repetitions=1, isolate=False)
+        self.assertTrue(math.isnan(result['peak_rss']))
+        self.assertGreater(result['median'], 0)
+
+    def test_summarize(self):
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 50), 3)
+        self.assertAlmostEqual(percentile([1, 2, 3, 4, 5], 95), 4.8)
+        summary = summarize([3.0, 1.0, 2.0, 10.0])
+        self.assertEqual(summary['median'], 2.5)
+        self.assertEqual(summary['min'], 1.0)
+        self.assertEqual(summary['mean'], 4.0)
+        self.assertAlmostEqual(summary['stddev'], 4.0824829, places=6)
+        self.assertTrue(math.isnan(summarize([])['median']))
+
+    def test_run_cell(self):
+        calls = []
+
+        def work():
+            calls.append(1)
+            return measured_phased_work()
+
+        result = run_cell(work, (), warmup=2, repetitions=3, isolate=False)
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(result['repetitions'], 3)
+        self.assertEqual(result['output_bytes'], 42)
+        self.assertGreaterEqual(result['p95'], result['median'])
+        self.assertGreaterEqual(result['transform_seconds'], 0.03)
+
+    def test_skipped_cell(self):
+        result = skipped_cell()
+        self.assertTrue(math.isnan(result['median']))
+        self.assertTrue(math.isnan(result['write_seconds']))
+
+
+class TestBaselines(unittest.TestCase):
+    """Tests for saving benchmark baselines and comparing against them."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = {'input': 'buildings.csv', 'repetitions': 5}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def cell(self, process, format, median):
+        return {**skipped_cell(), 'process': process, 'format': format, 'median': median}
+
+    def test_save_and_load(self):
+        results = [self.cell('pandas', 'fgb', 2.0), self.cell('duckdb', 'gpkg', math.nan)]
+        path = save_baseline('main', results, self.settings, self.tmpdir.name)
+        self.assertEqual(path, os.path.join(self.tmpdir.name, 'main.json'))
+
+        baseline = load_baseline('main', self.tmpdir.name)
+        self.assertEqual(baseline['results'][0]['median'], 2.0)
+        self.assertTrue(math.isnan(baseline['results'][1]['median']))
+        self.assertIn('cpu_count', baseline['machine'])
+        self.assertIn('duckdb', baseline['versions'])
+        self.assertEqual(baseline_differences(baseline, self.settings), [])
+        self.assertEqual(
+            baseline_differences(baseline, {**self.settings, 'repetitions': 3}),
+            ['settings repetitions: 5 -> 3'],
+        )
+
+        with self.assertRaises(FileNotFoundError):
+            load_baseline('other', self.tmpdir.name)
+        with self.assertRaises(ValueError):
+            save_baseline('../main', results, self.settings, self.tmpdir.name)
+
+    def test_compare(self):
+        baseline = {'results': [
+            self.cell('pandas', 'fgb', 2.0),
+            self.cell('pandas', 'gpkg', 2.0),
+            self.cell('pandas', 'shp', 2.0),
+            self.cell('duckdb', 'gpkg', math.nan),
+            self.cell('ogr', 'fgb', 1.0),
+        ]}
+        results = [
+            self.cell('pandas', 'fgb', 2.1),
+            self.cell('pandas', 'gpkg', 2.5),
+            self.cell('pandas', 'shp', 1.0),
+            self.cell('duckdb', 'gpkg', math.nan),
+            self.cell('duckdb', 'fgb', 1.0),
+        ]
+        comparison = {(row['process'], row['format']): row for row in compare_results(results, baseline, 0.1)}
+        self.assertEqual(comparison[('pandas', 'fgb')]['status'], 'unchanged')
+        self.assertEqual(comparison[('pandas', 'gpkg')]['status'], 'regression')
+        self.assertEqual(comparison[('pandas', 'shp')]['status'], 'speedup')
+        self.assertEqual(comparison[('pandas', 'shp')]['speedup'], 2.0)
+        self.assertEqual(comparison[('duckdb', 'gpkg')]['status'], 'skipped')
+        self.assertEqual(comparison[('duckdb', 'fgb')]['status'], 'new')
+        self.assertEqual(comparison[('ogr', 'fgb')]['status'], 'missing')
+
+    def test_compare_to_missing_baseline(self):
+        input_path = os.path.join(self.tmpdir.name, 'buildings.csv')
+        open(input_path, 'w').close()
+        result = CliRunner().invoke(
+            main,
+            ['google', 'benchmark', input_path, self.tmpdir.name, '--compare-to', 'main', '--baseline-dir', self.tmpdir.name],
+        )
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn('Invalid value for --compare-to: No baseline called main', result.output)
+
+
+class TestProcessBenchmark(unittest.TestCase):
+    """Tests for `process_benchmark`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmpdir.name, 'buildings.csv')
+        with open(self.csv, 'w') as f:
+            f.write('latitude,longitude,area_in_meters,confidence,geometry,full_plus_code\n')
+            for i in range(5):
+                f.write(f'0.5,{i}.5,10.0,0.9,"POLYGON (({i} 0, {i + 1} 0, {i + 1} 1, {i} 0))",6FG22222+222\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_benchmark(self):
+        results = process_benchmark(self.csv, self.tmpdir.name, ['pandas'], ['fgb'], True, False, warmup=0, repetitions=2)
+        pandas_fgb = results[0]
+        self.assertEqual(pandas_fgb['repetitions'], 2)
+        self.assertEqual(pandas_fgb['execution_time'], pandas_fgb['median'])
+        self.assertEqual(pandas_fgb['output_bytes'], os.path.getsize(os.path.join(self.tmpdir.name, 'buildings.fgb')))
+        for name in ('read', 'transform', 'write'):
+            self.assertGreater(pandas_fgb[f'{name}_seconds'], 0)
+        # DuckDB to GeoPackage is skipped, so it has no measurements rather than a time of zero.
+        results = process_benchmark(self.csv, self.tmpdir.name, ['duckdb'], ['gpkg'], True, False, warmup=0, repetitions=2)
+        self.assertTrue(math.isnan(results[0]['execution_time']))
+
+
+if __name__ == '__main__':
+    unittest.main()
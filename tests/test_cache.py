@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""Tests for the cache of remote partition files."""
+
+
+import os
+import tempfile
+import unittest
+
+import duckdb
+import pyarrow.compute as pc
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from open_buildings.cache import TileCache, cached_parquet_reader, hive_values
+from open_buildings.synthetic import write_overture_parquet
+
+
+class TestTileCache(unittest.TestCase):
+    """Reads partition files from a local folder standing in for the bucket."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.bucket = os.path.join(self.tmpdir.name, 'bucket')
+        self.cache_directory = os.path.join(self.tmpdir.name, 'cache')
+        for country, seed in [('AA', 1), ('BB', 2)]:
+            os.makedirs(os.path.join(self.bucket, f'country_iso={country}'))
+            write_overture_parquet(self.bucket_path(f'country_iso={country}/{country}_0.parquet'), 2000, seed=seed, row_group_size=250)
+        self.filesystem = pafs.SubTreeFileSystem(self.bucket, pafs.LocalFileSystem())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def bucket_path(self, url):
+        return os.path.join(self.bucket, url)
+
+    def cache(self, **kwargs):
+        kwargs.setdefault('max_bytes', 2**30)
+        return TileCache(self.cache_directory, block_size=16 * 1024, filesystem=self.filesystem, **kwargs)
+
+    def test_hits_and_misses(self):
+        url = 'country_iso=AA/AA_0.parquet'
+        expected = pq.read_table(self.bucket_path(url))
+
+        cache = self.cache()
+        self.assertTrue(pq.ParquetFile(cache.open(url)).read().equals(expected))
+        # Every block is fetched once; reading the footer again is already a hit.
+        self.assertGreater(cache.stats['misses'], 0)
+        self.assertEqual(cache.stats['bytes_fetched'], os.path.getsize(self.bucket_path(url)))
+
+        # A new cache on the same folder, like the next run, reads it all from disk.
+        cache = self.cache()
+        self.assertTrue(pq.ParquetFile(cache.open(url)).read().equals(expected))
+        self.assertEqual((cache.stats['misses'], cache.stats['bytes_fetched']), (0, 0))
+        self.assertGreater(cache.stats['hits'], 0)
+        self.assertIn('0 misses', cache.summary())
+
+    def test_byte_ranges(self):
+        # Reading one row group only fetches the blocks it and the footer are in.
+        url = 'country_iso=AA/AA_0.parquet'
+        cache = self.cache()
+        row_group = pq.ParquetFile(cache.open(url)).read_row_group(3)
+        self.assertTrue(row_group.equals(pq.ParquetFile(self.bucket_path(url)).read_row_group(3)))
+        self.assertLess(cache.stats['bytes_fetched'], os.path.getsize(self.bucket_path(url)) / 2)
+
+    def test_changed_file(self):
+        url = 'country_iso=AA/AA_0.parquet'
+        cache = self.cache()
+        pq.ParquetFile(cache.open(url)).read()
+        write_overture_parquet(self.bucket_path(url), 500, seed=9)
+        misses = cache.stats['misses']
+        self.assertEqual(pq.ParquetFile(cache.open(url)).read().num_rows, 500)
+        self.assertGreater(cache.stats['misses'], misses)
+
+    def test_eviction(self):
+        url = 'country_iso=AA/AA_0.parquet'
+        cache = self.cache(max_bytes=64 * 1024)
+        self.assertTrue(pq.ParquetFile(cache.open(url)).read().equals(pq.read_table(self.bucket_path(url))))
+        self.assertLessEqual(cache.total_bytes, 64 * 1024)
+        self.assertGreater(cache.stats['evicted'], 0)
+        on_disk = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(self.cache_directory) for name in names)
+        self.assertEqual(on_disk, cache.total_bytes)
+
+    def test_missing_file(self):
+        with self.assertRaises(FileNotFoundError):
+            self.cache().open('country_iso=CC/CC_0.parquet')
+
+    def test_cached_parquet_reader(self):
+        self.assertEqual(hive_values('s3://bucket/data/country_iso=AA/AA_0.parquet'), {'country_iso': 'AA'})
+        files = ['country_iso=AA/AA_0.parquet', 'country_iso=BB/BB_0.parquet']
+        conn = duckdb.connect()
+        reader, pruning = cached_parquet_reader(self.cache(), files, hive_partitioning=True)
+        self.assertEqual((pruning['row_groups'], pruning['row_groups_skipped']), (16, 0))
+        conn.register('cached_partitions', reader)
+        rows = conn.execute(
+            "SELECT country_iso, COUNT(*), COUNT(DISTINCT id) FROM cached_partitions GROUP BY country_iso ORDER BY country_iso"
+        ).fetchall()
+        self.assertEqual(rows, [('AA', 2000, 2000), ('BB', 2000, 2000)])
+
+    def test_columns(self):
+        files = ['country_iso=AA/AA_0.parquet', 'country_iso=BB/BB_0.parquet']
+        # Blocks small enough to fall between the column chunks of these little files.
+        cache = TileCache(os.path.join(self.tmpdir.name, 'columns'), block_size=1024, filesystem=self.filesystem)
+        reader, _ = cached_parquet_reader(cache, files, hive_partitioning=True, columns=['id', 'country_iso', 'missing'])
+        table = reader.read_all()
+        self.assertEqual(table.schema.names, ['id', 'country_iso'])
+        self.assertEqual(table.num_rows, 4000)
+        self.assertEqual(set(table['country_iso'].to_pylist()), {'AA', 'BB'})
+        # The geometry is most of each file, and is never fetched.
+        full = TileCache(os.path.join(self.tmpdir.name, 'full'), block_size=1024, filesystem=self.filesystem)
+        cached_parquet_reader(full, files, hive_partitioning=True)[0].read_all()
+        self.assertLess(cache.stats['bytes_fetched'], full.stats['bytes_fetched'] / 2)
+
+    def test_row_group_pruning(self):
+        # Sorted west to east, so each row group covers a band of longitude.
+        url = 'country_iso=CC/CC_0.parquet'
+        table = pq.read_table(self.bucket_path('country_iso=AA/AA_0.parquet'))
+        table = table.take(pc.sort_indices(pc.struct_field(table['bbox'], 'minx')))
+        os.makedirs(self.bucket_path('country_iso=CC'))
+        pq.write_table(table, self.bucket_path(url), row_group_size=250)
+
+        bounds = (-10, -60, 10, 80)
+        cache = self.cache()
+        reader, pruning = cached_parquet_reader(cache, [url], bounds=bounds)
+        read = reader.read_all()
+        self.assertEqual(pruning['row_groups'], 8)
+        self.assertGreater(pruning['row_groups_skipped'], 4)
+        # The skipped row groups are never fetched, beyond the edges of the blocks around them.
+        # (pyarrow always reads the last 64KB for the footer, so compare with reading it all.)
+        full = TileCache(os.path.join(self.tmpdir.name, 'full'), block_size=16 * 1024, filesystem=self.filesystem)
+        cached_parquet_reader(full, [url])[0].read_all()
+        self.assertLess(cache.stats['bytes_fetched'], full.stats['bytes_fetched'] - pruning['bytes_skipped'] / 2)
+
+        # Every building in the bounds is still there.
+        minx = pc.struct_field(table['bbox'], 'minx')
+        maxx = pc.struct_field(table['bbox'], 'maxx')
+        inside = table.filter(pc.and_(pc.less_equal(minx, 10), pc.greater_equal(maxx, -10)))
+        self.assertTrue(set(inside['id'].to_pylist()) <= set(read['id'].to_pylist()))
+        self.assertLess(read.num_rows, table.num_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Tests for the shared DuckDB connections."""
+
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from open_buildings import connection
+from open_buildings.connection import close_shared_connections, connect, is_remote, load_extension, shared_connection
+
+
+class TestConnection(unittest.TestCase):
+    """Tests for `open_buildings.connection`."""
+
+    def tearDown(self):
+        close_shared_connections()
+
+    def test_connect(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'buildings.duckdb')
+            conn = connect(path, extensions=('json',), memory_limit='100MB', threads=2)
+            self.assertEqual(conn.execute("SELECT current_setting('threads')").fetchone()[0], 2)
+            self.assertIn(conn.execute("SELECT current_setting('memory_limit')").fetchone()[0], ('95.3 MiB', '100.0 MB'))
+            loaded = conn.execute("SELECT loaded FROM duckdb_extensions() WHERE extension_name = 'json'").fetchone()[0]
+            self.assertTrue(loaded)
+            conn.close()
+
+    def test_extension_checked_once(self):
+        with mock.patch.object(connection, '_installed_extensions', set()):
+            conn = mock.MagicMock()
+            conn.execute.return_value.fetchone.return_value = (False,)
+            load_extension(conn, 'spatial')
+            load_extension(conn, 'spatial')
+        statements = [c.args[0] for c in conn.execute.call_args_list]
+        self.assertEqual(sum('duckdb_extensions()' in s for s in statements), 1)
+        self.assertEqual(statements.count('INSTALL spatial;'), 1)
+        self.assertEqual(statements.count('LOAD spatial;'), 2)
+
+    def test_shared_connection(self):
+        first = shared_connection(extensions=('json',), threads=1)
+        first.execute("CREATE TABLE shared AS SELECT 1 AS x")
+        first.execute("CREATE TEMP TABLE buildings AS SELECT 1 AS x")
+
+        # The same settings get a cursor on the same database, but not its temporary tables.
+        second = shared_connection(extensions=('json',), threads=1)
+        self.assertEqual(second.execute("SELECT x FROM shared").fetchone()[0], 1)
+        second.execute("CREATE TEMP TABLE buildings AS SELECT 2 AS x")
+        self.assertEqual(first.execute("SELECT x FROM buildings").fetchone()[0], 1)
+
+        # Different settings get a connection of their own.
+        other = shared_connection(extensions=('json',), threads=2)
+        self.assertEqual(other.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'shared'").fetchone()[0], 0)
+
+    def test_is_remote(self):
+        self.assertTrue(is_remote('s3://us-west-2.opendata.source.coop/cholmes/overture/*/*.parquet'))
+        self.assertTrue(is_remote('https://example.com/buildings.parquet'))
+        self.assertFalse(is_remote('/data/buildings/*.parquet'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Tests for the STRtree backed country assignment."""
+
+
+import os
+import tempfile
+import unittest
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import MultiPolygon, box
+
+from open_buildings.countries import INSIDE, OUTSIDE, CountryCoverage, CountryIndex, register_country_function
+
+
+class TestCountryIndex(unittest.TestCase):
+    """Assigns buildings to two made up countries that share a border at lon 10."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.country_parquet_path = os.path.join(self.tmpdir.name, 'countries.parquet')
+        # AA has an overseas part, so its bbox covers BB as well.
+        aa = MultiPolygon([box(0, 0, 10, 10), box(50, 50, 51, 51)])
+        bb = box(10, 0, 20, 10)
+        pq.write_table(pa.table({
+            'isocountrycodealpha2': ['AA', 'BB'],
+            'geometry': shapely.to_wkb([aa, bb]),
+        }), self.country_parquet_path)
+        self.buildings = [
+            box(1, 1, 1.1, 1.1),        # AA
+            box(15, 5, 15.1, 5.1),      # BB, inside AA's bbox but not AA
+            box(9.95, 5, 10.05, 5.1),   # on the border, first country wins
+            box(50.5, 50.5, 50.6, 50.6),  # AA overseas
+            box(30, 30, 30.1, 30.1),    # nowhere
+        ]
+        self.expected = ['AA', 'BB', 'AA', 'AA', None]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lookup(self):
+        index = CountryIndex.from_parquet(self.country_parquet_path)
+        self.assertEqual(list(index.lookup(self.buildings)), self.expected)
+
+    def test_duckdb_function(self):
+        con = duckdb.connect()
+        register_country_function(con, CountryIndex.from_parquet(self.country_parquet_path))
+        con.register('buildings', pa.table({'id': list(range(len(self.buildings))), 'geometry': shapely.to_wkb(self.buildings)}))
+        rows = con.execute("SELECT country_iso_for(geometry) FROM buildings ORDER BY id").fetchall()
+        self.assertEqual([r[0] for r in rows], self.expected)
+
+
+class TestCountryCoverage(TestCountryIndex):
+    """Runs the same buildings through a coverage table built from the two countries."""
+
+    def setUp(self):
+        super().setUp()
+        self.coverage_path = os.path.join(self.tmpdir.name, 'coverage.parquet')
+        CountryCoverage.build(CountryIndex.from_parquet(self.country_parquet_path), max_zoom=8).to_parquet(self.coverage_path)
+
+    def test_lookup(self):
+        index = CountryIndex.from_parquet(self.country_parquet_path, coverage_path=self.coverage_path)
+        self.assertEqual(list(index.lookup(self.buildings)), self.expected)
+
+    def test_interior_and_ocean_tiles_resolve_without_geometry(self):
+        coverage = CountryCoverage.from_parquet(self.coverage_path)
+        self.assertEqual(coverage.max_zoom, 8)
+        resolved, countries = coverage.lookup_bounds(shapely.bounds(self.buildings))
+        # The border building and the small overseas part (smaller than a zoom 8 tile) need the tree.
+        self.assertEqual(resolved.tolist(), [True, True, False, False, True])
+        self.assertEqual(countries[resolved].tolist(), ['AA', 'BB', None])
+        self.assertEqual(coverage.leaves[coverage.leaf('0' * 8)][0], OUTSIDE)
+
+    def test_countries_for_bounds(self):
+        coverage = CountryCoverage.from_parquet(self.coverage_path)
+        self.assertEqual(coverage.countries_for_bounds((1, 1, 2, 2)), ['AA'])
+        self.assertEqual(coverage.countries_for_bounds((9, 1, 11, 2)), ['AA', 'BB'])
+        self.assertEqual(coverage.countries_for_bounds((30, 30, 31, 31)), [])
+        self.assertIn(INSIDE, {status for status, _ in coverage.leaves.values()})
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""Tests for the batch download of many AOIs."""
+
+
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import box, mapping
+
+from open_buildings.connection import extension_available
+from open_buildings.download_buildings import (
+    batch_query,
+    download_batch,
+    group_aois,
+    output_format,
+    output_name,
+    read_aois,
+)
+from open_buildings.partitions import write_manifest
+from open_buildings.quadkey import lon_lat_to_quadkeys
+from open_buildings.synthetic import write_overture_parquet
+
+
+def feature_collection(aois):
+    return json.dumps({
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'id': aoi_id, 'properties': {}, 'geometry': mapping(geometry)} for aoi_id, geometry in aois],
+    })
+
+
+class TestBatchDownload(unittest.TestCase):
+    """Tests for the parts of `download_batch` that don't need the spatial extension."""
+
+    def features(self):
+        return [
+            {'type': 'Feature', 'id': 'north', 'properties': {'name': 'a'}, 'geometry': mapping(box(0, 1, 1, 2))},
+            {'type': 'Feature', 'id': 'south', 'properties': {'name': 'b'}, 'geometry': mapping(box(0, -1, 1, 0))},
+        ]
+
+    def test_read_aois(self):
+        collection = json.dumps({'type': 'FeatureCollection', 'features': self.features()})
+        aois = read_aois(collection)
+        self.assertEqual([aoi_id for aoi_id, _ in aois], ['north', 'south'])
+        self.assertEqual(aois[1][1].bounds, (0.0, -1.0, 1.0, 0.0))
+        self.assertEqual([aoi_id for aoi_id, _ in read_aois(collection, id_property='name')], ['a', 'b'])
+
+        # Newline-delimited, with a bare geometry and a feature without an id numbered by position.
+        lines = [json.dumps(self.features()[0]), '', json.dumps(mapping(box(2, 2, 3, 3))), '\x1e' + json.dumps({'type': 'Feature', 'geometry': mapping(box(4, 4, 5, 5))})]
+        self.assertEqual([aoi_id for aoi_id, _ in read_aois('\n'.join(lines))], ['north', '1', '2'])
+        # A single feature is a batch of one.
+        self.assertEqual(len(read_aois(json.dumps(self.features()[0]))), 1)
+
+        with self.assertRaises(ValueError):
+            read_aois('\n'.join([json.dumps(self.features()[0])] * 2))
+        with self.assertRaises(ValueError):
+            read_aois(collection, id_property='missing')
+
+    def test_group_aois(self):
+        aoi_files = [['a', 'b'], ['c'], [], ['b'], ['d', 'c'], ['e']]
+        self.assertEqual(group_aois(aoi_files), [(['a', 'b'], [0, 3]), (['c', 'd'], [1, 4]), (['e'], [5])])
+        # A later AOI can join two groups.
+        self.assertEqual(group_aois([['a'], ['b'], ['b', 'a']]), [(['a', 'b'], [0, 1, 2])])
+
+    def test_outputs(self):
+        self.assertEqual(output_format('out/{id}.fgb'), ('out/{id}.fgb', 'flatgeobuf'))
+        self.assertEqual(output_format('buildings', 'parquet'), ('buildings.parquet', 'parquet'))
+        self.assertEqual(output_name('site 1/b'), 'site_1_b')
+
+        query = batch_query('cached_partitions', "WHERE quadkey IN ('0')", ['id', 'quadkey'], has_bbox=True)
+        self.assertIn("SELECT r.aoi_id, b.id, b.quadkey, ST_AsWKB", query)
+        self.assertIn("b.bbox.minx <= a.aoi_maxx", query)
+        self.assertNotIn("bbox", batch_query('cached_partitions', "WHERE TRUE"))
+
+    def test_shared_output_names(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            aois = feature_collection([('a/b', box(0, 0, 1, 1)), ('a_b', box(2, 2, 3, 3))])
+            with self.assertRaises(ValueError):
+                download_batch(io.StringIO(aois), os.path.join(tmpdir, '{id}.parquet'), True, False, False, os.path.join(tmpdir, '*', '*.parquet'), True, None)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+
+@unittest.skipUnless(extension_available('spatial'), "needs DuckDB's spatial extension")
+class TestBatchDownloadQuery(unittest.TestCase):
+    """Runs batches against a small local hive folder of two countries and checks every AOI gets
+    the buildings within it."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = os.path.join(self.tmpdir.name, 'data')
+        self.data_path = os.path.join(self.data, '*', '*.parquet')
+        self.tables = []
+        for country, bounds in [('AA', (0, 0, 1, 1)), ('BB', (5, 5, 6, 6))]:
+            path = os.path.join(self.data, f'country_iso={country}', f'{country}.parquet')
+            os.makedirs(os.path.dirname(path))
+            write_overture_parquet(path, 2000, distribution='uniform', bounds=bounds, seed=1)
+            table = pq.read_table(path)
+            bbox = table['bbox']
+            lon = pc.divide(pc.add(pc.struct_field(bbox, 'minx'), pc.struct_field(bbox, 'maxx')), 2)
+            lat = pc.divide(pc.add(pc.struct_field(bbox, 'miny'), pc.struct_field(bbox, 'maxy')), 2)
+            table = table.append_column('quadkey', lon_lat_to_quadkeys(lon.to_numpy(), lat.to_numpy(), 12))
+            table = table.take(pc.sort_indices(table['quadkey']))
+            pq.write_table(table, path, row_group_size=200)
+            self.tables.append(table)
+        # With the manifest the files can be told apart, so AA and BB are separate groups.
+        write_manifest(self.data)
+        self.aois = [
+            ('a0', box(0.1, 0.1, 0.3, 0.3)),
+            ('a1', box(0.2, 0.2, 0.5, 0.5)),
+            ('b0', box(5.2, 5.2, 5.4, 5.4)),
+            ('far', box(30, 30, 31, 31)),
+        ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def expected(self):
+        counts = {}
+        for aoi_id, geometry in self.aois:
+            within = sum(int(shapely.within(shapely.from_wkb(t['geometry'].to_numpy(zero_copy_only=False)), geometry).sum()) for t in self.tables)
+            if within:
+                counts[aoi_id] = within
+        return counts
+
+    def download(self, dst, overwrite=False):
+        download_batch(io.StringIO(feature_collection(self.aois)), dst, True, overwrite, False, self.data_path, True, None)
+
+    def test_one_output(self):
+        dst = os.path.join(self.tmpdir.name, 'buildings.parquet')
+        self.download(dst)
+        table = pq.read_table(dst)
+        self.assertEqual(table.schema.names[0], 'aoi_id')
+        counts = {row['aoi_id']: row['id_count'] for row in table.group_by('aoi_id').aggregate([('id', 'count')]).to_pylist()}
+        expected = self.expected()
+        self.assertEqual(counts, expected)
+        # a0 and a1 overlap, so the buildings in both are there once for each.
+        self.assertEqual(set(expected), {'a0', 'a1', 'b0'})
+
+    def test_output_per_aoi(self):
+        dst = os.path.join(self.tmpdir.name, 'out', '{id}.parquet')
+        self.download(dst)
+        output_folder = os.path.join(self.tmpdir.name, 'out')
+        files = sorted(os.listdir(output_folder))
+        self.assertEqual(files, ['a0.parquet', 'a1.parquet', 'b0.parquet'])
+        counts = {f[:-len('.parquet')]: pq.read_table(os.path.join(output_folder, f)).num_rows for f in files}
+        self.assertEqual(counts, self.expected())
+        self.assertNotIn('aoi_id', pq.read_schema(os.path.join(output_folder, 'a0.parquet')).names)
+
+        # A rerun leaves the files that are there alone.
+        modified = os.path.getmtime(os.path.join(output_folder, 'a0.parquet'))
+        self.download(dst)
+        self.assertEqual(os.path.getmtime(os.path.join(output_folder, 'a0.parquet')), modified)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Tests for writing GeoParquet without a gpq round-trip."""
+
+
+import json
+import os
+import tempfile
+import unittest
+
+import duckdb
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import MultiPolygon, box
+
+from open_buildings.geoparquet import GeoParquetWriter, convert_parquet_to_geoparquet, write_query_to_geoparquet
+
+
+class TestGeoParquetWriter(unittest.TestCase):
+    """Tests for `open_buildings.geoparquet`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'out.parquet')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_batch(self, geometries, start=0):
+        return pa.record_batch({
+            'id': pa.array(range(start, start + len(geometries)), type=pa.int64()),
+            'geometry': pa.array(shapely.to_wkb(geometries), type=pa.binary()),
+        })
+
+    def test_geo_metadata(self):
+        batch = self.make_batch([box(0, 0, 1, 1), MultiPolygon([box(5, 5, 6, 7), box(-2, -3, -1, -1)])])
+        with GeoParquetWriter(self.path, batch.schema) as writer:
+            writer.write_batch(batch)
+
+        geo = json.loads(pq.read_schema(self.path).metadata[b'geo'])
+        self.assertEqual(geo['primary_column'], 'geometry')
+        column = geo['columns']['geometry']
+        self.assertEqual(column['encoding'], 'WKB')
+        self.assertEqual(column['geometry_types'], ['MultiPolygon', 'Polygon'])
+        self.assertEqual(column['bbox'], [-2.0, -3.0, 6.0, 7.0])
+
+        gdf = gpd.read_parquet(self.path)
+        self.assertEqual(len(gdf), 2)
+        self.assertEqual(gdf.geometry.iloc[0], box(0, 0, 1, 1))
+
+    def test_row_groups_span_batches(self):
+        geometries = [box(i, i, i + 1, i + 1) for i in range(25)]
+        with GeoParquetWriter(self.path, self.make_batch(geometries[:1]).schema, row_group_size=10) as writer:
+            for start in range(0, 25, 7):
+                writer.write_batch(self.make_batch(geometries[start:start + 7], start))
+
+        metadata = pq.ParquetFile(self.path).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [10, 10, 5])
+        self.assertEqual(pq.read_table(self.path).column('id').to_pylist(), list(range(25)))
+
+    def test_failed_write_removed(self):
+        batch = self.make_batch([box(0, 0, 1, 1)])
+        with self.assertRaises(RuntimeError):
+            with GeoParquetWriter(self.path, batch.schema) as writer:
+                writer.write_batch(batch)
+                raise RuntimeError('query failed')
+        # Nothing is left that a skip-if-exists resume would take as done.
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_write_query(self):
+        conn = duckdb.connect()
+        conn.execute("CREATE TABLE t (id INTEGER, geometry BLOB)")
+        conn.execute("INSERT INTO t VALUES (1, ?), (2, ?)", [shapely.to_wkb(box(0, 0, 1, 1)), shapely.to_wkb(box(2, 2, 3, 3))])
+
+        rows = write_query_to_geoparquet(conn, "SELECT * FROM t ORDER BY id DESC", self.path)
+        self.assertEqual(rows, 2)
+        self.assertEqual(pq.read_table(self.path).column('id').to_pylist(), [2, 1])
+        geo = json.loads(pq.read_schema(self.path).metadata[b'geo'])
+        self.assertEqual(geo['columns']['geometry']['bbox'], [0.0, 0.0, 3.0, 3.0])
+
+    def test_convert_in_place(self):
+        geometries = [box(i, 0, i + 1, 1) for i in range(12)]
+        pq.write_table(pa.Table.from_batches([self.make_batch(geometries)]), self.path, row_group_size=5)
+
+        self.assertEqual(convert_parquet_to_geoparquet(self.path, row_group_size=4), 12)
+        metadata = pq.ParquetFile(self.path).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [4, 4, 4])
+        self.assertFalse(os.path.exists(self.path.replace('.parquet', '_geo.parquet')))
+        gdf = gpd.read_parquet(self.path)
+        self.assertEqual(list(gdf.total_bounds), [0.0, 0.0, 12.0, 1.0])
+
+    def test_convert_in_place_without_extension(self):
+        # A .parquet in a folder name, and a file name without it.
+        folder = os.path.join(self.tmpdir.name, 'tiles.parquet')
+        os.makedirs(folder)
+        path = os.path.join(folder, 'part')
+        pq.write_table(pa.Table.from_batches([self.make_batch([box(0, 0, 1, 1)])]), path)
+
+        self.assertEqual(convert_parquet_to_geoparquet(path), 1)
+        self.assertEqual(os.listdir(folder), ['part'])
+        self.assertIn(b'geo', pq.read_schema(path).metadata)
+
+    def test_convert_hex_geometry(self):
+        input_path = os.path.join(self.tmpdir.name, 'hex.parquet')
+        pq.write_table(pa.table({'id': [1], 'geometry': [shapely.to_wkb(box(0, 0, 1, 1), hex=True)]}), input_path)
+
+        convert_parquet_to_geoparquet(input_path, self.path)
+        self.assertTrue(pa.types.is_binary(pq.read_schema(self.path).field('geometry').type))
+        self.assertEqual(gpd.read_parquet(self.path).geometry.iloc[0], box(0, 0, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""Tests for the Google Open Buildings CSV conversion."""
+
+
+import os
+import tempfile
+import unittest
+
+import duckdb
+import geopandas as gpd
+import pandas as pd
+import shapely
+from openlocationcode import openlocationcode as olc
+from shapely.geometry import MultiPolygon, box
+
+from open_buildings.connection import extension_available
+from open_buildings.google.process import (
+    NOT_MULTIPOLYGON,
+    next_file_to_start,
+    process_geometries,
+    process_with_duckdb,
+    process_with_pandas,
+    split_multipolygons_gdf,
+)
+
+
+class TestSplitMultipolygons(unittest.TestCase):
+    """Tests for `split_multipolygons_gdf`."""
+
+    def setUp(self):
+        self.multi = MultiPolygon([box(30.0, -1.0, 30.001, -0.999), box(30.01, -1.0, 30.0105, -0.9995)])
+        self.other_multi = MultiPolygon([box(31.0, 2.0, 31.0002, 2.0002), box(31.1, 2.0, 31.1001, 2.0001)])
+        self.polygon = box(29.0, -2.0, 29.0003, -1.9997)
+        self.gdf = gpd.GeoDataFrame(
+            {
+                'area_in_meters': [1.0, 2.0, 3.0],
+                'confidence': [0.9, 0.8, 0.7],
+                'full_plus_code': ['a', 'b', 'c'],
+            },
+            geometry=[self.polygon, self.multi, self.other_multi],
+            crs='EPSG:4326',
+        )
+
+    def expected_part(self, polygon):
+        # What the row by row version computed for each part.
+        area = gpd.GeoSeries([polygon], crs='EPSG:4326').to_crs('EPSG:6933').area.values[0]
+        centroid = polygon.centroid
+        return area, olc.encode(centroid.y, centroid.x, codeLength=12)
+
+    def test_split(self):
+        output = split_multipolygons_gdf(self.gdf)
+
+        self.assertEqual(list(output.columns), list(self.gdf.columns))
+        expected_geometries = list(self.multi.geoms) + list(self.other_multi.geoms) + [self.polygon]
+        self.assertEqual(list(output.geometry), expected_geometries)
+        self.assertEqual(list(output['confidence']), [0.8, 0.8, 0.7, 0.7, 0.9])
+
+        for i, polygon in enumerate(expected_geometries[:4]):
+            area, plus_code = self.expected_part(polygon)
+            self.assertAlmostEqual(output['area_in_meters'].iloc[i], area, places=6)
+            self.assertEqual(output['full_plus_code'].iloc[i], plus_code)
+        # The original polygon keeps its values.
+        self.assertEqual(output['area_in_meters'].iloc[4], 1.0)
+        self.assertEqual(output['full_plus_code'].iloc[4], 'a')
+
+    def test_no_multipolygons(self):
+        output = split_multipolygons_gdf(self.gdf.iloc[:1])
+        self.assertEqual(len(output), 1)
+        self.assertEqual(output.geometry.iloc[0], self.polygon)
+
+
+class TestParallelConvert(unittest.TestCase):
+    """Tests for converting a directory of CSVs with --jobs."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self.tmpdir.name, 'csv')
+        self.output_dir = os.path.join(self.tmpdir.name, 'out')
+        os.makedirs(self.input_dir)
+        os.makedirs(self.output_dir)
+        for name, rows in (('small', 1), ('medium', 3), ('large', 6)):
+            with open(os.path.join(self.input_dir, f'{name}.csv'), 'w') as f:
+                f.write('latitude,longitude,area_in_meters,confidence,geometry,full_plus_code\n')
+                for i in range(rows):
+                    f.write(f'0.5,{i}.5,10.0,0.9,"POLYGON (({i} 0, {i + 1} 0, {i + 1} 1, {i} 0))",6FG22222+222\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_next_file_to_start(self):
+        estimates = {'a': 6, 'b': 3, 'c': 1}
+        pending = ['a', 'b', 'c']
+        self.assertEqual(next_file_to_start(pending, [], estimates, None), 'a')
+        # Biggest first, but only what fits alongside the running files.
+        self.assertEqual(next_file_to_start(pending[1:], ['a'], estimates, 8), 'c')
+        self.assertIsNone(next_file_to_start(['b'], ['a'], estimates, 8))
+        # A file bigger than the budget still runs when nothing else is.
+        self.assertEqual(next_file_to_start(['a'], [], estimates, 2), 'a')
+
+    def test_parallel_convert(self):
+        results = process_geometries(self.input_dir, self.output_dir, 'parquet', False, 'pandas', True, False, 'none', jobs=2)
+        self.assertEqual(sorted(os.path.basename(r['file']) for r in results), ['large.csv', 'medium.csv', 'small.csv'])
+        self.assertEqual(len(gpd.read_parquet(os.path.join(self.output_dir, 'large.parquet'))), 6)
+
+
+class TestChunkedConvert(unittest.TestCase):
+    """The chunked pandas conversion should write the same rows as reading the whole file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmpdir.name, 'buildings.csv')
+        with open(self.csv, 'w') as f:
+            f.write('latitude,longitude,area_in_meters,confidence,geometry,full_plus_code\n')
+            for i in range(7):
+                f.write(f'0.5,{i}.5,10.0,0.9,"POLYGON (({i} 0, {i + 1} 0, {i + 1} 1, {i} 0))",6FG22222+222\n')
+            f.write('0.5,20.5,10.0,0.8,"MULTIPOLYGON (((20 0, 20.1 0, 20.1 0.1, 20 0)), ((21 0, 21.1 0, 21.1 0.1, 21 0)))",6FG22222+222\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def convert(self, format, chunk_size):
+        output = os.path.join(self.tmpdir.name, f'{chunk_size}.{format}')
+        process_with_pandas(self.csv, True, False, format, output, chunk_size)
+        return gpd.read_file(output) if format != 'parquet' else gpd.read_parquet(output)
+
+    def test_chunked_matches_whole_file(self):
+        for format in ('parquet', 'fgb', 'gpkg'):
+            whole = self.convert(format, None).sort_values('confidence', kind='stable').reset_index(drop=True)
+            chunked = self.convert(format, 3).sort_values('confidence', kind='stable').reset_index(drop=True)
+            self.assertEqual(len(chunked), 9)
+            self.assertEqual(list(chunked.geometry.to_wkt()), list(whole.geometry.to_wkt()))
+            self.assertEqual(list(chunked['full_plus_code']), list(whole['full_plus_code']))
+            self.assertEqual(chunked.crs.to_epsg(), 4326)
+
+
+class TestNotMultipolygon(unittest.TestCase):
+    """The rows the split passes through, which needs no spatial extension to check."""
+
+    def test_keeps_null_geometries(self):
+        conn = duckdb.connect()
+        conn.execute(
+            "CREATE TABLE buildings AS SELECT * FROM (VALUES "
+            "('POLYGON ((0 0, 1 0, 1 1, 0 0))'), ('MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)))'), (NULL)) t(geometry)"
+        )
+        kept = conn.execute(f"SELECT geometry FROM buildings WHERE {NOT_MULTIPOLYGON} ORDER BY geometry").fetchall()
+        self.assertEqual(kept, [('POLYGON ((0 0, 1 0, 1 1, 0 0))',), (None,)])
+        conn.close()
+
+
+@unittest.skipUnless(extension_available('spatial'), "needs DuckDB's spatial extension")
+class TestDuckDBSplit(unittest.TestCase):
+    """The one-statement split in DuckDB should give the same parts as the GeoPandas one."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmpdir.name, 'buildings.csv')
+        with open(self.csv, 'w') as f:
+            f.write('latitude,longitude,area_in_meters,confidence,geometry,full_plus_code\n')
+            f.write('-1.5,29.5,10.0,0.9,"POLYGON ((29.5 -1.5, 29.5003 -1.5, 29.5003 -1.4997, 29.5 -1.5))",6FG22222+222\n')
+            f.write('-1.0,30.0,20.0,0.8,"MULTIPOLYGON (((30 -1, 30.001 -1, 30.001 -0.999, 30 -1)), ((30.01 -1, 30.0105 -1, 30.0105 -0.9995, 30.01 -1)))",6FG22222+222\n')
+            f.write('60.0,10.0,30.0,0.7,"MULTIPOLYGON (((10 60, 10.0002 60, 10.0002 60.0002, 10 60)), ((10.1 60, 10.1001 60, 10.1001 60.0001, 10.1 60)), ((10.2 60, 10.2001 60, 10.2 60.0001, 10.2 60)))",6FG22222+222\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_matches_geopandas(self):
+        output = os.path.join(self.tmpdir.name, 'buildings.parquet')
+        process_with_duckdb(self.csv, os.path.join(self.tmpdir.name, 'buildings.duckdb'), True, False, 'parquet', output, 'native')
+        duck = gpd.read_parquet(output)
+
+        df = pd.read_csv(self.csv).drop(['latitude', 'longitude'], axis=1)
+        expected = split_multipolygons_gdf(gpd.GeoDataFrame(df, geometry=shapely.from_wkt(df['geometry'].values), crs='EPSG:4326'))
+
+        self.assertEqual(len(duck), len(expected))
+        self.assertEqual(len(duck), 6)
+        duck = duck.assign(wkt=duck.geometry.to_wkt()).sort_values('wkt').reset_index(drop=True)
+        expected = expected.assign(wkt=expected.geometry.to_wkt()).sort_values('wkt').reset_index(drop=True)
+        self.assertEqual(list(duck['wkt']), list(expected['wkt']))
+        self.assertEqual(list(duck['full_plus_code']), list(expected['full_plus_code']))
+        self.assertEqual(list(duck['confidence']), list(expected['confidence']))
+        for duck_area, expected_area in zip(duck['area_in_meters'], expected['area_in_meters']):
+            self.assertAlmostEqual(duck_area, expected_area, delta=expected_area * 1e-6)
+
+    def test_keeps_null_geometries(self):
+        with open(self.csv, 'a') as f:
+            f.write('0.0,0.0,40.0,0.6,,6FG22222+222\n')
+        output = os.path.join(self.tmpdir.name, 'buildings.parquet')
+        process_with_duckdb(self.csv, os.path.join(self.tmpdir.name, 'buildings.duckdb'), True, False, 'parquet', output, 'native')
+        duck = gpd.read_parquet(output)
+        self.assertEqual(len(duck), 7)
+        self.assertEqual(duck.geometry.isna().sum(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""Tests for adding quadkey and country columns to Overture files."""
+
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import box
+
+from open_buildings.countries import CountryIndex
+from open_buildings.overture import add_columns
+from open_buildings.overture.add_columns import (
+    add_columns_query,
+    load_ledger,
+    parse_memory_limit,
+    process_parquet_file,
+    process_parquet_files,
+    worker_settings,
+)
+from open_buildings.quadkey import lon_lat_to_quadkeys
+from open_buildings.synthetic import write_overture_parquet
+
+
+class TestStreamingAddColumns(unittest.TestCase):
+    """Runs synthetic buildings over two made up countries through the streaming add_columns."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.country_parquet_path = self.path('countries.parquet')
+        pq.write_table(pa.table({
+            'isocountrycodealpha2': ['AA', 'BB'],
+            'geometry': shapely.to_wkb([box(0, 0, 1, 1), box(1, 0, 2, 1)]),
+        }), self.country_parquet_path)
+        self.input_path = self.path('input_buildings')
+        write_overture_parquet(self.input_path, 3000, distribution='uniform', bounds=(0.5, 0.2, 2.5, 0.8), seed=7)
+        self.output_folder = self.path('out')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def check_output(self, output_path):
+        gdf = gpd.read_parquet(output_path)
+        self.assertEqual(len(gdf), 3000)
+        quadkeys = list(gdf['quadkey'])
+        self.assertEqual(quadkeys, sorted(quadkeys))
+
+        bbox = gdf['bbox'].apply(lambda b: ((b['minx'] + b['maxx']) / 2, (b['miny'] + b['maxy']) / 2))
+        expected_quadkeys = lon_lat_to_quadkeys([b[0] for b in bbox], [b[1] for b in bbox], 12).to_pylist()
+        self.assertEqual(quadkeys, expected_quadkeys)
+
+        expected_countries = list(CountryIndex.from_parquet(self.country_parquet_path).lookup(gdf.geometry.values))
+        # Read through Arrow, as pandas turns the missing codes into NaN.
+        self.assertEqual(pq.read_table(output_path, columns=['country_iso'])['country_iso'].to_pylist(), expected_countries)
+        self.assertEqual(set(expected_countries), {'AA', 'BB', None})
+
+    def test_streaming(self):
+        temp_directory = self.path('spill')
+        process_parquet_file(
+            self.input_path, self.output_folder, self.country_parquet_path, add_quadkey_option=True,
+            add_country_iso_option=True, geo_conversion='native', memory_limit='200MB', temp_directory=temp_directory, threads=2,
+        )
+        self.check_output(os.path.join(self.output_folder, 'buildings.parquet'))
+        # Nothing is left behind but the output.
+        self.assertEqual(os.listdir(self.output_folder), ['buildings.parquet'])
+
+    def test_streaming_copy(self):
+        process_parquet_file(
+            self.input_path, self.output_folder, self.country_parquet_path, add_quadkey_option=True,
+            add_country_iso_option=True, geo_conversion='none',
+        )
+        output_path = os.path.join(self.output_folder, 'buildings.parquet')
+        self.assertEqual(pq.read_table(output_path).num_rows, 3000)
+
+    def test_existing_columns_replaced(self):
+        table = pq.read_table(self.input_path).append_column('quadkey', pa.array(['x'] * 3000))
+        pq.write_table(table, self.input_path)
+        query = add_columns_query(self.input_path, True, False)
+        self.assertIn("* REPLACE (lat_lon_to_quadkey", query)
+        self.assertTrue(query.endswith("ORDER BY quadkey"))
+
+        process_parquet_file(
+            self.input_path, self.output_folder, self.country_parquet_path, add_quadkey_option=True,
+            add_country_iso_option=True, geo_conversion='native',
+        )
+        self.check_output(os.path.join(self.output_folder, 'buildings.parquet'))
+
+    def test_no_columns(self):
+        query = add_columns_query(self.input_path, False, False)
+        self.assertEqual(query, f"SELECT * FROM read_parquet('{self.input_path}')")
+
+
+class TestBatchDriver(unittest.TestCase):
+    """Runs a folder of synthetic files through the parallel, resumable driver."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.country_parquet_path = os.path.join(self.tmpdir.name, 'countries.parquet')
+        pq.write_table(pa.table({
+            'isocountrycodealpha2': ['AA'],
+            'geometry': shapely.to_wkb([box(0, 0, 1, 1)]),
+        }), self.country_parquet_path)
+        self.input_folder = os.path.join(self.tmpdir.name, 'input')
+        os.makedirs(self.input_folder)
+        for seed, name in enumerate(['a', 'b', 'c']):
+            write_overture_parquet(os.path.join(self.input_folder, f'input_{name}'), 200 * (seed + 1), bounds=(0.2, 0.2, 0.8, 0.8), seed=seed)
+        self.output_folder = os.path.join(self.tmpdir.name, 'out')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_driver(self, **kwargs):
+        kwargs.setdefault('jobs', 1)
+        return process_parquet_files(
+            self.input_folder, self.output_folder, self.country_parquet_path, add_quadkey_option=True,
+            add_country_iso_option=True, geo_conversion='native', **kwargs,
+        )
+
+    def test_parallel_and_resume(self):
+        self.assertEqual(self.run_driver(jobs=2), [])
+        self.assertEqual(sorted(os.listdir(self.output_folder)), ['a.parquet', 'add_columns_ledger.jsonl', 'b.parquet', 'c.parquet'])
+        ledger = load_ledger(self.output_folder)
+        self.assertEqual(sorted(ledger), ['input_a', 'input_b', 'input_c'])
+        self.assertEqual(pq.read_table(os.path.join(self.output_folder, 'c.parquet')).num_rows, 600)
+
+        # Nothing to do on a rerun.
+        with mock.patch.object(add_columns, 'process_parquet_file') as process:
+            self.assertEqual(self.run_driver(verify=True), [])
+        process.assert_not_called()
+
+        # An output that doesn't match the ledger is redone, and a leftover partial file removed.
+        with open(os.path.join(self.output_folder, 'b.parquet'), 'ab') as f:
+            f.write(b'garbage')
+        with open(os.path.join(self.output_folder, 'a.parquet.partial'), 'wb') as f:
+            f.write(b'garbage')
+        os.remove(os.path.join(self.output_folder, 'a.parquet'))
+        with mock.patch.object(add_columns, 'process_parquet_file', wraps=process_parquet_file) as process:
+            self.assertEqual(self.run_driver(), [])
+        self.assertEqual(sorted(os.path.basename(c.args[0]) for c in process.call_args_list), ['input_a', 'input_b'])
+        self.assertNotIn('a.parquet.partial', os.listdir(self.output_folder))
+        self.assertEqual(pq.read_table(os.path.join(self.output_folder, 'b.parquet')).num_rows, 400)
+
+    def test_retries(self):
+        attempts = []
+
+        def flaky(input_parquet_path, *args):
+            attempts.append(os.path.basename(input_parquet_path))
+            if attempts.count('input_b') < 2 and input_parquet_path.endswith('input_b'):
+                raise RuntimeError('worker died')
+            return process_parquet_file(input_parquet_path, *args)
+
+        with mock.patch.object(add_columns, 'process_parquet_file', side_effect=flaky):
+            self.assertEqual(self.run_driver(retries=1), [])
+        self.assertEqual(attempts.count('input_b'), 2)
+        self.assertEqual(len(load_ledger(self.output_folder)), 3)
+
+        # Out of retries the file is given back as failed, and isn't in the ledger.
+        with mock.patch.object(add_columns, 'process_parquet_file', side_effect=RuntimeError('always')):
+            failed = self.run_driver(overwrite=True, retries=1)
+        self.assertEqual(len(failed), 3)
+        self.assertEqual(load_ledger(self.output_folder), {})
+
+    def test_worker_settings(self):
+        self.assertEqual(parse_memory_limit('4GB'), 4 * 10**9)
+        self.assertEqual(parse_memory_limit('500 MiB'), 500 * 2**20)
+        with self.assertRaises(ValueError):
+            parse_memory_limit('lots')
+
+        with mock.patch('os.cpu_count', return_value=8), mock.patch.object(add_columns, 'total_memory', return_value=10 * 2**30):
+            # 8GB usable fits two 4GB workers, which split the cores.
+            self.assertEqual(worker_settings(), (2, '4096MiB', 4))
+            self.assertEqual(worker_settings(memory_limit='1GiB'), (8, '1GiB', 1))
+            self.assertEqual(worker_settings(jobs=1), (1, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""Tests for the overture partition planning and writing."""
+
+
+import os
+import tempfile
+import unittest
+
+import duckdb
+import pyarrow.parquet as pq
+
+from open_buildings.connection import extension_available
+from open_buildings.overture.partition import (
+    contiguous_chunks,
+    fetch_histogram,
+    pending_jobs,
+    plan_partitions,
+    split_quadkeys,
+    stream_partitions,
+    write_partitions,
+    write_partitions_parallel,
+)
+
+
+class TestOverturePartition(unittest.TestCase):
+    """Partitions a small buildings table where one country needs splitting by quadkey."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.conn = duckdb.connect()
+        # RW has 3 rows, US has 10: 6 under quadkey 0 (4 in 00, 2 in 01) and 4 under quadkey 1.
+        rows = [('RW', '300000000000')] * 3
+        rows += [('US', '000000000000')] * 4 + [('US', '010000000000')] * 2 + [('US', '100000000000')] * 4
+        self.conn.execute("CREATE TABLE buildings (id INTEGER, country_iso VARCHAR, quadkey VARCHAR)")
+        self.conn.executemany("INSERT INTO buildings VALUES (?, ?, ?)", [(i, c, q) for i, (c, q) in enumerate(reversed(rows))])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_split_quadkeys(self):
+        counts = {'000000000000': 4, '010000000000': 2, '100000000000': 4}
+        self.assertEqual([(p, c) for p, _, c in split_quadkeys(counts, 1, 5)], [('00', 4), ('01', 2), ('1', 4)])
+        # A single tile over the limit can't be split any further.
+        self.assertEqual([(p, c) for p, _, c in split_quadkeys({'000000000000': 9}, 1, 5)], [('000000000000', 9)])
+
+    def test_plan_and_write(self):
+        partitions = plan_partitions(fetch_histogram(self.conn, 'buildings', False), 5, False)
+        self.assertEqual([(c, p, n) for c, p, _, n in partitions], [('RW', None, 3), ('US', '00', 4), ('US', '01', 2), ('US', '1', 4)])
+
+        write_partitions(self.conn, 'buildings', partitions, self.tmpdir.name, 'none', 10000, False, True)
+        written = sorted(os.path.relpath(os.path.join(d, f), self.tmpdir.name) for d, _, fs in os.walk(self.tmpdir.name) for f in fs)
+        self.assertEqual(written, [os.path.join('country_iso=RW', 'RW.parquet'), os.path.join('country_iso=US', 'US_00.parquet'),
+                                   os.path.join('country_iso=US', 'US_01.parquet'), os.path.join('country_iso=US', 'US_1.parquet')])
+        table = pq.read_table(os.path.join(self.tmpdir.name, 'country_iso=US', 'US_00.parquet'))
+        self.assertEqual(table.column_names, ['id', 'country_iso', 'quadkey'])
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(set(table.column('quadkey').to_pylist()), {'000000000000'})
+
+    def test_contiguous_chunks(self):
+        jobs = [(i, f'{i}.parquet', 'US', [], count) for i, count in enumerate([5, 1, 1, 3, 2, 4])]
+        chunks = contiguous_chunks(jobs, 3)
+        self.assertEqual([[job[0] for job in chunk] for chunk in chunks], [[0], [1, 2, 3], [4], [5]])
+
+    def test_stream_run(self):
+        # A worker's job: a run of consecutive files, out of one scan.
+        partitions = plan_partitions(fetch_histogram(self.conn, 'buildings', False), 5, False)
+        jobs = pending_jobs(partitions, self.tmpdir.name, False, False)[1:3]
+        results = stream_partitions(self.conn, 'buildings', jobs, 'none', 10000, False)
+        self.assertEqual([(os.path.basename(r['file']), r['rows']) for r in results], [('US_00.parquet', 4), ('US_01.parquet', 2)])
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['US_00.parquet', 'US_01.parquet'])
+        self.assertEqual(pq.read_table(os.path.join(self.tmpdir.name, 'US_01.parquet')).column('quadkey').to_pylist(), ['010000000000'] * 2)
+
+    @unittest.skipUnless(extension_available('spatial'), "needs DuckDB's spatial extension")
+    def test_write_parallel(self):
+        # The workers open the database themselves, so it has to be a file.
+        duckdb_path = os.path.join(self.tmpdir.name, 'buildings.duckdb')
+        self.conn.execute(f"ATTACH '{duckdb_path}' AS db")
+        self.conn.execute("CREATE TABLE db.buildings AS SELECT * FROM buildings")
+        self.conn.execute("DETACH db")
+        partitions = plan_partitions(fetch_histogram(self.conn, 'buildings', False), 5, False)
+        output_folder = os.path.join(self.tmpdir.name, 'out')
+
+        # One file is already there, and is left alone.
+        os.makedirs(os.path.join(output_folder, 'country_iso=US'))
+        open(os.path.join(output_folder, 'country_iso=US', 'US_01.parquet'), 'w').close()
+        self.assertEqual([job[0] for job in pending_jobs(partitions, output_folder, True, False)], [0, 1, 3])
+
+        results = write_partitions_parallel(duckdb_path, 'buildings', partitions, output_folder, 'none', 10000, False, True, 2)
+        self.assertEqual(sorted((os.path.basename(r['file']), r['rows']) for r in results), [('RW.parquet', 3), ('US_00.parquet', 4), ('US_1.parquet', 4)])
+        table = pq.read_table(os.path.join(output_folder, 'country_iso=US', 'US_1.parquet'))
+        self.assertEqual(table.column_names, ['id', 'country_iso', 'quadkey'])
+        self.assertEqual(table.column('quadkey').to_pylist(), ['100000000000'] * 4)
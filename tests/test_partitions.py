@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Tests for picking partition files by country and quadkey."""
+
+
+import os
+import tempfile
+import unittest
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import box
+
+from open_buildings.partitions import (
+    bbox_predicate,
+    country_predicate,
+    footer_row_groups,
+    list_partition_files,
+    load_manifest,
+    parse_partition_path,
+    prune_partition_files,
+    quadkey_range_overlaps,
+    select_manifest_files,
+    select_row_groups,
+    select_row_groups_for_areas,
+    write_manifest,
+)
+
+
+class TestPartitions(unittest.TestCase):
+    """Tests for `open_buildings.partitions`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = []
+        for name in ['country_iso=RW/RW.parquet', 'country_iso=US/US_0231.parquet', 'country_iso=US/US_0232.parquet', 'country_iso=US/US_02331.parquet']:
+            path = os.path.join(self.tmpdir.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_partition_path(self):
+        self.assertEqual(parse_partition_path('s3://bucket/country_iso=US/US_0231.parquet'), ('US', '0231'))
+        self.assertEqual(parse_partition_path('s3://bucket/country_iso=RW/RW.parquet'), ('RW', ''))
+        self.assertEqual(parse_partition_path('/data/US_0231.parquet'), ('US', '0231'))
+        self.assertEqual(parse_partition_path('/data/part-0001.parquet'), (None, ''))
+        # The rows without a country.
+        self.assertEqual(parse_partition_path('s3://bucket/country_iso=__HIVE_DEFAULT_PARTITION__/data_0.parquet'), (None, ''))
+        self.assertEqual(parse_partition_path('s3://bucket/country_iso=None/None.parquet'), (None, ''))
+
+    def test_prune_by_quadkey(self):
+        selected = prune_partition_files(self.files, quadkeys=['023312'])
+        self.assertEqual([os.path.basename(f) for f in selected], ['RW.parquet', 'US_02331.parquet'])
+        # An AOI bigger than the file tiles keeps all of them.
+        self.assertEqual(len(prune_partition_files(self.files, quadkeys=['02'])), 4)
+
+    def test_prune_by_country(self):
+        selected = prune_partition_files(self.files, countries=['US'], quadkeys=['0232'])
+        self.assertEqual([os.path.basename(f) for f in selected], ['US_0232.parquet'])
+
+    def test_null_country(self):
+        null_file = os.path.join(self.tmpdir.name, 'country_iso=__HIVE_DEFAULT_PARTITION__', 'data_0.parquet')
+        files = self.files + [null_file]
+        # A partition of buildings without a country can hold some in any AOI.
+        self.assertEqual(prune_partition_files(files, countries=['US'], quadkeys=['0232'])[-1], null_file)
+        self.assertEqual(prune_partition_files(files, countries=[], quadkeys=['0232']), [null_file])
+
+        self.assertEqual(country_predicate(['RW']), "country_iso IN ('RW')")
+        self.assertEqual(country_predicate(['RW', 'US'], include_null=True), "(country_iso IN ('RW', 'US') OR country_iso IS NULL)")
+        self.assertEqual(country_predicate([]), "country_iso IS NULL")
+        con = duckdb.connect()
+        con.execute("CREATE TABLE buildings AS SELECT * FROM (VALUES ('RW'), ('US'), (NULL)) t(country_iso)")
+        rows = con.execute(f"SELECT country_iso FROM buildings WHERE {country_predicate(['RW'], include_null=True)} ORDER BY country_iso").fetchall()
+        self.assertEqual(rows, [('RW',), (None,)])
+
+    def test_list_partition_files(self):
+        con = duckdb.connect()
+        files = list_partition_files(con, os.path.join(self.tmpdir.name, '*', '*.parquet'))
+        self.assertEqual(sorted(files), sorted(self.files))
+
+
+class TestManifest(unittest.TestCase):
+    """Writes a couple of partition files and checks the manifest describes them."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        os.makedirs(os.path.join(root, 'country_iso=AA'))
+        os.makedirs(os.path.join(root, 'country_iso=BB'))
+        # AA has a bbox struct like Overture, BB only geometry like Google.
+        boxes = [box(1, 1, 2, 2), box(3, 3, 4, 4), box(5, 5, 6, 6)]
+        pq.write_table(pa.table({
+            'quadkey': ['1', '2', '3'],
+            'bbox': [dict(minx=b.bounds[0], miny=b.bounds[1], maxx=b.bounds[2], maxy=b.bounds[3]) for b in boxes],
+            'geometry': shapely.to_wkb(boxes),
+        }), os.path.join(root, 'country_iso=AA', 'AA.parquet'), row_group_size=2)
+        pq.write_table(pa.table({
+            'quadkey': ['3'],
+            'geometry': shapely.to_wkb([box(50, 50, 51, 51)]),
+        }), os.path.join(root, 'country_iso=BB', 'BB_3.parquet'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_manifest(self):
+        write_manifest(self.tmpdir.name)
+        data_path = os.path.join(self.tmpdir.name, '*', '*.parquet')
+        manifest = load_manifest(duckdb.connect(), data_path)
+        entries = {e['path']: e for e in manifest['files']}
+        aa = entries['country_iso=AA/AA.parquet']
+        self.assertEqual(aa['num_rows'], 3)
+        self.assertEqual(aa['bbox'], [1, 1, 6, 6])
+        self.assertEqual([rg['bbox'] for rg in aa['row_groups']], [[1, 1, 4, 4], [5, 5, 6, 6]])
+        self.assertEqual(aa['row_groups'][0]['quadkey_min'], '1')
+        self.assertGreater(aa['row_groups'][0]['num_bytes'], 0)
+        bb = entries['country_iso=BB/BB_3.parquet']
+        self.assertEqual((bb['country_iso'], bb['quadkey'], bb['bbox']), ('BB', '3', [50, 50, 51, 51]))
+
+        selected = select_manifest_files(manifest, data_path, (49, 49, 52, 52))
+        self.assertEqual([os.path.basename(f) for f in selected], ['BB_3.parquet'])
+        self.assertEqual(select_manifest_files(manifest, data_path, (49, 49, 52, 52), countries=['AA']), [])
+
+    def test_row_groups(self):
+        aa_path = os.path.join(self.tmpdir.name, 'country_iso=AA', 'AA.parquet')
+        row_groups = footer_row_groups(pq.ParquetFile(aa_path).metadata)
+        self.assertEqual([rg['bbox'] for rg in row_groups], [[1, 1, 4, 4], [5, 5, 6, 6]])
+        self.assertEqual([(rg['quadkey_min'], rg['quadkey_max']) for rg in row_groups], [('1', '2'), ('3', '3')])
+
+        self.assertEqual(select_row_groups(row_groups, (4.5, 4.5, 7, 7)), [1])
+        self.assertEqual(select_row_groups(row_groups, (0, 0, 10, 10), quadkeys=['2']), [0])
+        self.assertEqual(select_row_groups(row_groups, (0, 0, 10, 10), quadkeys=['21']), [])
+        self.assertEqual(select_row_groups(row_groups, (10, 10, 11, 11)), [])
+        # Many areas keep the row groups any one of them needs.
+        self.assertEqual(select_row_groups_for_areas(row_groups, [((4.5, 4.5, 7, 7), None), ((0, 0, 10, 10), ['2'])]), [0, 1])
+        self.assertEqual(select_row_groups_for_areas(row_groups, [((10, 10, 11, 11), None)]), [])
+        # Without a bbox struct there's nothing in the footer to go on, so they're all kept.
+        bb_path = os.path.join(self.tmpdir.name, 'country_iso=BB', 'BB_3.parquet')
+        self.assertEqual(select_row_groups(footer_row_groups(pq.ParquetFile(bb_path).metadata), (0, 0, 1, 1)), [0])
+
+        self.assertTrue(quadkey_range_overlaps('0231', '0230', '0232'))
+        self.assertTrue(quadkey_range_overlaps('023', '0231', '0231'))
+        self.assertTrue(quadkey_range_overlaps('', '1', '2'))
+        self.assertFalse(quadkey_range_overlaps('0231', '0232', '0233'))
+        self.assertFalse(quadkey_range_overlaps('0231', '02', '0230'))
+
+        rows = duckdb.connect().execute(
+            f"SELECT quadkey FROM read_parquet('{aa_path}') WHERE {bbox_predicate((3.5, 3.5, 5.5, 5.5))} ORDER BY quadkey"
+        ).fetchall()
+        self.assertEqual(rows, [('2',), ('3',)])
+
+    def test_no_manifest(self):
+        self.assertIsNone(load_manifest(duckdb.connect(), os.path.join(self.tmpdir.name, '*', '*.parquet')))
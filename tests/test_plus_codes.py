@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Tests for the vectorized Plus Code encoder and decoder."""
+
+
+import unittest
+
+import duckdb
+import numpy as np
+from openlocationcode import openlocationcode as olc
+
+from open_buildings.plus_codes import decode, encode, register_plus_code_function
+
+
+class TestPlusCodes(unittest.TestCase):
+    """Tests for `open_buildings.plus_codes`, checked against openlocationcode."""
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.lat = rng.uniform(-90, 90, 20000)
+        self.lon = rng.uniform(-180, 180, 20000)
+        # Edges: the poles, the antimeridian, longitudes that need normalizing and
+        # points right on a cell boundary.
+        edges = [(90, 180), (-90, -180), (0, -360.5), (45.5, 540), (89.99999, 179.9999999), (-1.0, 30.0), (0.000125, 0.000125)]
+        self.lat[:len(edges)] = [lat for lat, _ in edges]
+        self.lon[:len(edges)] = [lon for _, lon in edges]
+
+    def test_encode_matches_reference(self):
+        for code_length in (2, 4, 8, 10, 11, 12, 15):
+            expected = [olc.encode(float(lat), float(lon), codeLength=code_length) for lat, lon in zip(self.lat, self.lon)]
+            self.assertEqual(encode(self.lat, self.lon, code_length).to_pylist(), expected)
+
+    def test_decode_matches_reference(self):
+        codes = [olc.encode(float(lat), float(lon), codeLength=12) for lat, lon in zip(self.lat, self.lon)]
+        codes += [olc.encode(float(lat), float(lon), codeLength=8) for lat, lon in zip(self.lat[:1000], self.lon[:1000])]
+        codes += ['8FVC0000+', '6GFG2222+2222'.lower()]
+        areas = decode(codes)
+        for i, code in enumerate(codes):
+            area = olc.decode(code)
+            expected = (area.latitudeLo, area.longitudeLo, area.latitudeHi, area.longitudeHi, area.latitudeCenter, area.longitudeCenter, area.codeLength)
+            self.assertEqual(tuple(float(v[i]) for v in areas), expected, code)
+
+    def test_invalid(self):
+        self.assertEqual(encode([np.nan, 1.0], [1.0, 2.0]).to_pylist(), [None, olc.encode(1.0, 2.0, codeLength=12)])
+        with self.assertRaises(ValueError):
+            encode([1.0], [2.0], 9)
+        with self.assertRaises(ValueError):
+            decode(['8FVC22AB+'])
+
+    def test_duckdb_function(self):
+        con = duckdb.connect()
+        register_plus_code_function(con)
+        result = con.execute("SELECT plus_code(lat, lon) FROM (VALUES (-1.0, 30.0), (NULL, 1.0)) t(lat, lon)").fetchall()
+        self.assertEqual(result, [(olc.encode(-1.0, 30.0, codeLength=12),), (None,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""Tests for the profiling spans."""
+
+
+import json
+import os
+import tempfile
+import unittest
+
+import duckdb
+from click.testing import CliRunner
+
+from open_buildings import profiling
+from open_buildings.cli import main
+
+
+def worker(rows):
+    with profiling.span('worker_step') as s:
+        s.set(rows=rows)
+    return rows * 2
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests for `open_buildings.profiling`."""
+
+    def tearDown(self):
+        profiling.stop()
+
+    def test_disabled(self):
+        self.assertFalse(profiling.enabled())
+        with profiling.span('read_csv') as s:
+            s.set(rows=10)
+        self.assertEqual(profiling.stop(), [])
+        self.assertIsNone(profiling.settings())
+        self.assertEqual(profiling.call(None, worker, 3), (6, []))
+
+    def test_spans(self):
+        profiling.start()
+        with profiling.span('convert', file='a.csv'):
+            with profiling.span('read_csv') as s:
+                s.set(rows=5, bytes=100)
+            sum(range(100000))
+        events = profiling.stop()
+
+        # Spans are recorded as they finish, so the inner one comes first.
+        self.assertEqual([e['name'] for e in events], ['read_csv', 'convert'])
+        read, convert = events
+        self.assertEqual((read['rows'], read['bytes']), (5, 100))
+        self.assertEqual(convert['args'], {'file': 'a.csv'})
+        self.assertLessEqual(convert['start'], read['start'])
+        self.assertGreaterEqual(convert['seconds'], read['seconds'])
+
+        trace = profiling.chrome_trace(events)
+        event = trace['traceEvents'][0]
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args']['rows'], 5)
+        self.assertIn('cpu_ms', event['args'])
+
+        totals = profiling.summarize(events + [dict(read, rows=7)])
+        self.assertEqual(totals['read_csv']['count'], 2)
+        self.assertEqual(totals['read_csv']['rows'], 12)
+
+    def test_execute(self):
+        conn = duckdb.connect()
+        profiling.start(sql=True)
+        profiling.execute(conn, "CREATE TABLE t AS SELECT range AS i FROM range(1000)", 'create')
+        count = profiling.execute(conn, "SELECT COUNT(*) FROM t WHERE i % 2 = 0", 'count').fetchone()[0]
+        events = profiling.stop()
+
+        self.assertEqual(count, 500)
+        count_event = events[1]
+        self.assertEqual(count_event['rows'], 1)
+        self.assertEqual(count_event['args']['duckdb_rows_scanned'], 1000)
+        self.assertIn('duckdb_plan', count_event['args'])
+        # Profiling is turned back off after the statement.
+        self.assertFalse(conn.execute("SELECT current_setting('enable_profiling')").fetchone()[0])
+
+    def test_call_and_merge(self):
+        profiling.start()
+        result = profiling.merge(profiling.call(profiling.settings(), worker, 4))
+        self.assertEqual(result, 8)
+        self.assertEqual([(e['name'], e['rows']) for e in profiling.stop()], [('worker_step', 4)])
+
+    def test_profile_option(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace_path = os.path.join(tmpdir, 'trace.json')
+            csv_path = os.path.join(tmpdir, 'buildings.csv')
+            output_dir = os.path.join(tmpdir, 'out')
+            os.makedirs(output_dir)
+            runner = CliRunner()
+            result = runner.invoke(main, ['google', 'generate', csv_path, '--rows', '100'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            result = runner.invoke(main, ['google', 'convert', csv_path, output_dir, '--process', 'pandas', '--profile', trace_path])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            with open(trace_path) as f:
+                names = {event['name'] for event in json.load(f)['traceEvents']}
+            self.assertEqual(names, {'read_csv', 'split_multis', 'write_fgb'})
+            self.assertIn('write_fgb', result.output)
+            self.assertFalse(profiling.enabled())
+
+
+if __name__ == '__main__':
+    unittest.main()
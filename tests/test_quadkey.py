@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests for the vectorized quadkey functions."""
+
+
+import unittest
+
+import duckdb
+import mercantile
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, box
+
+from open_buildings.quadkey import (
+    lon_lat_to_quadkeys,
+    quadkey_cover,
+    quadkey_predicate,
+    quadkey_ranges,
+    quadkey_upper_bound,
+    register_quadkey_function,
+    tile_box,
+)
+
+
+class TestQuadkey(unittest.TestCase):
+    """Checks the vectorized quadkeys against mercantile."""
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        self.lon = rng.uniform(-180, 180, 20000)
+        self.lat = rng.uniform(-85, 85, 20000)
+        # Points right on tile edges and the corners of the world are where rounding bites.
+        edges = np.array([-180.0, 0.0, 180.0, 90.0, -90.0, 45.0, 22.5])
+        self.lon = np.concatenate([self.lon, edges, np.zeros(len(edges))])
+        self.lat = np.concatenate([self.lat, np.zeros(len(edges)), edges[[1, 1, 1, 5, 5, 5, 6]]])
+
+    def expected(self, level):
+        return [mercantile.quadkey(mercantile.tile(lon, lat, level)) for lon, lat in zip(self.lon, self.lat)]
+
+    def test_matches_mercantile(self):
+        for level in (1, 5, 12, 18):
+            result = lon_lat_to_quadkeys(self.lon, self.lat, level).to_pylist()
+            self.assertEqual(result, self.expected(level))
+
+    def test_nan_gives_null(self):
+        result = lon_lat_to_quadkeys([np.nan, 10.0], [10.0, 10.0], 12).to_pylist()
+        self.assertIsNone(result[0])
+        self.assertEqual(result[1], mercantile.quadkey(mercantile.tile(10.0, 10.0, 12)))
+
+    def test_duckdb_function(self):
+        con = duckdb.connect()
+        register_quadkey_function(con)
+        con.execute("CREATE TABLE points AS SELECT * FROM (SELECT unnest($1) AS lon, unnest($2) AS lat)", [self.lon.tolist(), self.lat.tolist()])
+        rows = con.execute("SELECT lat_lon_to_quadkey(lat, lon, 12) FROM points").fetchall()
+        self.assertEqual([r[0] for r in rows], self.expected(12))
+
+
+class TestQuadkeyCover(unittest.TestCase):
+    """Checks the multi-tile covers of an AOI and the conditions made from them."""
+
+    def check_cover(self, geometry, max_tiles):
+        quadkeys = quadkey_cover(geometry, max_tiles)
+        self.assertLessEqual(len(quadkeys), max_tiles)
+        self.assertEqual(quadkeys, sorted(quadkeys))
+        tiles = shapely.union_all([tile_box(mercantile.quadkey_to_tile(q)) for q in quadkeys])
+        self.assertTrue(tiles.covers(geometry))
+        return quadkeys
+
+    def test_cover(self):
+        # An AOI on the corner of the four quadrants would get the whole world as one tile.
+        quadkeys = self.check_cover(box(-1, -1, 1, 1), 16)
+        self.assertEqual({q[0] for q in quadkeys}, {'0', '1', '2', '3'})
+        self.assertEqual(len(quadkeys), 16)
+
+        # A tiny one there gets the four level 12 tiles around the corner.
+        quadkeys = self.check_cover(box(-0.001, -0.001, 0.001, 0.001), 16)
+        self.assertEqual(len(quadkeys), 4)
+        self.assertTrue(all(len(q) == 12 for q in quadkeys))
+
+        # An L leaves out tiles in the corner it doesn't reach.
+        l_shape = Polygon([(10, 10), (12, 10), (12, 10.2), (10.2, 10.2), (10.2, 12), (10, 12)])
+        quadkeys = self.check_cover(l_shape, 32)
+        total = sum(tile_box(mercantile.quadkey_to_tile(q)).area for q in quadkeys)
+        self.assertLess(total, box(10, 10, 12, 12).area)
+
+        self.assertEqual(len(self.check_cover(box(-1, -1, 1, 1), 1)), 1)
+        with self.assertRaises(ValueError):
+            quadkey_cover(box(0, 0, 1, 1), 0)
+
+    def test_ranges(self):
+        self.assertEqual(quadkey_upper_bound('0233'), '03')
+        self.assertEqual(quadkey_upper_bound('012'), '013')
+        self.assertIsNone(quadkey_upper_bound('33'))
+        self.assertEqual(quadkey_ranges(['01', '02', '021', '1']), [('01', '03'), ('1', '2')])
+        self.assertEqual(quadkey_ranges(['3']), [('3', None)])
+
+    def test_predicate(self):
+        self.assertEqual(quadkey_predicate(['0123', '0120'], level=4), "quadkey IN ('0120', '0123')")
+        self.assertEqual(quadkey_predicate(['01']), "(quadkey >= '01' AND quadkey < '02')")
+        self.assertEqual(quadkey_predicate(['3', '2']), "quadkey >= '2'")
+        self.assertEqual(quadkey_predicate(['0', '3']), "((quadkey >= '0' AND quadkey < '1') OR quadkey >= '3')")
+        self.assertEqual(quadkey_predicate([]), "FALSE")
+
+        # Run through DuckDB it picks the same rows as matching the prefixes one by one.
+        quadkeys = lon_lat_to_quadkeys(np.linspace(-20, 20, 400), np.linspace(-20, 20, 400), 12).to_pylist()
+        cover = quadkey_cover(box(-2, -2, 3, 3), 8)
+        con = duckdb.connect()
+        con.execute("CREATE TABLE buildings AS SELECT unnest($1) AS quadkey", [quadkeys])
+        rows = con.execute(f"SELECT quadkey FROM buildings WHERE {quadkey_predicate(cover)} ORDER BY quadkey").fetchall()
+        expected = sorted(q for q in quadkeys if any(q.startswith(c) for c in cover))
+        self.assertEqual([r[0] for r in rows], expected)
+        self.assertGreater(len(expected), 0)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Tests for the synthetic building generators."""
+
+
+import filecmp
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import duckdb
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+from openlocationcode import openlocationcode as olc
+
+from open_buildings.google.process import process_with_pandas
+from open_buildings.overture.add_columns import add_quadkey
+from open_buildings.quadkey import lon_lat_to_quadkeys
+from open_buildings.synthetic import building_batches, write_google_csv, write_overture_parquet
+
+
+class TestSynthetic(unittest.TestCase):
+    """Tests for `open_buildings.synthetic`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_batches(self):
+        # Small batches, to check rows are split across them and each batch gets its own generator.
+        with mock.patch('open_buildings.synthetic.BATCH_SIZE', 300):
+            batches = list(building_batches(1000, 0.25, 'uniform', (10.0, 20.0, 11.0, 21.0), seed=1))
+        self.assertEqual([len(b.geometry) for b in batches], [300, 300, 300, 100])
+        self.assertFalse(np.array_equal(batches[0].latitude, batches[1].latitude[:300]))
+
+        geometry = np.concatenate([b.geometry for b in batches])
+        self.assertTrue(shapely.is_valid(geometry).all())
+        bounds = shapely.total_bounds(geometry)
+        self.assertTrue(10.0 < bounds[0] and bounds[2] < 11.0 and 20.0 < bounds[1] and bounds[3] < 21.0)
+        multi = shapely.get_type_id(geometry) == 6
+        self.assertAlmostEqual(multi.mean(), 0.25, delta=0.05)
+        self.assertTrue((shapely.get_num_geometries(geometry[multi]) == 2).all())
+
+        # The area is close to the equal area one the conversion computes.
+        area = np.concatenate([b.area_in_meters for b in batches])
+        projected = gpd.GeoSeries(geometry, crs='EPSG:4326').to_crs('EPSG:6933').area.values
+        np.testing.assert_allclose(projected, area, rtol=0.02)
+
+    def test_clustered(self):
+        def tiles(distribution):
+            batch = next(building_batches(20000, 0, distribution, seed=2))
+            return len(set(lon_lat_to_quadkeys(batch.longitude, batch.latitude, 12).to_pylist()))
+
+        # Clustered buildings crowd into far fewer tiles.
+        self.assertLess(tiles('clustered') * 5, tiles('uniform'))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            next(building_batches(10, distribution='gaussian'))
+        with self.assertRaises(ValueError):
+            next(building_batches(10, multipolygon_ratio=1.5))
+
+    def test_google_csv(self):
+        write_google_csv(self.path('a.csv'), 500, 0.2, seed=3)
+        write_google_csv(self.path('b.csv'), 500, 0.2, seed=3)
+        write_google_csv(self.path('c.csv'), 500, 0.2, seed=4)
+        self.assertTrue(filecmp.cmp(self.path('a.csv'), self.path('b.csv'), shallow=False))
+        self.assertFalse(filecmp.cmp(self.path('a.csv'), self.path('c.csv'), shallow=False))
+
+        df = pd.read_csv(self.path('a.csv'))
+        self.assertEqual(list(df.columns), ['latitude', 'longitude', 'area_in_meters', 'confidence', 'geometry', 'full_plus_code'])
+        self.assertEqual(len(df), 500)
+        row = df.iloc[0]
+        self.assertEqual(row.full_plus_code, olc.encode(row.latitude, row.longitude, codeLength=12))
+        self.assertTrue(shapely.from_wkt(row.geometry).contains(shapely.Point(row.longitude, row.latitude)))
+
+        # The conversion reads it like a real file.
+        output = self.path('a.parquet')
+        process_with_pandas(self.path('a.csv'), True, False, 'parquet', output)
+        self.assertGreater(len(gpd.read_parquet(output)), 500)
+
+    def test_overture_parquet(self):
+        path = self.path('buildings.parquet')
+        write_overture_parquet(path, 1000, seed=5, row_group_size=400)
+        metadata = pq.ParquetFile(path).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [400, 400, 200])
+
+        gdf = gpd.read_parquet(path)
+        bbox = pd.DataFrame(gdf['bbox'].tolist())
+        np.testing.assert_array_equal(bbox[['minx', 'miny', 'maxx', 'maxy']].values, gdf.geometry.bounds.values)
+        self.assertEqual(gdf['id'].nunique(), 1000)
+
+        # add_columns can give it quadkeys from the bbox struct.
+        con = duckdb.connect()
+        con.execute(f"CREATE TABLE buildings AS SELECT * FROM read_parquet('{path}')")
+        add_quadkey(con)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM buildings WHERE length(quadkey) = 12").fetchone()[0], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()